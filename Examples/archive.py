@@ -0,0 +1,225 @@
+"""
+--------------------------------------------------
+  Weather Radar! --  Record & replay
+--------------------------------------------------
+
+Everything the radar shows depends on what the NWS servers send back at the
+time, so two runs are never the same. This records every request & response
+of a refresh into a zip archive, then replays it later (offline, as many
+times as you like) with the same results, bit for bit:
+
+* Recorder: a net.py transport that passes requests on and keeps the responses
+* Replay: a net.py transport that answers from an archive, with optional
+  latency & bandwidth (so slow networks can be tried too)
+* datetime.now() is frozen at the time the archive was recorded (the labels
+  say "x mins ago", and the station status depends on it)
+
+The archive has an index.json, and each different response body once (tiles
+that are the same are only stored once). PNGs aren't compressed again.
+
+    python3 archive.py record cycle.zip
+    python3 archive.py replay cycle.zip --latency 0.05 --bandwidth 250000
+
+Each run prints a fingerprint of the frames, so runs (and versions of the
+code) can be compared.
+
+"""
+
+import os
+import json
+import time
+import hashlib
+import zipfile
+import argparse
+import tempfile
+import threading
+from datetime import datetime, timezone
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+ARCHIVE_VERSION = 1
+KEPT_HEADERS = ["Content-Type"]
+STORED_TYPES = ["image/png", "image/jpeg", "image/webp"] #Already compressed
+
+################################################
+#  FUNCTIONS!
+################################################
+class Recorder:
+    ''' net.py transport that gets urls with requests, and keeps a copy of every response. '''
+
+    def __init__(self):
+        self.recorded = datetime.now(timezone.utc).timestamp() #(Replays are frozen at this time)
+        self.entries = [] #url, status, headers, body hash (or the error), seconds
+        self.bodies = {}  #hash -> (body, content type)
+        self.lock = threading.Lock()
+        self.sessions = threading.local()
+
+    def get(self, url, headers=None, timeout=None, stream=False):
+        if not hasattr(self.sessions, 'session'):
+            self.sessions.session = requests.Session()
+
+        started = time.monotonic()
+        entry = {'url': url}
+        try:
+            response = self.sessions.session.get(url, headers=headers, timeout=timeout, stream=stream)
+            body = response.content #(Even if it's streamed, so it can be kept)
+        except requests.exceptions.RequestException as error:
+            entry['error'] = type(error).__name__
+            raise
+        else:
+            kept_headers = {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers}
+            digest = hashlib.sha256(body).hexdigest()
+            entry.update(status=response.status_code, headers=kept_headers, body=digest)
+            with self.lock:
+                self.bodies[digest] = (body, kept_headers.get("Content-Type", ""))
+            return response
+        finally:
+            entry['seconds'] = round(time.monotonic() - started, 3)
+            with self.lock:
+                self.entries.append(entry)
+
+    def save(self, path):
+        ''' Write the archive (a zip file) '''
+        index = {'version': ARCHIVE_VERSION, 'recorded': self.recorded, 'requests': self.entries}
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("index.json", json.dumps(index, indent=1))
+            for digest, (body, content_type) in self.bodies.items():
+                stored = content_type.split(";")[0] in STORED_TYPES
+                archive.writestr(f"bodies/{digest}", body, compress_type=zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED)
+
+class Replay:
+    ''' net.py transport that answers from an archive.
+        A url that was asked for more than once gets its responses in the same
+        order (then the last one again). Anything that isn't in the archive is a 404.
+    '''
+
+    def __init__(self, path, latency=0, bandwidth=None):
+        ''' Param path: Archive from Recorder.save()
+            Param latency: Seconds before each response starts
+            Param bandwidth: Bytes per second (None = no limit)
+        '''
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.responses = {} #url -> [entries]
+        self.served = {}    #url -> number of times it's been asked for
+        self.lock = threading.Lock()
+
+        with zipfile.ZipFile(path) as archive:
+            index = json.loads(archive.read("index.json"))
+            if index.get('version') != ARCHIVE_VERSION:
+                raise ValueError(f"Unknown archive version ({index.get('version')})")
+            self.recorded = index['recorded']
+            self.bodies = {name.split("/", 1)[1]: archive.read(name) for name in archive.namelist() if name.startswith("bodies/")}
+
+        for entry in index['requests']:
+            self.responses.setdefault(entry['url'], []).append(entry)
+
+    def get(self, url, headers=None, timeout=None, stream=False):
+        with self.lock:
+            entries = self.responses.get(url)
+            count = self.served.get(url, 0)
+            self.served[url] = count + 1
+        if not entries:
+            return self.wait(make_response(url, 404, {}, b"Not in the archive"), timeout)
+
+        entry = entries[min(count, len(entries) - 1)]
+        if 'error' in entry:
+            time.sleep(self.latency)
+            raise getattr(requests.exceptions, entry['error'], requests.exceptions.ConnectionError)(f"{entry['error']} (recorded)")
+        return self.wait(make_response(url, entry['status'], entry['headers'], self.bodies[entry['body']]), timeout)
+
+    def wait(self, response, timeout):
+        ''' Take as long as the response would on the network (or time out) '''
+        seconds = self.latency
+        if self.bandwidth:
+            seconds += len(response.content) / self.bandwidth
+
+        read_timeout = timeout[1] if isinstance(timeout, tuple) else timeout
+        if read_timeout is not None and seconds > read_timeout:
+            time.sleep(read_timeout)
+            raise requests.exceptions.ReadTimeout(f"Replay: {seconds:.1f} seconds is longer than the timeout")
+        time.sleep(seconds)
+        return response
+
+def make_response(url, status, headers, body):
+    ''' Returns a requests Response (already read, so .content & .iter_content() both work) '''
+    response = requests.Response()
+    response.url = url
+    response.status_code = status
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = body
+    response._content_consumed = True
+    return response
+
+class FrozenDatetime(datetime):
+    ''' datetime, but now() is always the same time. '''
+
+    frozen = None #UTC timestamp
+
+    @classmethod
+    def now(cls, tz=None):
+        return datetime.fromtimestamp(cls.frozen, tz)
+
+def run_cycle(transport, frozen):
+    ''' Run a refresh (from a cold start) through a transport.
+        Param transport: Recorder or Replay
+        Param frozen: UTC timestamp for datetime.now()
+
+        Returns the frames, and how long it took (seconds)
+    '''
+    import net
+    import weather_radar
+
+    FrozenDatetime.frozen = frozen
+    weather_radar.datetime = FrozenDatetime
+    weather_radar.EXPORT_DIR = None
+    net.transport = transport
+
+    with tempfile.TemporaryDirectory() as folder:
+        weather_radar.STATE_FILE = os.path.join(folder, "radar_state.pickle") #(Nothing saved, so it's a cold start)
+        weather_radar.new_event_loop()
+        started = time.monotonic()
+        weather_radar.start_session()
+        frames, interval = weather_radar.refresh_radar()
+
+    return frames, time.monotonic() - started
+def fingerprint(frames):
+    ''' Returns a hash of the frames (the same frames give the same hash) '''
+    digest = hashlib.sha256()
+    for frame in frames:
+        digest.update(f"{frame.mode} {frame.size}".encode())
+        digest.update(frame.tobytes())
+    return digest.hexdigest()[:16]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record a refresh into an archive, or replay one.")
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("archive", help="Archive (zip) to write or read")
+    parser.add_argument("--latency", type=float, default=0, help="Replay: seconds before each response")
+    parser.add_argument("--bandwidth", type=float, default=None, help="Replay: bytes per second")
+    parser.add_argument("--frames", help="Folder to save the frames to (PNG)")
+    args = parser.parse_args()
+
+    if args.mode == "record":
+        transport = Recorder()
+        frozen = transport.recorded
+    else:
+        transport = Replay(args.archive, args.latency, args.bandwidth)
+        frozen = transport.recorded
+
+    frames, seconds = run_cycle(transport, frozen)
+
+    if args.mode == "record":
+        transport.save(args.archive)
+        print(f"\nRecorded {len(transport.entries)} requests ({len(transport.bodies)} different responses) to {args.archive} ({os.path.getsize(args.archive) / 1024:.0f} KB)")
+    else:
+        missing = [url for url in transport.served if url not in transport.responses]
+        print(f"\nReplayed {sum(transport.served.values())} requests ({len(missing)} not in the archive)")
+
+    if args.frames:
+        os.makedirs(args.frames, exist_ok=True)
+        for i, frame in enumerate(frames):
+            frame.save(os.path.join(args.frames, f"frame_{i:02d}.png"))
+
+    print(f"{len(frames)} frames in {seconds:.2f} seconds, fingerprint {fingerprint(frames)}")
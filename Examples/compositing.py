@@ -0,0 +1,169 @@
+"""
+--------------------------------------------------
+  Weather Radar! --  Parallel compositing
+--------------------------------------------------
+
+Once the downloads are done, putting the frames together is all CPU, and
+frames don't depend on each other. So they're put together in a pool of
+worker processes, one frame per core at a time:
+
+* The layers that are the same for every frame (everything below & above the
+  radar, and the circle overlay) are copied into shared memory once per
+  refresh. Workers use them straight from there (no pickling, no copies).
+* Each task only sends its radar image and time text, and gets the frame back.
+
+    pool = make_pool(4)
+    with SharedLayers(below, above, circle) as layers:
+        frame = await composite_async(pool, layers, radar, text, font)
+
+put_together() is the compositing itself, so frames are the same whether
+they're made in a worker or not.
+
+"""
+
+import os
+import uuid
+import asyncio
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from sprites import draw_glyphs, text_length
+
+RADAR_OPACITY = 155 #Alpha of the radar's coloured pixels
+LAYER_COUNT = 3     #Below the radar, above it, and the circle overlay
+
+attached = {} #(In a worker) shared memory name -> (SharedMemory, layer images)
+
+################################################
+#  FUNCTIONS!
+################################################
+class SharedLayers:
+    ''' The layers that are the same for every frame, in shared memory. '''
+
+    def __init__(self, below, above, circle):
+        ''' Param below, above, circle: RGBA images (all the same size) '''
+        self.size = below.size
+        shape = (LAYER_COUNT, self.size[1], self.size[0], 4)
+        name = f"radar_{os.getpid()}_{uuid.uuid4().hex[:8]}" #(Named here, as our secrets.py hides the one SharedMemory names them with)
+        self.memory = shared_memory.SharedMemory(name=name, create=True, size=int(np.prod(shape)))
+        pixels = np.ndarray(shape, dtype=np.uint8, buffer=self.memory.buf)
+        for index, layer in enumerate([below, above, circle]):
+            pixels[index] = np.asarray(layer.convert("RGBA"))
+        del pixels #(The memory can't be closed while there's an array using it)
+        self.spec = (self.memory.name, self.size) #What the workers are sent
+
+    def close(self):
+        ''' Free the shared memory (workers let go of it when the next one comes along) '''
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *error):
+        self.close()
+
+def make_pool(workers):
+    ''' Start the worker processes.
+        They're forked, so start them before any threads are (e.g. at the start of main()).
+        Param workers: Number of processes
+
+        Returns a ProcessPoolExecutor
+    '''
+    resource_tracker.ensure_running() #(So the workers share ours, and don't clean up shared memory that isn't theirs)
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+    list(pool.map(warm_up, range(workers))) #Start them all now
+    return pool
+def warm_up(index):
+    return index
+def put_together(below, above, circle, radar, text, font):
+    ''' Put a frame together.
+        Param below, above, circle: Layers (RGBA images)
+        Param radar: Radar image
+        Param text: Time text (along the top)
+        Param font: (file, size) tuple for the time
+
+        Returns a PIL image.
+    '''
+    time_layer = Image.new('RGBA', below.size, (255,0,0,0))
+
+    #Centre the time based on text length.
+    #(The times are different every frame, so they're put together from cached characters)
+    text_pos_x = (below.width - text_length(text, font))/2
+    draw_glyphs(
+        time_layer,
+        (text_pos_x,0),
+        text,
+        font=font,
+        fill=(0,0,0,255),
+        stroke_width=3,
+        stroke_fill=(255,255,255,255)
+        )
+
+    combined = Image.alpha_composite(below, make_transparent(radar, RADAR_OPACITY)) # Radar (note function to make radar image transparent)
+    combined = Image.alpha_composite(combined, above) #Warnings, map labels, marker, ring & alert labels
+    combined = Image.alpha_composite(combined, time_layer) #Time
+    combined = Image.alpha_composite(combined, circle) #Circle overlay!
+    return combined
+def make_transparent(image,transparency):
+    ''' Make opague parts of a transparent image, transparent!
+
+        Param image: The image to use.
+        Param transparent: value between 0 & 255. 0 = full transparent, 255 = opaque.
+
+        Returns a reconstructed image.
+    '''
+    #Make sure the image has an alpha channel
+    image = image.convert("RGBA")
+
+    #Do some array magic.
+    img_array = np.array(image)
+    img_array[:, :, 3] = (transparency * (img_array[:, :, :3] != 255).any(axis=2))
+
+    return Image.fromarray(img_array)
+def shared_layers(spec):
+    ''' (In a worker) Returns the layers in shared memory, as images that use it directly '''
+    name, size = spec
+    if name not in attached:
+        #Let go of the last refresh's layers
+        for old_name in list(attached):
+            memory, layers = attached.pop(old_name)
+            del layers
+            memory.close()
+
+        memory = shared_memory.SharedMemory(name=name)
+        pixels = np.ndarray((LAYER_COUNT, size[1], size[0], 4), dtype=np.uint8, buffer=memory.buf)
+        attached[name] = (memory, [Image.frombuffer("RGBA", size, pixels[index], "raw", "RGBA", 0, 1) for index in range(LAYER_COUNT)])
+    return attached[name][1]
+def composite_task(spec, radar, text, font):
+    ''' (In a worker) Put a frame together.
+        Param spec: SharedLayers.spec
+        Param radar: RGBA array of the radar image
+        Param text, font: The time, and its font
+
+        Returns the frame, as an RGBA array
+    '''
+    below, above, circle = shared_layers(spec)
+    return np.asarray(put_together(below, above, circle, Image.fromarray(radar), text, font))
+async def composite_async(pool, layers, radar, text, font):
+    ''' Put a frame together in the pool (without blocking the event loop).
+        Param pool: From make_pool()
+        Param layers: SharedLayers
+        Param radar: Radar image
+        Param text, font: The time, and its font
+
+        Returns a PIL image.
+    '''
+    pixels = await asyncio.wrap_future(pool.submit(composite_task, layers.spec, np.asarray(radar.convert("RGBA")), text, font))
+    return Image.fromarray(pixels)
+def composite_many(pool, layers, radars, texts, font):
+    ''' Put lots of frames together in the pool (all at the same time).
+
+        Returns a list of PIL images.
+    '''
+    tasks = [pool.submit(composite_task, layers.spec, np.asarray(radar.convert("RGBA")), text, font) for radar, text in zip(radars, texts)]
+    return [Image.fromarray(task.result()) for task in tasks]
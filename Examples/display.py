@@ -0,0 +1,165 @@
+"""
+--------------------------------------------------
+  Weather Radar! --  Partial display updates
+--------------------------------------------------
+
+Between two radar frames, most of the screen (basemap, ring, overlay) stays the
+same. Only the radar and the time label change. So instead of sending the whole
+320x240 frame over SPI every time, we find the bands of rows that changed (and
+the columns they changed in) and only send those windows. The ILI9341 only
+writes pixels inside the window we give it.
+
+    shown = push_frame(disp, frame, shown)
+
+MockDisplay works like the ILI9341 (same image() method) but just counts the
+bytes that would have been sent, so the savings can be checked without hardware.
+Displays that show frames all at once (framebuffer.py) have a flip() method,
+which is called after the windows are sent.
+
+"""
+
+import numpy as np
+from PIL import Image
+
+WINDOW_COST = 64 #Bytes. Roughly what each extra window costs (commands + the call itself)
+
+################################################
+#  FUNCTIONS!
+################################################
+def to_rgb565(image):
+    ''' Convert a PIL image to the display's 16 bit colours.
+        Param image: PIL image (RGB or RGBA)
+
+        Returns a (height, width) uint16 array.
+    '''
+    pixels = np.asarray(image.convert("RGB")).astype(np.uint16)
+    return ((pixels[:, :, 0] & 0xF8) << 8) | ((pixels[:, :, 1] & 0xFC) << 3) | (pixels[:, :, 2] >> 3)
+def display_colours(disp, image):
+    ''' Convert a PIL image to colours as the display sees them (so changes it can't show are ignored).
+        Param disp: The display (16 bits per pixel, unless it has a bits_per_pixel that says otherwise)
+        Param image: PIL image
+
+        Returns a (height, width) array.
+    '''
+    if getattr(disp, 'bits_per_pixel', 16) <= 16:
+        return to_rgb565(image)
+    pixels = np.asarray(image.convert("RGB")).astype(np.uint32)
+    return (pixels[:, :, 0] << 16) | (pixels[:, :, 1] << 8) | pixels[:, :, 2]
+def changed_windows(previous, current):
+    ''' Find the windows that need to be sent to go from one frame to the next.
+        Each band of changed rows becomes a window (as wide as the changes in it).
+        Bands that are close together are merged if sending the rows in between
+        costs less than another window.
+
+        Param previous, current: (height, width) arrays of colours (see display_colours())
+
+        Returns a list of (top, left, bottom, right) windows.
+    '''
+    changed = previous != current
+    changed_rows = changed.any(axis=1)
+    if not changed_rows.any():
+        return []
+
+    # Start & end of each run of changed rows
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], changed_rows.view(np.int8), [0]))))
+    bands = edges.reshape(-1, 2)
+
+    windows = []
+    for top, bottom in bands:
+        columns = np.flatnonzero(changed[top:bottom].any(axis=0))
+        window = [top, columns[0], bottom, columns[-1] + 1]
+
+        if windows:
+            # Is it cheaper to stretch the last window down to here?
+            last = windows[-1]
+            left, right = min(last[1], window[1]), max(last[3], window[3])
+            merged = (bottom - last[0]) * (right - left) * 2
+            separate = window_bytes(last) + window_bytes(window) + WINDOW_COST
+            if merged <= separate:
+                windows[-1] = [last[0], left, bottom, right]
+                continue
+
+        windows.append(window)
+
+    return [tuple(int(value) for value in window) for window in windows]
+def window_bytes(window):
+    ''' Returns the number of pixel bytes in a (top, left, bottom, right) window '''
+    top, left, bottom, right = window
+    return (bottom - top) * (right - left) * 2
+def native_position(window, size, rotation):
+    ''' Work out where a window of the (rotated) frame is on the display itself.
+        Param window: (top, left, bottom, right) in the frame
+        Param size: (width, height) of the frame
+        Param rotation: Display rotation (0, 90, 180 or 270)
+
+        Returns (x,y) of the window on the display
+    '''
+    top, left, bottom, right = window
+    width, height = size
+    if rotation == 90:
+        return top, width - right
+    if rotation == 180:
+        return width - right, height - bottom
+    if rotation == 270:
+        return height - bottom, left
+    return left, top
+def push_frame(disp, frame, shown=None):
+    ''' Send a frame to the display, only sending the parts that changed.
+        Param disp: The display (ILI9341, or anything with the same image() method)
+        Param frame: PIL image to show
+        Param shown: What push_frame returned last time (None to send the whole frame)
+
+        Returns what's on the display now (pass it in next time).
+    '''
+    pixels = display_colours(disp, frame)
+
+    if shown is None or shown.shape != pixels.shape:
+        disp.image(frame)
+    else:
+        rotation = getattr(disp, 'rotation', 0)
+        for window in changed_windows(shown, pixels):
+            top, left, bottom, right = window
+            x, y = native_position(window, frame.size, rotation)
+            disp.image(frame.crop((left, top, right, bottom)), x=x, y=y)
+
+    if hasattr(disp, 'flip'): #(Page flipped displays, see framebuffer.py)
+        disp.flip()
+    return pixels
+
+################################################
+# Mock display (for testing without the hardware)
+################################################
+class MockDisplay:
+    ''' Pretends to be the ILI9341 and counts what would be sent over SPI. '''
+
+    COMMAND_BYTES = 11 #Column set (1+4), page set (1+4), memory write (1)
+
+    def __init__(self, width=240, height=320, rotation=270):
+        self.width = width
+        self.height = height
+        self.rotation = rotation
+        self.bytes_sent = 0
+        self.windows = 0
+        self.frames = 0
+        self.screen = Image.new("RGB", (width, height)) #What's on the display (not rotated)
+
+    def image(self, img, rotation=None, x=0, y=0):
+        ''' Same as the ILI9341's image() method. '''
+        if rotation is None:
+            rotation = self.rotation
+        if rotation != 0:
+            img = img.rotate(rotation, expand=True)
+        if x + img.width > self.width or y + img.height > self.height:
+            raise ValueError(f"Image must not exceed dimensions of display ({self.width}x{self.height}).")
+
+        self.screen.paste(img.convert("RGB"), (x, y))
+        self.bytes_sent += img.width * img.height * 2 + self.COMMAND_BYTES
+        self.windows += 1
+        if (x, y, img.width, img.height) == (0, 0, self.width, self.height):
+            self.frames += 1
+
+    def shown(self):
+        ''' Returns what's on the display, the right way up. '''
+        if self.rotation == 0:
+            return self.screen.copy()
+        return self.screen.rotate(-self.rotation, expand=True)
@@ -0,0 +1,186 @@
+"""
+--------------------------------------------------
+  Weather Radar! --  Animated exports
+--------------------------------------------------
+
+Save a loop of frames as an animated GIF, APNG or WebP (for web pages, chat
+alerts, etc.)
+
+All the frames are quantized together to ONE shared palette, so colours don't
+flicker between frames and the palette is only stored once. Only the part of
+each frame that changed from the frame before is saved:
+
+* GIF:  Written here. Each frame is just the changed rectangle, and pixels in
+        that rectangle that didn't change are transparent (compresses better).
+* APNG: Pillow writes only the changed rectangle of each frame.
+* WebP: libwebp's animation encoder does the same.
+
+"""
+
+import os
+import time
+import struct
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+TRANSPARENT = 255 #Palette index kept free for "unchanged" pixels in GIFs
+
+################################################
+#  FUNCTIONS!
+################################################
+def export_animation(frames, path, duration=750, loop=0):
+    ''' Save frames as an animation. The format comes from the file extension
+        (.gif, .png/.apng, or .webp)
+        Param frames: A list of PIL images (all the same size)
+        Param path: File to save to
+        Param duration: Milliseconds per frame
+        Param loop: Number of loops (0 = forever)
+
+        Returns the number of bytes written.
+    '''
+    extension = os.path.splitext(path)[1].lower()
+    indexes, palette = shared_palette(frames)
+
+    # Write to a temporary file and swap it in, so a web server never sees half a file
+    temp_path = f"{path}.tmp"
+    if extension == ".gif":
+        with open(temp_path, 'wb') as gif_file:
+            write_gif(gif_file, indexes, palette, duration, loop)
+    elif extension in [".png", ".apng"]:
+        images = [palette_image(index, palette) for index in indexes]
+        images[0].save(temp_path, format="PNG", save_all=True, append_images=images[1:], duration=duration, loop=loop, disposal=0, blend=0)
+    elif extension == ".webp":
+        images = [palette_image(index, palette).convert("RGB") for index in indexes]
+        images[0].save(temp_path, format="WEBP", save_all=True, append_images=images[1:], duration=duration, loop=loop, lossless=True, method=0)
+    else:
+        raise ValueError(f"Unknown animation format: {extension}")
+
+    os.replace(temp_path, path)
+    return os.path.getsize(path)
+def export_all(frames, folder, name="radar", formats=("gif", "png", "webp"), duration=750):
+    ''' Save frames in every format.
+        Param frames: A list of PIL images
+        Param folder: Folder to save to
+        Param name: File name (without extension)
+        Param formats: File extensions to save
+        Param duration: Milliseconds per frame
+
+        Returns a dictionary of path -> (bytes, seconds to encode)
+    '''
+    results = {}
+    for extension in formats:
+        path = os.path.join(folder, f"{name}.{extension}")
+        start = time.perf_counter()
+        size = export_animation(frames, path, duration=duration)
+        results[path] = (size, time.perf_counter() - start)
+    return results
+def shared_palette(frames, colours=255):
+    ''' Quantize all the frames together to one palette.
+        Param frames: A list of PIL images
+        Param colours: Number of colours (one is left free for transparency)
+
+        Returns palette indexes (frames, height, width) array, and the palette (RGB bytes, 256 colours)
+    '''
+    stacked = np.concatenate([np.asarray(frame.convert("RGB")) for frame in frames]) #All frames, one on top of the other
+    quantized = Image.fromarray(stacked).quantize(colors=colours, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+
+    palette = bytes(quantized.getpalette()[:768])
+    palette = palette + bytes(768 - len(palette))
+    indexes = np.asarray(quantized).reshape(len(frames), frames[0].height, frames[0].width)
+    return indexes, palette
+def palette_image(indexes, palette):
+    ''' Returns a P mode PIL image from palette indexes and a palette '''
+    image = Image.fromarray(np.ascontiguousarray(indexes))
+    image.putpalette(palette) #(Makes it a P image)
+    return image
+def changed_rectangle(previous, current):
+    ''' Find the rectangle of pixels that changed between two frames.
+        Param previous, current: 2D arrays
+
+        Returns (top, left, bottom, right), or None if nothing changed
+    '''
+    changed = previous != current
+    rows = np.flatnonzero(changed.any(axis=1))
+    if len(rows) == 0:
+        return None
+    columns = np.flatnonzero(changed.any(axis=0))
+    return rows[0], columns[0], rows[-1] + 1, columns[-1] + 1
+def write_gif(gif_file, indexes, palette, duration=750, loop=0):
+    ''' Write an animated GIF, saving only the changed rectangle of each frame.
+        Param gif_file: File (opened in binary mode)
+        Param indexes: Palette indexes (frames, height, width)
+        Param palette: RGB palette bytes (256 colours)
+        Param duration: Milliseconds per frame
+        Param loop: Number of loops (0 = forever)
+    '''
+    frame_count, height, width = indexes.shape
+
+    # Work out the rectangles first (frames that didn't change just make the one before last longer)
+    frames = [[(0, 0, height, width), indexes[0], duration]]
+    for i in range(1, frame_count):
+        rectangle = changed_rectangle(indexes[i - 1], indexes[i])
+        if rectangle is None:
+            frames[-1][2] += duration
+            continue
+
+        top, left, bottom, right = rectangle
+        patch = indexes[i, top:bottom, left:right].copy()
+        patch[patch == indexes[i - 1, top:bottom, left:right]] = TRANSPARENT #Unchanged pixels show the frame underneath
+        frames.append([rectangle, patch, duration])
+
+    ##########
+    # Header #
+    ##########
+    gif_file.write(b"GIF89a")
+    gif_file.write(struct.pack("<HHBBB", width, height, 0xF7, 0, 0)) #256 colour global palette
+    gif_file.write(palette)
+    gif_file.write(b"\x21\xFF\x0BNETSCAPE2.0\x03\x01" + struct.pack("<H", loop) + b"\x00") #Loop
+
+    ##########
+    # Frames #
+    ##########
+    for (top, left, bottom, right), patch, frame_duration in frames:
+        # Graphic control: duration, keep the frame underneath (disposal 1), transparent colour
+        gif_file.write(struct.pack("<BBBBHBB", 0x21, 0xF9, 4, (1 << 2) | 1, round(frame_duration / 10), TRANSPARENT, 0))
+        gif_file.write(struct.pack("<BHHHHB", 0x2C, left, top, right - left, bottom - top, 0))
+        gif_file.write(lzw_data(patch, palette))
+
+    gif_file.write(b"\x3B")
+def lzw_data(patch, palette):
+    ''' LZW compress a patch of palette indexes for a GIF.
+        (Pillow does the compressing: we save the patch as a GIF, and take the
+        compressed image data out of it)
+
+        Param patch: 2D array of palette indexes
+        Param palette: RGB palette bytes
+
+        Returns the LZW minimum code size and data sub-blocks.
+    '''
+    single = BytesIO()
+    palette_image(patch, palette).save(single, format="GIF", optimize=False, interlace=False)
+    data = single.getvalue()
+
+    position = 13 #After the header & logical screen descriptor
+    if data[10] & 0x80: #Global colour table
+        position += 3 * 2 ** ((data[10] & 0x07) + 1)
+
+    while data[position] == 0x21: #Skip extensions
+        position += 2
+        while data[position] != 0:
+            position += data[position] + 1
+        position += 1
+
+    if data[position] != 0x2C:
+        raise ValueError("Couldn't find the GIF image data")
+    flags = data[position + 9]
+    position += 10
+    if flags & 0x80: #Local colour table
+        position += 3 * 2 ** ((flags & 0x07) + 1)
+
+    # Minimum code size, then sub-blocks until the 0 length terminator
+    end = position + 1
+    while data[end] != 0:
+        end += data[end] + 1
+    return data[position:end + 1]
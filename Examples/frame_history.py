@@ -0,0 +1,148 @@
+"""
+--------------------------------------------------
+  Weather Radar! --  Frame history
+--------------------------------------------------
+
+Keeps frames on disk (composited frames, or raw radar images) so you can scrub
+back through the afternoon's storm, long after they've gone from the loop.
+
+* The frames go in one memory-mapped file, a fixed number of fixed-size slots.
+  The file is made at full size up front, so it never grows.
+* A sorted index of times says which slot each frame is in.
+* When it's full, the oldest frame's slot is reused.
+* window() gives the frames between two times as views of the file, so
+  nothing is copied (or even read) until it's used.
+
+    history = FrameHistory(folder, (240, 320, 4), max_bytes=200 * 1024 * 1024)
+    history.add_many(times, frames)
+    times, frames = history.window(start, end)
+
+"""
+
+import os
+import calendar
+import threading
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+DATA_FILE = "frames.dat"
+INDEX_FILE = "index.npz"
+
+################################################
+#  FUNCTIONS!
+################################################
+class FrameHistory:
+    ''' A rolling archive of same-size frames, in time order. '''
+
+    def __init__(self, folder, shape, max_bytes, dtype=np.uint8):
+        ''' Open the history in a folder (or start one).
+            Param folder: Folder for the files
+            Param shape: Shape of each frame, e.g. (height, width, 4)
+            Param max_bytes: Disk space to use (decides how many frames are kept)
+            Param dtype: Pixel type
+        '''
+        self.folder = folder
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.capacity = max_bytes // frame_bytes
+        if self.capacity < 1:
+            raise ValueError(f"{max_bytes} bytes isn't enough for a {self.shape} frame")
+        self.lock = threading.Lock()
+
+        os.makedirs(folder, exist_ok=True)
+        data_path = os.path.join(folder, DATA_FILE)
+        self.times, self.slots = self.load_index()
+        if self.times is None or not os.path.exists(data_path):
+            #Start again (it's new, or the frames have changed size)
+            self.times, self.slots = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+            self.data = np.memmap(data_path, dtype=self.dtype, mode="w+", shape=(self.capacity,) + self.shape)
+            self.save_index()
+        else:
+            self.data = np.memmap(data_path, dtype=self.dtype, mode="r+", shape=(self.capacity,) + self.shape)
+
+    def __len__(self):
+        return len(self.times)
+
+    def load_index(self):
+        ''' Returns the times & slots from the index file (or None, None if it's missing or doesn't match) '''
+        try:
+            with np.load(os.path.join(self.folder, INDEX_FILE)) as index:
+                if tuple(index['shape']) != self.shape or str(index['dtype']) != self.dtype.str or int(index['capacity']) != self.capacity:
+                    return None, None
+                return index['times'], index['slots']
+        except (OSError, KeyError, ValueError):
+            return None, None
+
+    def save_index(self):
+        ''' Write the index (after the frames, so it never points at a frame that isn't there) '''
+        self.data.flush()
+        temp_file = os.path.join(self.folder, f"{INDEX_FILE}.tmp")
+        with open(temp_file, 'wb') as index_file:
+            np.savez(index_file, times=self.times, slots=self.slots, shape=np.array(self.shape), dtype=np.array(self.dtype.str), capacity=np.array(self.capacity))
+        os.replace(temp_file, os.path.join(self.folder, INDEX_FILE))
+
+    def add(self, when, frame):
+        ''' Add a frame (one that's already there for that time is replaced).
+            Param when: Time of the frame (datetime, naive = UTC, or seconds)
+            Param frame: PIL image or array (the same shape as the others)
+        '''
+        self.add_many([when], [frame])
+
+    def add_many(self, times, frames):
+        ''' Add frames, then save the index once. '''
+        with self.lock:
+            for when, frame in zip(times, frames):
+                self.put(timestamp(when), frame)
+            self.save_index()
+
+    def put(self, when, frame):
+        pixels = np.asarray(frame, dtype=self.dtype)
+        if pixels.shape != self.shape:
+            raise ValueError(f"Frame is {pixels.shape}, not {self.shape}")
+
+        position = np.searchsorted(self.times, when)
+        if position < len(self.times) and self.times[position] == when: #Same time, replace it
+            self.data[self.slots[position]] = pixels
+            return
+
+        if len(self.times) < self.capacity:
+            slot = len(self.times)
+        elif position == 0: #Full, and older than everything we've got
+            return
+        else: #Full, so the oldest one goes
+            slot = self.slots[0]
+            self.times, self.slots = self.times[1:], self.slots[1:]
+            position -= 1
+
+        self.data[slot] = pixels
+        self.times = np.insert(self.times, position, when)
+        self.slots = np.insert(self.slots, position, slot)
+
+    def window(self, start=None, end=None):
+        ''' Get the frames between two times (including them).
+            Param start, end: datetimes (naive = UTC) or seconds (None = from the first / to the last)
+
+            Returns the times (seconds), and a list of frames (views of the file, nothing is
+            copied. A frame's view changes if its slot is reused, so copy any you want to keep)
+        '''
+        with self.lock:
+            first = 0 if start is None else np.searchsorted(self.times, timestamp(start), side="left")
+            last = len(self.times) if end is None else np.searchsorted(self.times, timestamp(end), side="right")
+            return self.times[first:last].copy(), [self.data[slot] for slot in self.slots[first:last]]
+
+    def close(self):
+        with self.lock:
+            self.data.flush()
+            del self.data
+
+def timestamp(when):
+    ''' Returns a time as whole seconds since 1970 (datetimes without a timezone are UTC) '''
+    if isinstance(when, datetime):
+        return calendar.timegm(when.utctimetuple())
+    return int(when)
+def to_images(frames):
+    ''' Returns PIL images of frames from window() '''
+    return [Image.fromarray(np.asarray(frame)) for frame in frames]
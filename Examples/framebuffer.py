@@ -0,0 +1,235 @@
+"""
+--------------------------------------------------
+  Weather Radar! --  Linux framebuffer display
+--------------------------------------------------
+
+For HDMI & DSI panels (or anything else with a /dev/fb*), instead of the
+ILI9341 on SPI. It has the same image() method, so push_frame() and show()
+work the same way:
+
+* /dev/fb0 is memory-mapped, and frames are written straight into it in the
+  panel's own pixel format (RGB565, XRGB8888, BGR...), converted with numpy
+* image() draws into a shadow copy of the screen (in RAM). flip() then copies
+  the parts that changed to the page that isn't being shown, and pans to it
+  (FBIOPAN_DISPLAY), so frames never tear. Panels without room for two pages
+  are drawn on directly.
+* scale makes small frames bigger (e.g. 2 = a 320x240 frame on 640x480 of the panel)
+
+A regular file works as the framebuffer too (give it the size & pixel format),
+for testing without a panel:
+
+    disp = Framebuffer("/tmp/fb.raw", size=(320, 240), bits_per_pixel=16)
+    shown = push_frame(disp, frame, shown)
+    disp.shown()   # What's on the "screen", as a PIL image
+
+"""
+
+import os
+import mmap
+import stat
+import fcntl
+import struct
+
+import numpy as np
+from PIL import Image
+
+FBIOGET_VSCREENINFO = 0x4600
+FBIOPUT_VSCREENINFO = 0x4601
+FBIOGET_FSCREENINFO = 0x4602
+FBIOPAN_DISPLAY = 0x4606
+FBIO_WAITFORVSYNC = 0x40044620
+
+VAR_INFO = struct.Struct("40I") #struct fb_var_screeninfo (as 32 bit numbers)
+FIX_INFO = struct.Struct("@16sL4I3HIL2I3H0L") #struct fb_fix_screeninfo
+XRES, YRES, XRES_VIRTUAL, YRES_VIRTUAL, XOFFSET, YOFFSET, BITS_PER_PIXEL = range(7)
+RED, GREEN, BLUE, TRANSP = 8, 11, 14, 17 #(offset, length, msb_right) of each channel
+FIX_SMEM_LEN, FIX_LINE_LENGTH = 2, 9
+
+#Channel (offset, length) of the pixel formats regular files use: red, green, blue, transparency
+FILE_FORMATS = {
+    16: ((11, 5), (5, 6), (0, 5), (0, 0)), #RGB565
+    32: ((16, 8), (8, 8), (0, 8), (0, 0)), #XRGB8888
+}
+
+################################################
+#  FUNCTIONS!
+################################################
+class Framebuffer:
+    ''' A Linux framebuffer, with the ILI9341's image() method. '''
+
+    def __init__(self, device="/dev/fb0", size=None, bits_per_pixel=None, rotation=0, scale=1, pages=2):
+        ''' Param device: Framebuffer device (or a regular file to pretend with)
+            Param size: (width, height) of the panel (only for regular files)
+            Param bits_per_pixel: 16 or 32 (only for regular files)
+            Param rotation: Rotation of the frames (0, 90, 180 or 270)
+            Param scale: Make the frames this many times bigger
+            Param pages: 2 for page flipping, 1 to draw on the screen directly
+        '''
+        self.rotation = rotation
+        self.scale = scale
+        self.is_device = os.path.exists(device) and stat.S_ISCHR(os.stat(device).st_mode)
+        self.file = os.open(device, os.O_RDWR if self.is_device else os.O_RDWR | os.O_CREAT)
+        self.original = None #(The device's settings, if we change them)
+
+        if self.is_device:
+            self.var = self.get_var()
+            if pages > 1 and self.var[YRES_VIRTUAL] < self.var[YRES] * 2:
+                self.ask_for_pages(pages)
+            smem_len, line_length = self.get_fix()
+            bits = self.var[BITS_PER_PIXEL]
+            channels = tuple((self.var[field], self.var[field + 1]) for field in (RED, GREEN, BLUE, TRANSP))
+        else:
+            if size is None or bits_per_pixel not in FILE_FORMATS:
+                raise ValueError("A regular file needs a size, and 16 or 32 bits per pixel")
+            width, height = size
+            self.var = [0] * (VAR_INFO.size // 4)
+            self.var[XRES:BITS_PER_PIXEL + 1] = [width, height, width, height * pages, 0, 0, bits_per_pixel]
+            bits = bits_per_pixel
+            channels = FILE_FORMATS[bits]
+            line_length = width * bits // 8
+            smem_len = line_length * height * pages
+            if os.fstat(self.file).st_size < smem_len:
+                os.ftruncate(self.file, smem_len)
+
+        if bits not in (16, 32):
+            raise ValueError(f"{bits} bits per pixel isn't supported (only 16 & 32)")
+        self.bits_per_pixel = bits
+        self.dtype = np.uint16 if bits == 16 else np.uint32
+        self.channels = channels
+        self.panel_width, self.panel_height = self.var[XRES], self.var[YRES]
+        self.pages = max(1, min(pages, self.var[YRES_VIRTUAL] // self.panel_height, smem_len // (line_length * self.panel_height)))
+
+        #The whole framebuffer, as rows of pixels
+        self.memory = mmap.mmap(self.file, line_length * self.panel_height * self.pages, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self.pixels = np.ndarray((self.panel_height * self.pages, line_length // (bits // 8)), dtype=self.dtype, buffer=self.memory)
+        self.page = self.var[YOFFSET] // self.panel_height if self.pages > 1 else 0 #Page being shown
+
+        self.shadow = self.page_pixels(self.page).copy()
+        self.dirty = [[] for page in range(self.pages)] #Windows (top, left, bottom, right) each page is missing
+
+        #Size of the display, in frame pixels (like the ILI9341's width & height)
+        self.width, self.height = self.panel_width // scale, self.panel_height // scale
+
+    def get_var(self):
+        info = bytearray(VAR_INFO.size)
+        fcntl.ioctl(self.file, FBIOGET_VSCREENINFO, info)
+        return list(VAR_INFO.unpack(info))
+
+    def get_fix(self):
+        ''' Returns the framebuffer's memory size, and bytes per row '''
+        info = bytearray(FIX_INFO.size)
+        fcntl.ioctl(self.file, FBIOGET_FSCREENINFO, info)
+        fix = FIX_INFO.unpack(info)
+        return fix[FIX_SMEM_LEN], fix[FIX_LINE_LENGTH]
+
+    def ask_for_pages(self, pages):
+        ''' Ask the driver for a virtual screen that's tall enough for the pages (it can say no) '''
+        wanted = list(self.var)
+        wanted[YRES_VIRTUAL] = self.var[YRES] * pages
+        try:
+            fcntl.ioctl(self.file, FBIOPUT_VSCREENINFO, bytearray(VAR_INFO.pack(*wanted)))
+        except OSError:
+            return
+        self.original = self.var
+        self.var = self.get_var()
+
+    def page_pixels(self, page):
+        ''' Returns one page of the framebuffer (a view, writing to it writes to the screen) '''
+        return self.pixels[page * self.panel_height:(page + 1) * self.panel_height, :self.panel_width]
+
+    def image(self, img, rotation=None, x=0, y=0):
+        ''' Same as the ILI9341's image() method (shown at the next flip() if there are two pages).
+            Param img: PIL image
+            Param rotation: (None = the display's rotation)
+            Param x, y: Where it goes on the display
+        '''
+        if rotation is None:
+            rotation = self.rotation
+        if rotation != 0:
+            img = img.rotate(rotation, expand=True)
+        if x + img.width > self.width or y + img.height > self.height:
+            raise ValueError(f"Image must not exceed dimensions of display ({self.width}x{self.height}).")
+
+        native = pack_pixels(img, self.dtype, self.channels)
+        if self.scale > 1:
+            native = native.repeat(self.scale, axis=0).repeat(self.scale, axis=1)
+        top, left = y * self.scale, x * self.scale
+        window = (top, left, top + native.shape[0], left + native.shape[1])
+        self.shadow[window[0]:window[2], window[1]:window[3]] = native
+
+        if self.pages == 1:
+            self.page_pixels(0)[window[0]:window[2], window[1]:window[3]] = native
+        else:
+            for dirty in self.dirty:
+                dirty.append(window)
+
+    def flip(self):
+        ''' Show what's been drawn since the last flip (copy what changed to the hidden page, then show it) '''
+        if self.pages == 1 or not self.dirty[self.page ^ 1]:
+            return
+
+        back = self.page ^ 1
+        page = self.page_pixels(back)
+        for top, left, bottom, right in self.dirty[back]:
+            page[top:bottom, left:right] = self.shadow[top:bottom, left:right]
+        self.dirty[back] = []
+        self.pan(back)
+
+    def pan(self, page):
+        ''' Show one of the pages '''
+        self.page = page
+        if not self.is_device:
+            return
+        self.var[XOFFSET], self.var[YOFFSET] = 0, page * self.panel_height
+        try:
+            fcntl.ioctl(self.file, FBIO_WAITFORVSYNC, bytearray(4)) #(Not every driver can)
+        except OSError:
+            pass
+        fcntl.ioctl(self.file, FBIOPAN_DISPLAY, bytearray(VAR_INFO.pack(*self.var)))
+
+    def shown(self):
+        ''' Returns what's on the screen (the page being shown), as a PIL image the right way up. '''
+        image = unpack_pixels(self.page_pixels(self.page), self.channels)
+        if self.scale > 1:
+            image = image.resize((self.width, self.height), Image.NEAREST)
+        if self.rotation == 0:
+            return image
+        return image.rotate(-self.rotation, expand=True)
+
+    def close(self):
+        ''' Unmap the framebuffer (and put the driver's settings back, if they were changed) '''
+        if self.pages > 1 and self.page != 0:
+            page = self.page_pixels(0)
+            page[:] = self.page_pixels(self.page)
+            self.pan(0)
+        del self.pixels
+        self.memory.close()
+        if self.original is not None:
+            try:
+                fcntl.ioctl(self.file, FBIOPUT_VSCREENINFO, bytearray(VAR_INFO.pack(*self.original)))
+            except OSError:
+                pass
+        os.close(self.file)
+
+def pack_pixels(image, dtype, channels):
+    ''' Convert a PIL image to a framebuffer's pixel format.
+        Param image: PIL image
+        Param dtype: np.uint16 or np.uint32
+        Param channels: (offset, length) of red, green, blue & transparency in each pixel
+
+        Returns a (height, width) array
+    '''
+    pixels = np.asarray(image.convert("RGB"))
+    native = np.zeros(pixels.shape[:2], dtype=dtype)
+    for index, (offset, length) in enumerate(channels[:3]):
+        native |= (pixels[:, :, index] >> (8 - length)).astype(dtype) << offset
+    offset, length = channels[3]
+    if length: #Opaque
+        native |= dtype(((1 << length) - 1) << offset)
+    return native
+def unpack_pixels(native, channels):
+    ''' Returns framebuffer pixels (from pack_pixels()) as an RGB PIL image '''
+    rgb = np.empty(native.shape + (3,), dtype=np.uint8)
+    for index, (offset, length) in enumerate(channels[:3]):
+        rgb[:, :, index] = ((native >> offset) & ((1 << length) - 1)) << (8 - length)
+    return Image.fromarray(rgb)
@@ -0,0 +1,178 @@
+"""
+--------------------------------------------------
+  Weather Radar! --  Streaming GeoJSON
+--------------------------------------------------
+
+Reads a WFS GeoJSON response one feature at a time as it downloads, instead of
+loading the whole thing with .json(). The polygons go into flat numpy arrays:
+
+    coordinates      (points, 2) lon/lat
+    ring_offsets     ring i is coordinates[ring_offsets[i]:ring_offsets[i+1]]
+    polygon_offsets  polygon i is rings polygon_offsets[i] to polygon_offsets[i+1] (the first one is the outside, the rest are holes)
+    feature_offsets  feature i is polygons feature_offsets[i] to feature_offsets[i+1]
+
+Every polygon and ring of a MultiPolygon is kept. Memory & time go up linearly
+with the number of alerts, even during a big outbreak.
+
+    shapes, properties = read_features(response)
+    for i, props in enumerate(properties):
+        shape = shapes.feature(i)
+
+"""
+
+import json
+import codecs
+
+import numpy as np
+
+CHUNK_SIZE = 64 * 1024 #Bytes to read at a time
+
+################################################
+#  FUNCTIONS!
+################################################
+class Shapes:
+    ''' Polygons for a set of features, in flat arrays (see above). '''
+
+    def __init__(self, coordinates, ring_offsets, polygon_offsets, feature_offsets):
+        self.coordinates = coordinates
+        self.ring_offsets = ring_offsets
+        self.polygon_offsets = polygon_offsets
+        self.feature_offsets = feature_offsets
+
+    def __len__(self):
+        return len(self.feature_offsets) - 1
+
+    def feature(self, index):
+        ''' Returns the Shapes of one feature (the coordinates aren't copied) '''
+        first_polygon, last_polygon = self.feature_offsets[index], self.feature_offsets[index + 1]
+        first_ring, last_ring = self.polygon_offsets[first_polygon], self.polygon_offsets[last_polygon]
+        first_point, last_point = self.ring_offsets[first_ring], self.ring_offsets[last_ring]
+        return Shapes(
+            self.coordinates[first_point:last_point],
+            self.ring_offsets[first_ring:last_ring + 1] - first_point,
+            self.polygon_offsets[first_polygon:last_polygon + 1] - first_ring,
+            np.array([0, last_polygon - first_polygon])
+            )
+
+    def polygons(self):
+        ''' Yields each polygon as a list of (points, 2) rings (outside first, then holes) '''
+        for polygon in range(len(self.polygon_offsets) - 1):
+            rings = range(self.polygon_offsets[polygon], self.polygon_offsets[polygon + 1])
+            yield [self.coordinates[self.ring_offsets[ring]:self.ring_offsets[ring + 1]] for ring in rings]
+
+class ShapesBuilder:
+    ''' Collects polygons one feature at a time, then makes Shapes. '''
+
+    def __init__(self):
+        self.rings = []           #(points, 2) arrays
+        self.ring_lengths = []
+        self.polygon_lengths = [] #Rings in each polygon
+        self.feature_lengths = [] #Polygons in each feature
+
+    def add(self, geometry):
+        ''' Add a feature's (Multi)Polygon geometry (anything else is added with no polygons) '''
+        if geometry is None or geometry.get('type') not in ["Polygon", "MultiPolygon"]:
+            self.feature_lengths.append(0)
+            return
+
+        polygons = geometry['coordinates']
+        if geometry['type'] == "Polygon":
+            polygons = [polygons]
+
+        for polygon in polygons:
+            for ring in polygon:
+                points = np.asarray(ring, dtype=np.float64).reshape(-1, len(ring[0]) if ring else 2)[:, :2]
+                self.rings.append(points)
+                self.ring_lengths.append(len(points))
+            self.polygon_lengths.append(len(polygon))
+        self.feature_lengths.append(len(polygons))
+
+    def build(self):
+        ''' Returns the Shapes '''
+        coordinates = np.concatenate(self.rings) if self.rings else np.empty((0, 2))
+        return Shapes(coordinates, offsets(self.ring_lengths), offsets(self.polygon_lengths), offsets(self.feature_lengths))
+
+def offsets(lengths):
+    ''' Returns the start of each item (and the end of the last one) from their lengths '''
+    return np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+def iter_features(chunks):
+    ''' Yield the features of a GeoJSON FeatureCollection one at a time, as it arrives.
+        Param chunks: Bytes (e.g. response.iter_content())
+    '''
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ""
+    position = 0
+    finished = False
+
+    def read_more():
+        nonlocal buffer, position, finished
+        chunk = next(chunks, None)
+        if chunk is None:
+            finished = True
+            buffer = buffer[position:] + text.decode(b"", final=True)
+        else:
+            buffer = buffer[position:] + text.decode(chunk)
+        position = 0
+
+    def skip(characters):
+        # Move past whitespace & the given characters. Returns the next character (or None at the end)
+        nonlocal position
+        while True:
+            while position < len(buffer) and (buffer[position].isspace() or buffer[position] in characters):
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if finished:
+                return None
+            read_more()
+
+    #Find the start of the features array
+    while True:
+        start = buffer.find('"features"', position)
+        if start >= 0:
+            position = start + len('"features"')
+            break
+        if finished:
+            return
+        position = max(0, len(buffer) - len('"features"')) #(The key might be split between chunks)
+        read_more()
+
+    if skip(":") != "[":
+        return
+    position += 1
+
+    #Then each feature
+    while True:
+        if skip(",") in ["]", None]:
+            return
+
+        needed = max(1, len(buffer) - position)
+        while True:
+            try:
+                feature, end = decoder.raw_decode(buffer, position)
+                break
+            except json.JSONDecodeError:
+                if finished:
+                    raise
+                #Read until there's twice as much (so a big feature isn't parsed over & over)
+                needed *= 2
+                while not finished and len(buffer) - position < needed:
+                    read_more()
+
+        position = end
+        yield feature
+def read_features(response, chunk_size=CHUNK_SIZE):
+    ''' Read a GeoJSON response, a feature at a time.
+        Param response: requests response (ideally fetched with stream=True)
+        Param chunk_size: Bytes to read at a time
+
+        Returns the Shapes, and a list of each feature's properties
+    '''
+    builder = ShapesBuilder()
+    properties = []
+    for feature in iter_features(response.iter_content(chunk_size=chunk_size)):
+        builder.add(feature.get('geometry'))
+        properties.append(feature.get('properties') or {})
+    return builder.build(), properties
@@ -0,0 +1,301 @@
+"""
+--------------------------------------------------
+  Weather Radar! --  Offline basemaps (MBTiles)
+--------------------------------------------------
+
+The basemap tiles hardly ever change, so instead of downloading them from a
+tile server (slow on a cold start, and the Stamen tiles aren't always there)
+they can come from an MBTiles file: tiles in an SQLite database.
+
+* One connection per file, kept open for the whole process
+* The tiles for a map are read with one query (in batches), not one at a time
+* The PNGs are decoded at the same time (in threads), then pasted together
+
+Set 'basemap' (and 'basemap_labels') in secrets.py to the .mbtiles file. To
+make one, seed it from a tile server (or GeoTiler provider) once:
+
+    python3 mbtiles.py seed basemap.mbtiles stamen-toner --bbox -125 45 -121 49 --zoom 5 10
+    python3 mbtiles.py info basemap.mbtiles
+
+Seeding skips tiles that are already there, so it can be stopped and started again.
+
+"""
+
+import os
+import math
+import sqlite3
+import asyncio
+import argparse
+import threading
+from io import BytesIO
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+
+import geotiler
+from PIL import Image
+
+URL_SCHEME = "mbtiles:" #Tile "urls" are mbtiles:/path/to/file.mbtiles?z/x/y
+BATCH = 300 #Tiles per query (3 parameters each, under SQLite's limit)
+MMAP_BYTES = 256 * 1024 * 1024 #Read the file through a memory map (up to this much)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT);
+CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name);
+CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);
+CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);
+"""
+
+open_files = {} #path -> MBTiles (opened once, see open_mbtiles())
+open_lock = threading.Lock()
+
+################################################
+#  FUNCTIONS!
+################################################
+class MBTiles:
+    ''' An MBTiles file. Tiles are (zoom, x, y) with y from the top, like GeoTiler
+        (MBTiles counts rows from the bottom, that's taken care of here).
+    '''
+
+    def __init__(self, path, writable=False):
+        ''' Param path: The .mbtiles file
+            Param writable: Open it for seeding (it's made if it isn't there)
+        '''
+        self.path = path
+        self.lock = threading.Lock() #(One connection, shared by the threads)
+        if writable:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.executescript(SCHEMA)
+        else:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"No MBTiles file at {path}")
+            self.connection = sqlite3.connect(f"file:{quote(os.path.abspath(path))}?mode=ro", uri=True, check_same_thread=False)
+        self.connection.execute(f"PRAGMA mmap_size={MMAP_BYTES}")
+
+    def lookup(self, coords, data=True):
+        ''' Find tiles, a batch per query (each tile is looked up in the index).
+            Param coords: List of (zoom, x, y)
+            Param data: Get the tile data too
+
+            Yields (zoom, x, y, tile data or None) for the ones that are there
+        '''
+        columns = "tile_data" if data else "NULL"
+        for start in range(0, len(coords), BATCH):
+            batch = coords[start:start + BATCH]
+            values = ",".join(["(?,?,?)"] * len(batch))
+            parameters = [value for zoom, x, y in batch for value in (zoom, x, flip_y(zoom, y))]
+            with self.lock:
+                rows = self.connection.execute(
+                    f"SELECT zoom_level, tile_column, tile_row, {columns} FROM (VALUES {values}) AS wanted "
+                    "JOIN tiles ON tiles.zoom_level = wanted.column1 AND tiles.tile_column = wanted.column2 AND tiles.tile_row = wanted.column3",
+                    parameters).fetchall()
+            for zoom, x, row, tile_data in rows:
+                yield zoom, x, flip_y(zoom, row), tile_data
+
+    def read(self, coords):
+        ''' Get tiles.
+            Param coords: List of (zoom, x, y)
+
+            Returns {(zoom, x, y): tile data} for the ones that are there
+        '''
+        return {(zoom, x, y): tile_data for zoom, x, y, tile_data in self.lookup(coords)}
+
+    def missing(self, coords):
+        ''' Returns the coords (zoom, x, y) that aren't in the file '''
+        present = {(zoom, x, y) for zoom, x, y, tile_data in self.lookup(coords, data=False)}
+        return [coord for coord in coords if coord not in present]
+
+    def write(self, tiles):
+        ''' Add (or replace) tiles, all in one transaction.
+            Param tiles: List of ((zoom, x, y), tile data)
+        '''
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?,?,?,?)",
+                [(zoom, x, flip_y(zoom, y), sqlite3.Binary(data)) for (zoom, x, y), data in tiles])
+
+    def metadata(self):
+        ''' Returns the metadata table as a dict (name, format, bounds, minzoom...) '''
+        with self.lock:
+            return dict(self.connection.execute("SELECT name, value FROM metadata").fetchall())
+
+    def set_metadata(self, **values):
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO metadata (name, value) VALUES (?,?)", [(name, str(value)) for name, value in values.items()])
+
+    def count(self):
+        ''' Returns {zoom: number of tiles} '''
+        with self.lock:
+            return dict(self.connection.execute("SELECT zoom_level, COUNT(*) FROM tiles GROUP BY zoom_level ORDER BY zoom_level").fetchall())
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def flip_y(zoom, y):
+    ''' Convert between XYZ rows (from the top) and TMS rows (from the bottom). It works both ways. '''
+    return (1 << zoom) - 1 - y
+def open_mbtiles(path):
+    ''' Returns the (read only) MBTiles for a file. It's only opened once, and kept open. '''
+    with open_lock:
+        if path not in open_files:
+            open_files[path] = MBTiles(path)
+        return open_files[path]
+def provider(path):
+    ''' Returns a GeoTiler map provider for an MBTiles file '''
+    metadata = open_mbtiles(path).metadata()
+    return geotiler.provider.MapProvider({
+        'name': metadata.get('name') or os.path.basename(path),
+        'attribution': metadata.get('attribution'),
+        'url': f"{URL_SCHEME}{path}?{{z}}/{{x}}/{{y}}",
+        'extension': metadata.get('format', 'png')
+        })
+def is_mbtiles(map_provider):
+    ''' Returns True if a GeoTiler provider is from provider() '''
+    return str(map_provider.url or "").startswith(URL_SCHEME)
+def parse_url(url):
+    ''' Returns the path & (zoom, x, y) from a tile url made by provider() '''
+    path, _, coord = url[len(URL_SCHEME):].rpartition("?")
+    zoom, x, y = (int(value) for value in coord.split("/"))
+    return path, (zoom, x, y)
+async def fetch_tiles(tiles, num_workers):
+    ''' GeoTiler tile downloader that reads from MBTiles files (every tile in one go).
+        Param tiles: GeoTiler tiles (with urls from provider())
+        Param num_workers: (Not used, it's one query)
+
+        Yields the tiles (with img set, or error set if they're not in the file)
+    '''
+    loop = asyncio.get_running_loop()
+    files = {}
+    for tile in tiles:
+        path, coord = parse_url(tile.url)
+        files.setdefault(path, []).append((tile, coord))
+
+    for path, file_tiles in files.items():
+        try:
+            found = await loop.run_in_executor(None, lambda: open_mbtiles(path).read([coord for tile, coord in file_tiles]))
+        except (OSError, sqlite3.Error) as error:
+            for tile, coord in file_tiles:
+                yield tile._replace(img=None, error=error)
+            continue
+
+        for tile, coord in file_tiles:
+            data = found.get(coord)
+            if data:
+                yield tile._replace(img=data, error=None)
+            else:
+                yield tile._replace(img=None, error=ValueError(f"Tile {coord} isn't in {path}"))
+def decode(data):
+    ''' Returns a tile as an RGBA image (like GeoTiler does it) '''
+    return Image.open(BytesIO(data)).convert('RGBA')
+async def render_map(map, executor=None):
+    ''' Render a map from MBTiles, like geotiler.render_map_async() (but the tiles are decoded at the same time).
+        Param map: GeoTiler map (with a provider from provider())
+        Param executor: Threads to decode in (None = the event loop's default)
+
+        Returns the PIL image, and a list of the tiles that weren't there (their urls).
+        Missing tiles are left transparent.
+    '''
+    loop = asyncio.get_running_loop()
+    image = Image.new('RGBA', tuple(map.size))
+    decoding = []
+    missing = []
+    async for tile in geotiler.fetch_tiles(map, fetch_tiles):
+        if tile.img:
+            decoding.append((tile.offset, loop.run_in_executor(executor, decode, tile.img)))
+        else:
+            missing.append(tile.url)
+
+    for offset, task in decoding:
+        image.paste(await task, offset)
+    return image, missing
+
+################################################
+#  Seeding
+################################################
+def tile_xy(lon, lat, zoom):
+    ''' Returns the (x, y) of the tile a point is in '''
+    tiles = 1 << zoom
+    lat = max(min(lat, 85.0511), -85.0511) #(Web Mercator stops here)
+    x = int((lon + 180) / 360 * tiles)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * tiles)
+    return min(max(x, 0), tiles - 1), min(max(y, 0), tiles - 1)
+def tiles_in(bbox, zoom):
+    ''' Returns every (zoom, x, y) in a bounding box (min lon, min lat, max lon, max lat) '''
+    min_lon, min_lat, max_lon, max_lat = bbox
+    left, top = tile_xy(min_lon, max_lat, zoom)
+    right, bottom = tile_xy(max_lon, min_lat, zoom)
+    return [(zoom, x, y) for x in range(left, right + 1) for y in range(top, bottom + 1)]
+def source_provider(source):
+    ''' Returns a GeoTiler provider for a tile url (with {z}, {x} & {y}) or a GeoTiler provider name '''
+    if '{z}' in source:
+        return geotiler.provider.MapProvider({'name': source, 'url': source})
+    return geotiler.find_provider(source)
+def seed(path, source, bbox, zooms, workers=8, headers=None):
+    ''' Download tiles into an MBTiles file.
+        Param path: The .mbtiles file (made if it isn't there)
+        Param source: Tile url (with {z}, {x} & {y}) or GeoTiler provider name
+        Param bbox: (min lon, min lat, max lon, max lat)
+        Param zooms: Zoom levels
+        Param workers: Tiles to download at once
+        Param headers: Request headers
+
+        Returns the number of tiles added, and the number that couldn't be downloaded
+    '''
+    from net import fetch
+
+    tile_source = source_provider(source)
+    mbtiles = MBTiles(path, writable=True)
+    mbtiles.set_metadata(
+        name=os.path.splitext(os.path.basename(path))[0],
+        format=tile_source.extension,
+        type="baselayer",
+        bounds=",".join(str(value) for value in bbox),
+        minzoom=min(zooms),
+        maxzoom=max(zooms),
+        attribution=tile_source.attribution or ""
+        )
+
+    def download(coord):
+        zoom, x, y = coord
+        response = fetch(tile_source.tile_url((x, y), zoom), headers=headers, name="tile")
+        return coord, response.content if response else None
+
+    added, failed = 0, 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for zoom in zooms:
+            todo = mbtiles.missing(tiles_in(bbox, zoom))
+            print(f"Zoom {zoom}: {len(todo)} tiles to get")
+            for start in range(0, len(todo), BATCH):
+                results = list(pool.map(download, todo[start:start + BATCH]))
+                tiles = [(coord, data) for coord, data in results if data]
+                mbtiles.write(tiles)
+                added += len(tiles)
+                failed += len(results) - len(tiles)
+                print(f"\t{min(start + BATCH, len(todo))}/{len(todo)}")
+
+    mbtiles.close()
+    return added, failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Make (or look at) an MBTiles basemap.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    seeding = commands.add_parser("seed", help="Download tiles into an MBTiles file")
+    seeding.add_argument("mbtiles", help="MBTiles file to add to")
+    seeding.add_argument("source", help="Tile url (with {z}, {x} & {y}) or GeoTiler provider name")
+    seeding.add_argument("--bbox", type=float, nargs=4, required=True, metavar=("MIN_LON", "MIN_LAT", "MAX_LON", "MAX_LAT"))
+    seeding.add_argument("--zoom", type=int, nargs=2, required=True, metavar=("MIN", "MAX"))
+    seeding.add_argument("--workers", type=int, default=8)
+    info = commands.add_parser("info", help="Show the metadata & number of tiles")
+    info.add_argument("mbtiles")
+    args = parser.parse_args()
+
+    if args.command == "seed":
+        from secrets import secrets
+        added, failed = seed(args.mbtiles, args.source, args.bbox, range(args.zoom[0], args.zoom[1] + 1), args.workers, secrets.get('header'))
+        print(f"\nAdded {added} tiles to {args.mbtiles} ({failed} couldn't be downloaded)")
+    else:
+        mbtiles = MBTiles(args.mbtiles)
+        for name, value in mbtiles.metadata().items():
+            print(f"{name}: {value}")
+        for zoom, count in mbtiles.count().items():
+            print(f"Zoom {zoom}: {count} tiles")
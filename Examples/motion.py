@@ -0,0 +1,195 @@
+"""
+--------------------------------------------------
+  Weather Radar! --  Storm motion
+--------------------------------------------------
+
+Works out which way the echoes are moving from the radar frames we already
+have. Each pair of frames is compared with FFT phase correlation (for the whole
+map, or for blocks of it), then:
+
+* extrapolate(): moves a radar image forward in time
+* arrival_eta(): how long until precipitation reaches a point (e.g. the marker)
+
+All the frames are done at once with numpy (at half resolution), so 10 frames
+take a small fraction of a second, even on a Pi.
+
+    motion = estimate_motion(radars, times, block_size=80)
+    minutes = arrival_eta(radars[-1], motion, (160, 120))
+
+"""
+
+import numpy as np
+from PIL import Image
+
+SCALE = 2          #Work at half resolution (motion is still found to a fraction of a pixel)
+MIN_PEAK = 0.1     #Weaker correlation peaks than this are just noise
+MIN_ECHO = 0.02    #Fraction of a block that has to have echoes to trust its motion
+MAX_MINUTES = 120  #Don't extrapolate further ahead than this
+
+################################################
+#  FUNCTIONS!
+################################################
+class Motion:
+    ''' Storm motion, in (full resolution) pixels per minute. '''
+
+    def __init__(self, velocity, field=None, block_size=None):
+        self.velocity = velocity     #(x, y) for the whole map
+        self.field = field           #(blocks down, blocks across, 2) for each block (or None)
+        self.block_size = block_size #Pixels per block
+
+    def at(self, x, y):
+        ''' Returns the (x, y) velocity at pixel positions (numpy arrays) '''
+        if self.field is None:
+            return np.full(np.shape(x), self.velocity[0]), np.full(np.shape(y), self.velocity[1])
+        row = np.clip(np.asarray(y) // self.block_size, 0, self.field.shape[0] - 1).astype(int)
+        col = np.clip(np.asarray(x) // self.block_size, 0, self.field.shape[1] - 1).astype(int)
+        return self.field[row, col, 0], self.field[row, col, 1]
+
+def echo_field(radar):
+    ''' Returns where the echoes are in a radar image, as a half resolution float array (0-1) '''
+    alpha = np.asarray(radar.convert("RGBA").getchannel("A"), dtype=np.float32) / 255
+    height, width = alpha.shape[0] // SCALE, alpha.shape[1] // SCALE
+    return alpha[:height * SCALE, :width * SCALE].reshape(height, SCALE, width, SCALE).mean(axis=(1, 3))
+def phase_correlation(previous, current):
+    ''' Find how far images moved, with FFT phase correlation.
+        Param previous, current: Stacks of images (..., height, width)
+
+        Returns the (..., 2) shifts (x, y), and the height of each correlation peak (0-1)
+    '''
+    height, width = previous.shape[-2:]
+    window = np.outer(np.hanning(height), np.hanning(width)) #Stops the edges looking like a match
+
+    cross = np.fft.rfft2(current * window) * np.conj(np.fft.rfft2(previous * window))
+    cross /= np.abs(cross) + 1e-9
+    correlation = np.fft.irfft2(cross, s=(height, width)).reshape(-1, height, width)
+
+    #Peak of each correlation, and a parabola through its neighbours (for the fraction of a pixel)
+    peak = correlation.reshape(len(correlation), -1).argmax(axis=1)
+    row, col = np.unravel_index(peak, (height, width))
+    image = np.arange(len(correlation))
+    centre = correlation[image, row, col]
+
+    def offset(before, after):
+        curve = before - 2 * centre + after
+        return np.clip(np.where(curve < 0, (before - after) / np.where(curve < 0, 2 * curve, 1), 0), -0.5, 0.5)
+
+    dy = row + offset(correlation[image, (row - 1) % height, col], correlation[image, (row + 1) % height, col])
+    dx = col + offset(correlation[image, row, (col - 1) % width], correlation[image, row, (col + 1) % width])
+
+    #Shifts past half way are really the other way (the correlation wraps around)
+    dy = np.where(dy > height / 2, dy - height, dy)
+    dx = np.where(dx > width / 2, dx - width, dx)
+
+    shape = previous.shape[:-2]
+    return np.stack([dx, dy], axis=-1).reshape(*shape, 2), centre.reshape(shape)
+def estimate_motion(radars, times, block_size=None):
+    ''' Work out storm motion from a loop of radar images.
+        Param radars: Radar images (PIL, oldest first)
+        Param times: Time of each image (datetimes)
+        Param block_size: Pixels per block for motion in each block (None = one motion for the whole map)
+
+        Returns a Motion (or None if there aren't enough echoes to tell)
+    '''
+    if len(radars) < 2:
+        return None
+
+    fields = np.stack([echo_field(radar) for radar in radars])
+    minutes = np.array([(later - earlier).total_seconds() / 60 for earlier, later in zip(times, times[1:])])
+    if (minutes <= 0).any():
+        raise ValueError("Radar times have to be in order")
+
+    ##########################
+    # Whole map              #
+    ##########################
+    shifts, peaks = phase_correlation(fields[:-1], fields[1:])
+    velocity = combine(shifts * SCALE / minutes[:, None], peaks, fields[:-1].mean(axis=(1, 2)))
+    if velocity is None:
+        return None
+    if block_size is None:
+        return Motion(velocity)
+
+    ##########################
+    # Blocks                 #
+    ##########################
+    size = block_size // SCALE
+    down, across = fields.shape[1] // size, fields.shape[2] // size
+    blocks = fields[:, :down * size, :across * size].reshape(len(fields), down, size, across, size).swapaxes(2, 3)
+
+    shifts, peaks = phase_correlation(blocks[:-1], blocks[1:]) #(pairs, down, across, 2)
+    echoes = np.minimum(blocks[:-1].mean(axis=(3, 4)), blocks[1:].mean(axis=(3, 4)))
+    field = np.empty((down, across, 2))
+    for row in range(down):
+        for col in range(across):
+            block_velocity = combine(shifts[:, row, col] * SCALE / minutes[:, None], peaks[:, row, col], echoes[:, row, col])
+            field[row, col] = velocity if block_velocity is None else block_velocity #(Blocks without echoes move with the rest)
+
+    return Motion(velocity, field, block_size)
+def combine(velocities, peaks, echoes):
+    ''' Average the velocities from each pair of frames (weighted by how good the match was).
+        Param velocities: (pairs, 2) velocities
+        Param peaks: Correlation peak of each pair
+        Param echoes: Fraction of each pair with echoes
+
+        Returns the (x, y) velocity, or None if none of the pairs are any good
+    '''
+    good = (peaks >= MIN_PEAK) & (echoes >= MIN_ECHO)
+    if not good.any():
+        return None
+    weights = peaks[good] * echoes[good]
+    return tuple(float(value) for value in np.average(velocities[good], axis=0, weights=weights))
+def extrapolate(radar, motion, minutes):
+    ''' Move a radar image forward in time.
+        Param radar: Radar image (PIL)
+        Param motion: Motion from estimate_motion()
+        Param minutes: How far ahead
+
+        Returns a RGBA PIL image
+    '''
+    pixels = np.asarray(radar.convert("RGBA"))
+    height, width = pixels.shape[:2]
+    minutes = min(minutes, MAX_MINUTES)
+
+    #Where each pixel comes from (backwards along the motion)
+    y, x = np.mgrid[0:height, 0:width]
+    velocity_x, velocity_y = motion.at(x, y)
+    source_x = np.rint(x - velocity_x * minutes).astype(int)
+    source_y = np.rint(y - velocity_y * minutes).astype(int)
+    inside = (source_x >= 0) & (source_x < width) & (source_y >= 0) & (source_y < height)
+
+    moved = np.empty_like(pixels)
+    moved[...] = (255, 255, 255, 0) #Same as the WMS background
+    moved[inside] = pixels[source_y[inside], source_x[inside]]
+    return Image.fromarray(moved)
+def arrival_eta(radar, motion, point, radius=10):
+    ''' Work out when precipitation will reach a point, if the echoes keep moving the same way.
+        Param radar: Latest radar image (PIL)
+        Param motion: Motion from estimate_motion()
+        Param point: (x, y) pixel position
+        Param radius: How close (pixels) counts as reaching it
+
+        Returns minutes after the radar image (0 if it's already there), or None if nothing's heading that way
+    '''
+    alpha = np.asarray(radar.convert("RGBA").getchannel("A"))
+    y, x = np.nonzero(alpha)
+    if len(x) == 0:
+        return None
+
+    #Distance from each echo to the point, and the echo's velocity
+    distance_x, distance_y = point[0] - x, point[1] - y
+    if (distance_x ** 2 + distance_y ** 2 <= radius ** 2).any():
+        return 0.0
+    velocity_x, velocity_y = motion.at(x, y)
+    speed = velocity_x ** 2 + velocity_y ** 2
+    moving = speed > 0
+    speed = np.where(moving, speed, 1)
+
+    #Closest approach (time & distance), then when it first gets within the radius
+    closest = (distance_x * velocity_x + distance_y * velocity_y) / speed
+    miss = (distance_x - velocity_x * closest) ** 2 + (distance_y - velocity_y * closest) ** 2
+    hits = moving & (closest > 0) & (miss <= radius ** 2)
+    if not hits.any():
+        return None
+
+    arrival = closest[hits] - np.sqrt((radius ** 2 - miss[hits]) / speed[hits])
+    eta = float(arrival.min())
+    return eta if eta <= MAX_MINUTES else None
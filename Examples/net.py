@@ -0,0 +1,158 @@
+"""
+--------------------------------------------------
+  Weather Radar! --  Network requests
+--------------------------------------------------
+
+Every request goes through fetch(), so they all get the same treatment:
+
+* Retries with jittered exponential backoff (for connection problems, timeouts
+  and server errors. 404s etc. aren't retried).
+* A circuit breaker for each host. If a host keeps failing, we stop asking it
+  for a while instead of waiting for every request to time out.
+* One deadline for the whole refresh. Every request (and retry) has to fit in
+  whatever time is left, so a bad network gives a partial set of frames on
+  time, instead of a refresh that takes minutes.
+
+Requests normally go out through a requests session, but a transport can be
+set instead (e.g. to record or replay an archive of responses, see archive.py).
+
+"""
+
+import time
+import random
+import asyncio
+import threading
+from urllib.parse import urlsplit
+
+import requests
+
+################################################
+# Settings
+################################################
+RETRIES = 2             #Extra attempts after the first one
+BACKOFF_BASE = 0.5      #Seconds (doubles each retry, with random jitter)
+BACKOFF_MAX = 8         #Seconds
+CONNECT_TIMEOUT = 3.05  #Seconds to connect (the read timeout is given per request)
+BREAKER_FAILURES = 5    #Failures in a row before a host is skipped...
+BREAKER_COOLDOWN = 60   #...for this many seconds
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+deadline = None         #time.monotonic() time the current refresh has to finish by
+breakers = {}           #host -> [failures in a row, time the breaker closes again]
+breaker_lock = threading.Lock()
+sessions = threading.local() #One requests session (connection pool) per thread
+transport = None        #Used instead of the sessions if set (anything with the same get() as a requests session)
+
+################################################
+#  FUNCTIONS!
+################################################
+def fetch(url, headers=None, timeout=10, name=None, stream=False):
+    ''' Get a url, with retries, a circuit breaker, and the refresh deadline.
+        Param url: The url to get
+        Param headers: Request headers
+        Param timeout: Read timeout (seconds) for each attempt
+        Param name: What we're getting (for error messages)
+        Param stream: Don't download the body straight away (read it with response.iter_content())
+
+        Returns the response, or False if we couldn't get it (like the old
+        try/except blocks did). An unsuccessful response (e.g. 404) is returned as is.
+    '''
+    host = urlsplit(url).netloc
+    name = name or host
+    response = False
+
+    for attempt in range(RETRIES + 1):
+        remaining = time_left()
+        if remaining <= 0:
+            print(f"Out of time: {name}")
+            return response
+
+        if not breaker_allows(host):
+            print(f"Skipping {name} ({host} isn't responding)")
+            return response
+
+        try:
+            response = get_session().get(url, headers=headers, timeout=(min(CONNECT_TIMEOUT, remaining), min(timeout, remaining)), stream=stream)
+        except requests.exceptions.RequestException as error:
+            print(f"Connection problems: {name} ({type(error).__name__})")
+            response = False
+        else:
+            if response.status_code not in RETRY_STATUS:
+                breaker_success(host)
+                return response
+            response.close() #(So a streamed connection goes back to the pool)
+
+        breaker_failure(host)
+
+        # Wait a (random) bit before trying again
+        if attempt < RETRIES:
+            delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+            if delay >= time_left():
+                break
+            time.sleep(delay)
+
+    return response
+def start_deadline(seconds):
+    ''' Start the time budget for a refresh.
+        Param seconds: Time budget (None for no limit)
+    '''
+    global deadline
+    deadline = None if seconds is None else time.monotonic() + seconds
+def time_left():
+    ''' Returns the seconds left before the deadline (infinite if there isn't one) '''
+    if deadline is None:
+        return float('inf')
+    return deadline - time.monotonic()
+def get_session():
+    ''' Returns this thread's requests session (keeps connections open between requests), or the transport '''
+    if transport is not None:
+        return transport
+    if not hasattr(sessions, 'session'):
+        sessions.session = requests.Session()
+    return sessions.session
+def breaker_allows(host):
+    ''' Check if we should try a host.
+        After BREAKER_FAILURES failures in a row the host is skipped until the
+        cooldown is over, then one request is let through to test it.
+
+        Returns True/False
+    '''
+    with breaker_lock:
+        failures, closes = breakers.get(host, (0, 0))
+        if failures < BREAKER_FAILURES:
+            return True
+        if time.monotonic() >= closes:
+            breakers[host] = [failures, time.monotonic() + BREAKER_COOLDOWN] #Only one test request per cooldown
+            return True
+        return False
+def breaker_success(host):
+    with breaker_lock:
+        breakers.pop(host, None)
+def breaker_failure(host):
+    with breaker_lock:
+        failures, closes = breakers.get(host, (0, 0))
+        failures += 1
+        if failures == BREAKER_FAILURES:
+            print(f"{host} isn't responding, skipping it for {BREAKER_COOLDOWN} seconds")
+            closes = time.monotonic() + BREAKER_COOLDOWN
+        breakers[host] = [failures, closes]
+async def fetch_map_tiles(tiles, num_workers):
+    ''' GeoTiler tile downloader that uses fetch() (so basemap tiles get
+        the same retries, breaker & deadline as everything else).
+        Param tiles: GeoTiler tiles
+        Param num_workers: Number of tiles to download at once
+
+        Yields the tiles (with img set, or error set if they couldn't be downloaded)
+    '''
+    loop = asyncio.get_running_loop()
+    limit = asyncio.Semaphore(num_workers)
+
+    async def fetch_tile(tile):
+        async with limit:
+            response = await loop.run_in_executor(None, lambda: fetch(tile.url, name="basemap tile"))
+        if response:
+            return tile._replace(img=response.content, error=None)
+        return tile._replace(img=None, error=ValueError(f"Unable to download {tile.url} ({response})"))
+
+    for task in asyncio.as_completed([fetch_tile(tile) for tile in tiles]):
+        yield await task
@@ -0,0 +1,339 @@
+"""
+--------------------------------------------------
+  Weather Radar! --  NEXRAD Level III decoder
+--------------------------------------------------
+
+Reads NEXRAD Level III radial products (like base reflectivity) straight from
+the files, and turns them into the same kind of image as the WMS radar layer
+(RGBA, white & transparent where there's no echo) for a map's extent and size.
+
+Turning radials & range bins into pixels is done with a lookup table: which
+(azimuth, range bin) each pixel is in. Working that out is the slow part, so
+the tables are cached for each radar & map. After that, each new volume is
+one numpy gather.
+
+    product = read_product(path)
+    radar = to_raster(product, map.extent, map.size)
+
+"""
+
+import os
+import re
+import bz2
+import struct
+import threading
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+AZIMUTH_SLOTS = 720  #Half degree slots (fits both 1 and 0.5 degree radials)
+MAX_TABLES = 8       #Lookup tables to keep (about 300KB each for a 320x240 map)
+EARTH_RADIUS = 6371  #km
+
+# Radial products we can draw: code -> (name, km per range bin)
+PRODUCTS = {
+    19: ("Base Reflectivity (16 level)", 1),
+    20: ("Base Reflectivity (16 level, long range)", 2),
+    94: ("Digital Base Reflectivity", 1),
+    153: ("Super Resolution Digital Base Reflectivity", 0.25),
+    180: ("TDWR Digital Base Reflectivity", 0.15),
+    186: ("TDWR Long Range Digital Base Reflectivity", 0.3),
+}
+
+# NWS reflectivity colours: (lowest dBZ, RGBA)
+REFLECTIVITY_COLOURS = [
+    (5, (4,233,231,255)),
+    (10, (1,159,244,255)),
+    (15, (3,0,244,255)),
+    (20, (2,253,2,255)),
+    (25, (1,197,1,255)),
+    (30, (0,142,0,255)),
+    (35, (253,248,2,255)),
+    (40, (229,188,0,255)),
+    (45, (253,149,0,255)),
+    (50, (253,0,0,255)),
+    (55, (212,0,0,255)),
+    (60, (188,0,0,255)),
+    (65, (248,0,253,255)),
+    (70, (152,84,198,255)),
+    (75, (253,253,253,255)),
+]
+NO_ECHO = (255,255,255,0) #Same as the WMS background
+
+WMO_HEADER = re.compile(rb'[A-Z]{4}\d{2} [A-Z]{4} \d{6}[^\n]*\n[^\n]*\n') #e.g. "SDUS56 KSEW 101717\r\r\nN0BLGX\r\r\n"
+MESSAGE_HEADER = struct.Struct('>hhiihhh') #Code, date, time, length, source, destination, blocks
+DESCRIPTION = struct.Struct('>hii7hihi4h16h7h2B3i') #Product description block (102 bytes)
+RADIAL_PACKET = struct.Struct('>7h') #Code, first bin, bins, i, j, scale, radials
+RADIAL_HEADER = struct.Struct('>3h') #Length, start angle, angle delta
+
+tables = OrderedDict() #(radar, map) -> lookup table
+table_lock = threading.Lock() #Frames are decoded at the same time
+volume_times = {} #path -> (modified time, volume time)
+
+################################################
+# Decoding
+################################################
+class Product:
+    ''' A decoded radial product. '''
+
+    def __init__(self, code, lat, lon, elevation, time, gate, first_bin, starts, widths, levels, values):
+        self.code = code           #Product code (e.g. 94)
+        self.lat = lat             #Radar location
+        self.lon = lon
+        self.elevation = elevation #Elevation angle (degrees)
+        self.time = time           #Volume scan time (UTC datetime)
+        self.gate = gate           #km per range bin
+        self.first_bin = first_bin
+        self.starts = starts       #Start angle of each radial (degrees)
+        self.widths = widths       #Width of each radial (degrees)
+        self.levels = levels       #Data levels (radials, bins) uint8
+        self.values = values       #Value of each data level (256 floats, NaN for no data)
+
+def read_product(path):
+    ''' Read a NEXRAD Level III file.
+        Param path: File path
+
+        Returns a Product
+    '''
+    with open(path, 'rb') as product_file:
+        return parse_product(product_file.read())
+def parse_product(data):
+    ''' Decode a NEXRAD Level III radial product.
+        Param data: The file's bytes
+
+        Returns a Product
+    '''
+    data = strip_wmo_header(data)
+    description = parse_description(data)
+    code = description[4]
+    if code not in PRODUCTS:
+        raise ValueError(f"Unsupported Level III product: {code}")
+
+    # Everything after the product description block can be bzip2 compressed (halfword 51)
+    if description[37] == 1 and data[120:123] == b'BZh':
+        data = data[:120] + bz2.decompress(data[120:])
+
+    ###################
+    # Symbology block #
+    ###################
+    position = description[42] * 2 #Offset is in halfwords
+    divider, block_id, length, layers = struct.unpack_from('>hhih', data, position)
+    if divider != -1 or block_id != 1:
+        raise ValueError("Couldn't find the symbology block")
+    position += 10 + 6 #Block header, then the first layer's header
+
+    packet_code, first_bin, bins, _, _, _, radials = RADIAL_PACKET.unpack_from(data, position)
+    position += RADIAL_PACKET.size
+
+    starts = np.empty(radials)
+    widths = np.empty(radials)
+    levels = np.zeros((radials, bins), dtype=np.uint8)
+
+    for radial in range(radials):
+        length, start, delta = RADIAL_HEADER.unpack_from(data, position)
+        position += RADIAL_HEADER.size
+        starts[radial], widths[radial] = start / 10, delta / 10
+
+        if packet_code == 16: #Digital: a byte for each bin
+            row = np.frombuffer(data, dtype=np.uint8, count=min(length, bins), offset=position)
+            position += length + length % 2 #(Padded to a halfword)
+        elif packet_code == -20705: #0xAF1F, run length encoded: (run << 4 | level) bytes
+            runs = np.frombuffer(data, dtype=np.uint8, count=length * 2, offset=position)
+            row = np.repeat(runs & 0x0F, runs >> 4)[:bins]
+            position += length * 2
+        else:
+            raise ValueError(f"Unsupported Level III packet: {packet_code & 0xFFFF:#x}")
+
+        levels[radial, :len(row)] = row
+
+    widths[widths <= 0] = 360 / radials
+    return Product(
+        code=code,
+        lat=description[1] / 1000,
+        lon=description[2] / 1000,
+        elevation=description[16] / 10,
+        time=scan_time(description),
+        gate=PRODUCTS[code][1],
+        first_bin=first_bin,
+        starts=starts % 360,
+        widths=widths,
+        levels=levels,
+        values=level_values(code, description[17:33])
+        )
+def strip_wmo_header(data):
+    ''' Returns the data without the WMO/AWIPS text header (if it has one) '''
+    if data[MESSAGE_HEADER.size:MESSAGE_HEADER.size + 2] == b'\xff\xff':
+        return data
+    header = WMO_HEADER.search(data[:100])
+    if header:
+        return data[header.end():]
+    return data
+def parse_description(data):
+    ''' Returns the product description block values (see DESCRIPTION) '''
+    description = DESCRIPTION.unpack_from(data, MESSAGE_HEADER.size)
+    if description[0] != -1:
+        raise ValueError("Not a NEXRAD Level III product")
+    return description
+def scan_time(description):
+    ''' Returns the volume scan time from the product description block '''
+    return datetime(1970, 1, 1, tzinfo=timezone.utc) + timedelta(days=description[9] - 1, seconds=description[10])
+def level_values(code, thresholds):
+    ''' Work out what each data level means.
+        Param code: Product code
+        Param thresholds: Halfwords 31-46 of the product description block
+
+        Returns 256 values (dBZ), NaN for levels with no data
+    '''
+    values = np.full(256, np.nan)
+
+    if code in [19, 20]: #16 levels, each threshold is (flags, value)
+        for level, threshold in enumerate(thresholds):
+            flags, value = (threshold >> 8) & 0xFF, threshold & 0xFF
+            if flags & 0x80: #A code (ND, RF...), not a value
+                continue
+            values[level] = -value if flags & 0x01 else value
+    else: #Digital: minimum & increment (tenths of dBZ), and number of levels
+        minimum, increment, count = thresholds[0] / 10, thresholds[1] / 10, thresholds[2]
+        level = np.arange(2, min(count, 256)) #0 = below threshold, 1 = range folded
+        values[level] = minimum + (level - 2) * increment
+
+    return values
+
+################################################
+# Drawing
+################################################
+def to_raster(product, extent, size):
+    ''' Draw a product as a radar image, like the WMS layer.
+        Param product: A Product
+        Param extent: Map extent (min lon, min lat, max lon, max lat), e.g. map.extent
+        Param size: (width, height) of the map
+
+        Returns a RGBA PIL image
+    '''
+    table = polar_table(product.lat, product.lon, product.elevation, product.gate, product.first_bin, product.levels.shape[1], tuple(extent), tuple(size))
+    colours = level_colours(product.values)
+    return Image.fromarray(colours[azimuth_grid(product)[table]])
+def azimuth_grid(product):
+    ''' Put a volume's radials into the fixed azimuth slots the lookup tables use.
+        Param product: A Product
+
+        Returns the flattened (slots, bins) data levels, with an extra 0 (no data) on the end.
+    '''
+    radials, bins = product.levels.shape
+    centres = (np.arange(AZIMUTH_SLOTS) + 0.5) * 360 / AZIMUTH_SLOTS
+
+    #Which radial covers each slot (if any)
+    order = np.argsort(product.starts)
+    starts, widths = product.starts[order], product.widths[order]
+    radial = np.searchsorted(starts, centres, side='right') - 1 #(-1 is the last radial, which wraps past 360)
+    covered = (centres - starts[radial]) % 360 < widths[radial]
+    rows = np.where(covered, order[radial], radials)
+
+    levels = np.vstack([product.levels, np.zeros((1, bins), dtype=np.uint8)])
+    return np.append(levels[rows].ravel(), 0)
+def level_colours(values):
+    ''' Returns a RGBA colour (uint8 array) for each of the 256 data levels '''
+    lowest = np.array([dbz for dbz, colour in REFLECTIVITY_COLOURS])
+    palette = np.array([NO_ECHO] + [colour for dbz, colour in REFLECTIVITY_COLOURS], dtype=np.uint8)
+
+    index = np.searchsorted(lowest, np.nan_to_num(values, nan=-np.inf), side='right') #0 = below 5dBZ (or no data)
+    return palette[index]
+def polar_table(lat, lon, elevation, gate, first_bin, bins, extent, size):
+    ''' Get the lookup table from pixels to (azimuth slot, range bin).
+        Cached, since it's the same for every volume from a radar.
+
+        Param lat, lon: Radar location
+        Param elevation: Elevation angle (degrees)
+        Param gate: km per range bin
+        Param first_bin: Range bin the data starts at
+        Param bins: Number of range bins
+        Param extent: Map extent (min lon, min lat, max lon, max lat)
+        Param size: (width, height) of the map
+
+        Returns a (height, width) array of indexes into azimuth_grid()
+    '''
+    key = (lat, lon, elevation, gate, first_bin, bins, extent, size)
+    with table_lock:
+        if key in tables:
+            tables.move_to_end(key)
+            return tables[key]
+
+    west, south, east, north = extent
+    width, height = size
+
+    #Pixel centres (the map is web mercator: even steps in longitude & mercator y)
+    lons = west + (np.arange(width) + 0.5) / width * (east - west)
+    top, bottom = mercator_y(north), mercator_y(south)
+    lats = np.degrees(np.arctan(np.sinh(top - (np.arange(height) + 0.5) / height * (top - bottom))))
+    lons, lats = np.meshgrid(lons, lats)
+
+    #Distance & bearing from the radar (great circle)
+    radar_lat = np.radians(lat)
+    pixel_lat = np.radians(lats)
+    delta_lon = np.radians(lons - lon)
+    a = np.sin((pixel_lat - radar_lat) / 2) ** 2 + np.cos(radar_lat) * np.cos(pixel_lat) * np.sin(delta_lon / 2) ** 2
+    distance = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+    azimuth = np.degrees(np.arctan2(
+        np.sin(delta_lon) * np.cos(pixel_lat),
+        np.cos(radar_lat) * np.sin(pixel_lat) - np.sin(radar_lat) * np.cos(pixel_lat) * np.cos(delta_lon)
+        )) % 360
+
+    #Range bins are along the (tilted) beam
+    bin_index = np.floor(distance / np.cos(np.radians(elevation)) / gate).astype(np.int64) - first_bin
+    slot = (azimuth / 360 * AZIMUTH_SLOTS).astype(np.int64) % AZIMUTH_SLOTS
+
+    table = slot * bins + bin_index
+    table[(bin_index < 0) | (bin_index >= bins)] = AZIMUTH_SLOTS * bins #The "no data" on the end
+    table = table.astype(np.int32)
+
+    with table_lock:
+        tables[key] = table
+        if len(tables) > MAX_TABLES: #Forget the oldest table
+            tables.popitem(last=False)
+
+    return table
+def mercator_y(lat):
+    return np.arcsinh(np.tan(np.radians(lat)))
+
+################################################
+# Finding files
+################################################
+def product_time(path):
+    ''' Returns the volume scan time of a Level III file (only reads the headers) '''
+    modified = os.path.getmtime(path)
+    if path not in volume_times or volume_times[path][0] != modified:
+        with open(path, 'rb') as product_file:
+            data = strip_wmo_header(product_file.read(256))
+        volume_times[path] = (modified, scan_time(parse_description(data)))
+    return volume_times[path][1]
+def find_product(folder, when, max_difference=300):
+    ''' Find the Level III file closest to a time.
+        Param folder: Folder of Level III files
+        Param when: UTC datetime
+        Param max_difference: Seconds the file's scan time can be off by
+
+        Returns the path, or None if there isn't one close enough.
+    '''
+    if not os.path.isdir(folder):
+        return None
+
+    closest, closest_difference = None, max_difference
+    paths = set()
+    for entry in os.scandir(folder):
+        if not entry.is_file():
+            continue
+        paths.add(entry.path)
+        try:
+            difference = abs((product_time(entry.path) - when).total_seconds())
+        except (ValueError, struct.error): #Not a Level III file
+            continue
+        if difference <= closest_difference:
+            closest, closest_difference = entry.path, difference
+
+    #Forget files that have been deleted
+    for path in [path for path in volume_times if os.path.dirname(path) == folder and path not in paths]:
+        del volume_times[path]
+
+    return closest
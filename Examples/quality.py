@@ -0,0 +1,149 @@
+"""
+--------------------------------------------------
+  Weather Radar! --  Adaptive quality
+--------------------------------------------------
+
+On a slow link or a busy Pi a refresh can take much longer than usual, and the
+old loop keeps playing (getting more out of date) until it's done. This keeps
+refreshes inside a time budget by turning the quality down a step at a time,
+and back up again once there's room.
+
+Each kind of stage has its own steps, so only the part that's slow is turned
+down (a slow download doesn't need fewer alerts drawn, and slow compositing
+doesn't need smaller radar images):
+
+    Radar images (downloads):  5 frames, then half resolution radar (a quarter of the tiles), then 3 frames
+    Compositing (CPU):         5 frames, then 3 frames and no storm motion
+    Alerts & overlays:         no hazard alerts for the greater area (not downloaded or drawn)
+
+After each refresh, update() is given the refresh graph's timeline. If it was
+too slow (over the budget), the kinds of stage that took more than their share
+of it go down a step (two if they were way over). A kind of stage only goes back
+up after a few refreshes in a row that were well under its share, so it doesn't
+flip back and forth.
+
+    quality = QualityController(60)
+    settings = quality.settings()   # {'frames': 5, 'alerts': True, ...}
+    ...
+    quality.update(graph.timeline())
+
+"""
+
+BEST = {'frames': None, 'alerts': True, 'radar_zoom_out': 0, 'motion': True} #(None = as many frames as the station mode says)
+
+#Kind of stage -> its steps down (best first, only what's changed from BEST)
+STEPS = {
+    "radar images": [{}, {'frames': 5}, {'frames': 5, 'radar_zoom_out': 1}, {'frames': 3, 'radar_zoom_out': 1}],
+    "compositing": [{}, {'frames': 5}, {'frames': 3, 'motion': False}],
+    "alerts & status": [{}, {'alerts': False}],
+    "overlays": [{}, {'alerts': False}],
+}
+#Part of the budget each kind of stage can take (they run at the same time, so these add up to more than 1)
+SHARES = {"radar images": 0.6, "compositing": 0.4, "alerts & status": 0.5, "overlays": 0.2}
+HEADROOM = 0.5  #Stages under this much of their share are fast enough to go up a step
+CALM = 3        #...this many times in a row
+WAY_OVER = 1.5  #Stages over this much of their share go down two steps
+
+#Stage name (first word) -> what it's part of
+STAGE_GROUPS = {'radar': "radar images", 'composite': "compositing", 'shared': "compositing", 'basemap': "basemap", 'overlays': "overlays"}
+
+################################################
+#  FUNCTIONS!
+################################################
+class QualityController:
+    ''' Picks the quality for each refresh, from how long each part of the last ones took. '''
+
+    def __init__(self, budget, steps=STEPS, shares=SHARES):
+        ''' Param budget: Seconds a refresh should take (at most)
+            Param steps: Kind of stage -> its settings for each step, best first
+            Param shares: Kind of stage -> part of the budget it can take
+        '''
+        self.budget = budget
+        self.steps = steps
+        self.shares = shares
+        self.levels = {group: 0 for group in steps} #Step each kind of stage is on
+        self.fast = {group: 0 for group in steps} #Fast refreshes in a row
+
+    def settings(self):
+        ''' Returns the settings for the next refresh (a dict, see BEST): the lowest of every kind of stage's step '''
+        settings = dict(BEST)
+        for group, level in self.levels.items():
+            step = self.steps[group][level]
+            if step.get('frames') is not None:
+                settings['frames'] = min(step['frames'], settings['frames'] or step['frames'])
+            settings['alerts'] = settings['alerts'] and step.get('alerts', True)
+            settings['radar_zoom_out'] = max(settings['radar_zoom_out'], step.get('radar_zoom_out', 0))
+            settings['motion'] = settings['motion'] and step.get('motion', True)
+        return settings
+
+    def update(self, timeline):
+        ''' Work out the steps for the next refresh.
+            Param timeline: TaskGraph.timeline() of the refresh that just finished
+
+            Returns True if anything changed
+        '''
+        total, stages = timeline
+        spans = stage_spans(stages)
+        over = {group: spans.get(group, 0) / (self.budget * self.shares[group]) for group in self.steps}
+
+        slow = []
+        if total > self.budget:
+            slow = [group for group, ratio in over.items() if ratio > 1]
+            if not slow: #(Too slow overall, but nothing was over its share: blame the closest)
+                slow = [max(over, key=over.get)]
+
+        changed = []
+        for group in self.steps:
+            level = self.levels[group]
+            if group in slow:
+                self.fast[group] = 0
+                level = min(level + (2 if over[group] > WAY_OVER else 1), len(self.steps[group]) - 1)
+            elif over[group] < HEADROOM:
+                self.fast[group] += 1
+                if self.fast[group] >= CALM and level > 0:
+                    self.fast[group] = 0
+                    level -= 1
+            else:
+                self.fast[group] = 0
+
+            if level != self.levels[group]:
+                direction = "down" if level > self.levels[group] else "up"
+                changed.append(f"{group} {direction} to step {level}")
+                self.levels[group] = level
+
+        if changed:
+            print(f"Quality: {', '.join(changed)} (refresh took {total:.1f} of {self.budget:.0f} seconds; {describe(spans)})")
+            return True
+        return False
+
+def stage_spans(stages):
+    ''' Work out how long each kind of stage took, from the first one starting to the last one
+        finishing (without the gaps where none of them were running).
+        Param stages: [(name, start, seconds)] from TaskGraph.timeline()
+
+        Returns {group: seconds}
+    '''
+    intervals = {}
+    for name, start, seconds in stages:
+        first_word = name.split()[0]
+        if first_word == 'frames': #(That's the whole of get_radar_images())
+            continue
+        group = STAGE_GROUPS.get(first_word, "alerts & status")
+        intervals.setdefault(group, []).append((start, start + seconds))
+
+    spans = {}
+    for group, group_intervals in intervals.items():
+        total, end = 0, None
+        for start, finish in sorted(group_intervals):
+            if end is None or start > end:
+                total += finish - start
+                end = finish
+            elif finish > end:
+                total += finish - end
+                end = finish
+        spans[group] = total
+    return spans
+def describe(groups):
+    ''' Returns the slowest groups of stages as text, e.g. "radar images 41.2s, compositing 3.1s" '''
+    slowest = sorted(groups.items(), key=lambda item: -item[1])[:3]
+    return ", ".join(f"{group} {seconds:.1f}s" for group, seconds in slowest)
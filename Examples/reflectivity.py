@@ -0,0 +1,110 @@
+"""
+--------------------------------------------------
+  Weather Radar! --  Reflectivity values
+--------------------------------------------------
+
+Turns radar images back into numbers. Each legend colour is looked up in a
+sorted palette table (colours packed into one number, then a binary search),
+giving a dBZ array for each frame. Colours that aren't exactly in the legend
+(e.g. from resampling) get the closest legend colour, if there's one close enough.
+
+Then lots of points can be sampled in every frame at once:
+
+    stack = dbz_stack(radars)            # (frames, height, width)
+    values = sample(stack, rows, cols)   # (frames, points)
+
+The palette is the NWS one (see nexrad.py), not read from the WMS. So check it
+against the layer's legend (GetLegendGraphic) before trusting the numbers:
+
+    if legend_matches(Image.open(legend_png)): ...
+
+"""
+
+import numpy as np
+
+from nexrad import REFLECTIVITY_COLOURS
+
+MAX_COLOUR_DISTANCE = 24 #How far off (RGB) a colour can be and still count as a legend colour
+LEGEND_DISTANCE = 8      #How far off the legend's swatches can be from the palette (they should be the same)
+MIN_SWATCH_PIXELS = 20   #Colours in the legend image with fewer pixels than this are edges & text, not swatches
+
+################################################
+#  FUNCTIONS!
+################################################
+def palette_table(colours=REFLECTIVITY_COLOURS):
+    ''' Make the lookup table for a legend.
+        Param colours: List of (dBZ, RGBA colour)
+
+        Returns the packed RGB colours (sorted), their dBZ values, and the RGB colours in the same order
+    '''
+    rgb = np.array([colour[:3] for dbz, colour in colours], dtype=np.int64)
+    packed = (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+    order = np.argsort(packed)
+    values = np.array([dbz for dbz, colour in colours], dtype=np.float32)
+    return packed[order], values[order], rgb[order]
+def to_dbz(radar, table=None):
+    ''' Get the reflectivity of every pixel of a radar image.
+        Param radar: Radar image (PIL)
+        Param table: From palette_table() (None for the NWS reflectivity colours)
+
+        Returns a (height, width) float32 array of dBZ (NaN where there's no echo)
+    '''
+    packed_palette, values, rgb = table if table is not None else default_table
+    pixels = np.asarray(radar.convert("RGBA"))
+    packed = (pixels[:, :, 0].astype(np.int64) << 16) | (pixels[:, :, 1].astype(np.int64) << 8) | pixels[:, :, 2]
+
+    #Exact legend colours
+    index = np.clip(np.searchsorted(packed_palette, packed), 0, len(packed_palette) - 1)
+    found = packed_palette[index] == packed
+
+    #Anything else that's visible: closest legend colour (just once for each different colour)
+    echo = pixels[:, :, 3] > 0
+    missing = echo & ~found
+    if missing.any():
+        colours, inverse = np.unique(pixels[missing][:, :3].astype(np.int64), axis=0, return_inverse=True)
+        distance = ((colours[:, None, :] - rgb[None, :, :]) ** 2).sum(axis=2)
+        closest = distance.argmin(axis=1)
+        close = distance[np.arange(len(colours)), closest] <= MAX_COLOUR_DISTANCE ** 2
+        index[missing] = closest[inverse.ravel()]
+        found[missing] = close[inverse.ravel()]
+
+    return np.where(echo & found, values[index], np.nan).astype(np.float32)
+def legend_matches(legend, table=None):
+    ''' Check a layer's legend has the same colours as the palette (so to_dbz() is right for it).
+        Param legend: Legend image (PIL, from the WMS GetLegendGraphic)
+        Param table: From palette_table() (None for the NWS reflectivity colours)
+
+        Returns True if every palette colour is in the legend, and every swatch in the legend is in the palette
+    '''
+    packed_palette, values, rgb = table if table is not None else default_table
+    pixels = np.asarray(legend.convert("RGBA")).reshape(-1, 4)
+    colours, counts = np.unique(pixels[pixels[:, 3] > 0][:, :3].astype(np.int64), axis=0, return_counts=True)
+
+    #Swatches (not the background, text or anti-aliased edges, which are greys or only a few pixels)
+    grey = colours.max(axis=1) - colours.min(axis=1) < 16
+    swatches = colours[(counts >= MIN_SWATCH_PIXELS) & ~grey]
+    palette = rgb[rgb.max(axis=1) - rgb.min(axis=1) >= 16] #(Greys, e.g. white for 75+ dBZ, can't be told from the background)
+    if len(swatches) == 0:
+        return False
+
+    distance = ((swatches[:, None, :] - palette[None, :, :]) ** 2).sum(axis=2)
+    return bool((distance.min(axis=1) <= LEGEND_DISTANCE ** 2).all() and (distance.min(axis=0) <= LEGEND_DISTANCE ** 2).all())
+def dbz_stack(radars, table=None):
+    ''' Returns the dBZ of a list of radar images as one (frames, height, width) array '''
+    return np.stack([to_dbz(radar, table) for radar in radars])
+def sample(stack, rows, cols):
+    ''' Sample points in every frame (one gather).
+        Param stack: (frames, height, width) array from dbz_stack()
+        Param rows, cols: Pixel positions of the points (anything outside the image is NaN)
+
+        Returns a (frames, points) array
+    '''
+    rows, cols = np.asarray(rows).ravel(), np.asarray(cols).ravel()
+    height, width = stack.shape[1:]
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+
+    values = np.full((len(stack), len(rows)), np.nan, dtype=stack.dtype)
+    values[:, inside] = stack[:, rows[inside], cols[inside]]
+    return values
+
+default_table = palette_table()
@@ -4,5 +4,16 @@ secrets = {
                 'Contact': 'EMAIL_ADDRESS'
                 },
     'coordinates' : (47.168599999999998,-123.55929999999999),
-    'station': 'klgx' #station ID fallback
+    'station': 'klgx', #station ID fallback
+    'framebuffer': None, #Framebuffer device for an HDMI/DSI panel, e.g. '/dev/fb0' (None = the ILI9341 on SPI)
+    'framebuffer_scale': None, #Make the frames this many times bigger on the panel (None = 1)
+    'export_dir': None, #Folder to save the loop as GIF/APNG/WebP animations (optional)
+    'layers': ['bohp'], #Radar products to download (the first one is shown). Each extra one is another download per frame, e.g. ['bohp', 'bdhc', 'bref_raw', 'bvel']
+    'nws_url': None, #Weather API server (None = https://api.weather.gov)
+    'opengeo_url': None, #Radar & alerts server (None = https://opengeo.ncep.noaa.gov)
+    'basemap': None, #GeoTiler map provider, tile url, or .mbtiles file (None = stamen-toner)
+    'basemap_labels': None, #(None = stamen-toner-labels)
+    'quality_budget': None, #Seconds a refresh should take. Slower ones turn the quality down until they fit (None = 60)
+    'history_dir': None, #Folder to keep old frames in, to scrub back through (optional)
+    'level3_dir': None, #Folder of mirrored NEXRAD Level III files, in station & layer folders e.g. klgx/bref_raw/ (optional)
 }
@@ -0,0 +1,455 @@
+"""
+--------------------------------------------------
+  Weather Radar! --  Soak test
+--------------------------------------------------
+
+The radar runs for weeks at a time, so anything that slowly leaks (memory,
+open files, CPU) eventually takes it down. This runs the real main loop for
+days of refreshes in a few minutes, and checks that everything stays flat:
+
+* A local server (in its own process) stands in for the Weather API, the
+  opengeo WMS/WFS and the map tiles. Radar times, storms, alerts and the
+  station status all change as time goes by.
+* A virtual clock skips the waiting between refreshes. The refreshes
+  themselves run in real time (so timeouts, retries & the deadline still work).
+* A MockDisplay (see display.py) stands in for the ILI9341.
+
+After every refresh it records the RSS, open files, Python objects (by type)
+and CPU time, then reports the trends (after a few warm up cycles, while the
+caches fill up). It exits with 1 if memory or open files keep growing.
+
+    python3 soak.py --cycles 300 --csv soak.csv
+
+"""
+
+import os
+import sys
+import gc
+import csv
+import math
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+from io import BytesIO
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from secrets import secrets
+from display import MockDisplay
+from nexrad import REFLECTIVITY_COLOURS
+
+TIME_STEP = 300              #Seconds between radar (and alert) times
+TIMES_KEPT = 12              #Times in each GetCapabilities file
+STORM_SPEED = (20, 6)        #Metres per second (east, north)
+STORM_RADIUS = 40000         #Metres
+STORM_PERIOD = 6 * 3600      #Seconds until the storms start again
+WARMUP = 20                  #Cycles before the trends are measured
+MAX_RSS_PER_DAY = 4096       #KB of RSS growth per (virtual) day that counts as a leak
+MAX_FD_GROWTH = 0            #Open files
+STATION = secrets['station']
+
+################################################
+#  Virtual clock
+################################################
+class VirtualClock:
+    ''' Stands in for the time module. Sleeping skips ahead instead, unless a
+        refresh is running (then it's a real sleep, so downloads can finish).
+    '''
+
+    def __init__(self):
+        self.offset = None #multiprocessing.Value (seconds ahead of the real clock, shared with the server)
+        self.busy = 0      #Refreshes running
+
+    def skipped(self):
+        return self.offset.value if self.offset is not None else 0.0
+
+    def monotonic(self):
+        return time.monotonic() + self.skipped()
+
+    def time(self):
+        return time.time() + self.skipped()
+
+    def sleep(self, seconds):
+        if self.offset is None:
+            return time.sleep(seconds)
+
+        #Real sleeps (a bit at a time) until the refresh is done, then skip the rest
+        while seconds > 0 and self.busy:
+            nap = min(seconds, 0.05)
+            time.sleep(nap)
+            seconds -= nap
+        with self.offset.get_lock():
+            self.offset.value += max(0, seconds)
+
+    def __getattr__(self, name): #Everything else is the real time module
+        return getattr(time, name)
+
+clock = VirtualClock()
+
+class VirtualDatetime(datetime):
+    ''' datetime, but now() is on the virtual clock. '''
+
+    @classmethod
+    def now(cls, tz=None):
+        return datetime.fromtimestamp(clock.time(), tz)
+
+class SoakFinished(BaseException):
+    ''' Stops main() (it only catches Exception). '''
+
+################################################
+#  Stand-in server
+################################################
+def time_string(timestamp, pattern='%Y-%m-%dT%H:%M:%S.000Z'):
+    ''' Returns a UTC timestamp as a string '''
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(pattern)
+def png(image):
+    ''' Returns a PIL image as PNG bytes '''
+    file = BytesIO()
+    image.save(file, "PNG")
+    return file.getvalue()
+def mercator(lon, lat):
+    ''' Returns web mercator metres (EPSG:3857) '''
+    radius = 6378137
+    return radius * math.radians(lon), radius * math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+
+class StandIn(BaseHTTPRequestHandler):
+    ''' Answers the requests weather_radar.py makes, like the real servers would. '''
+
+    offset = None #Virtual clock offset (multiprocessing.Value)
+    basemap_tiles = {}
+
+    def now(self):
+        return time.time() + self.offset.value
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key.lower(): values[0] for key, values in parse_qs(url.query).items()}
+        path = url.path.strip('/').split('/')
+        request = query.get('request', '').lower()
+
+        if path[0] == 'nws' and path[1] == 'points':
+            self.send(self.point(), "application/geo+json")
+        elif path[0] == 'nws' and path[1:3] == ['radar', 'stations']:
+            self.send(self.stations(), "application/geo+json")
+        elif path[0] == 'opengeo' and request == 'getcapabilities':
+            self.send(self.capabilities(radar=path[2] != 'wwa'), "text/xml")
+        elif path[0] == 'opengeo' and request == 'getmap':
+            self.send(self.radar_tile(query), "image/png")
+        elif path[0] == 'opengeo' and request == 'getfeature':
+            self.send(self.features(query['typenames']), "application/json")
+        elif path[0] in ['tiles', 'labels']:
+            self.send(self.basemap_tile(path[0]), "image/png")
+        else:
+            self.send_error(404)
+
+    def send(self, body, content_type):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+    ##########################
+    # Weather API            #
+    ##########################
+    def point(self):
+        return json.dumps({"properties": {
+            "radarStation": STATION.upper(),
+            "relativeLocation": {"properties": {"city": "Soak Town", "state": "WA"}},
+            "timeZone": "America/Los_Angeles",
+            "forecast": "",
+            }})
+
+    def stations(self):
+        #Ours is down for an hour every other day (so the radar switches to the neighbour)
+        down = (self.now() // 3600) % 48 == 47
+        lat, lon = secrets['coordinates']
+        stations = [
+            (STATION.upper(), "WSR-88D", lat, lon, 3 * 3600 if down else 120),
+            ("KNBR", "WSR-88D", lat + 1.2, lon + 1.0, 180),
+            ("TNBR", "TDWR", lat - 0.3, lon + 0.4, 60),
+            ]
+        return json.dumps({"features": [{
+            "geometry": {"type": "Point", "coordinates": [station_lon, station_lat]},
+            "properties": {
+                "id": station_id,
+                "name": "Soak Test",
+                "stationType": station_type,
+                "rda": {"properties": {"volumeCoveragePattern": "R212"}},
+                "latency": {"levelTwoLastReceivedTime": time_string(self.now() - latency, '%Y-%m-%dT%H:%M:%S+00:00')},
+                }} for station_id, station_type, station_lat, station_lon, latency in stations]})
+
+    ##########################
+    # WMS                    #
+    ##########################
+    def capabilities(self, radar):
+        latest = self.now() // TIME_STEP * TIME_STEP
+        times = ",".join(time_string(latest - TIME_STEP * i) for i in reversed(range(TIMES_KEPT)))
+        lat, lon = secrets['coordinates']
+        bounds = (f"<EX_GeographicBoundingBox><westBoundLongitude>{lon - 5}</westBoundLongitude><eastBoundLongitude>{lon + 5}</eastBoundLongitude>"
+                  f"<southBoundLatitude>{lat - 4}</southBoundLatitude><northBoundLatitude>{lat + 4}</northBoundLatitude></EX_GeographicBoundingBox>") if radar else ""
+        return f'<WMS_Capabilities><Capability><Layer>{bounds}<Layer><Dimension name="time">{times}</Dimension></Layer></Layer></Capability></WMS_Capabilities>'
+
+    def radar_tile(self, query):
+        ''' Three storms drifting across the station (stronger in the afternoon, gone at night) '''
+        minx, miny, maxx, maxy = (float(value) for value in query['bbox'].split(','))
+        size = int(query['width'])
+        when = datetime.strptime(query['time'], '%Y-%m-%dT%H:%M:%S.000Z').replace(tzinfo=timezone.utc).timestamp()
+
+        strength = 60 * math.sin(math.pi * (when % 86400) / 86400)
+        seconds = when % STORM_PERIOD - STORM_PERIOD / 2
+        centre_x, centre_y = mercator(secrets['coordinates'][1], secrets['coordinates'][0])
+
+        y, x = np.mgrid[0:size, 0:size] + 0.5
+        x = minx + x * (maxx - minx) / size
+        y = maxy - y * (maxy - miny) / size
+        dbz = np.zeros((size, size))
+        for storm in range(3):
+            storm_x = centre_x + STORM_SPEED[0] * seconds + (storm - 1) * 3 * STORM_RADIUS
+            storm_y = centre_y + STORM_SPEED[1] * seconds + (storm - 1) * STORM_RADIUS
+            distance = np.hypot(x - storm_x, y - storm_y) / STORM_RADIUS
+            dbz = np.maximum(dbz, strength * (1 - distance))
+
+        pixels = np.full((size, size, 4), (255, 255, 255, 0), dtype=np.uint8)
+        for level, colour in REFLECTIVITY_COLOURS:
+            pixels[dbz >= level] = colour
+        return png(Image.fromarray(pixels))
+
+    ##########################
+    # WFS                    #
+    ##########################
+    def features(self, kind):
+        ''' Alerts around our location (how many goes up & down through the day) '''
+        now = self.now()
+        lat, lon = secrets['coordinates']
+        if kind == 'warnings':
+            count = int((now // 3600) % 4)
+            types = ["Severe Thunderstorm Warning", "Flash Flood Warning"]
+        else:
+            count = int(3 + 3 * math.sin(2 * math.pi * now / 86400))
+            types = ["Winter Storm Watch", "High Wind Warning", "Gale Warning"]
+
+        features = []
+        for i in range(count):
+            size = 0.2 + 0.1 * i
+            square = [[lon - size, lat - size], [lon + size, lat - size], [lon + size, lat + size], [lon - size, lat + size], [lon - size, lat - size]]
+            hole = [[x * 0.5 + lon * 0.5, y * 0.5 + lat * 0.5] for x, y in square]
+            features.append({
+                "type": "Feature",
+                "geometry": {"type": "MultiPolygon", "coordinates": [[square, hole]] if i % 2 else [[square]]},
+                "properties": {
+                    "prod_type": types[i % len(types)],
+                    "cap_id": f"soak.{kind}.{i}",
+                    "onset": time_string(now - 3600, '%Y-%m-%dT%H:%M:%S+0000'),
+                    "ends": "" if i % 3 == 0 else time_string(now + 3 * 3600, '%Y-%m-%dT%H:%M:%S+0000'),
+                    "expiration": time_string(now + 3 * 3600, '%Y-%m-%dT%H:%M:%S+0000'),
+                    },
+                })
+        return json.dumps({"type": "FeatureCollection", "totalFeatures": count, "features": features})
+
+    ##########################
+    # Basemap                #
+    ##########################
+    def basemap_tile(self, kind):
+        if kind not in self.basemap_tiles:
+            if kind == 'tiles':
+                image = Image.new("RGBA", (256, 256), (235, 235, 235, 255))
+                draw = ImageDraw.Draw(image)
+                for line in range(0, 256, 32):
+                    draw.line([(line, 0), (line, 255)], fill=(60, 60, 60, 255))
+                    draw.line([(0, line), (255, line)], fill=(60, 60, 60, 255))
+            else:
+                image = Image.new("RGBA", (256, 256), (0, 0, 0, 0))
+                ImageDraw.Draw(image).text((100, 120), "Soak", fill=(0, 0, 0, 255))
+            self.basemap_tiles[kind] = png(image)
+        return self.basemap_tiles[kind]
+
+def serve(offset, ready):
+    ''' Run the stand-in server (in its own process, so it isn't measured).
+        Param offset: Virtual clock offset (multiprocessing.Value)
+        Param ready: Queue to put the port on
+    '''
+    StandIn.offset = offset
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandIn)
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+################################################
+#  Measuring
+################################################
+def rss():
+    ''' Returns the resident memory of this process (KB) '''
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+def open_files():
+    ''' Returns how many file descriptors this process has open '''
+    return len(os.listdir("/proc/self/fd"))
+def object_counts():
+    ''' Returns a Counter of Python objects by type (after a full collection) '''
+    gc.collect()
+    return Counter(type(item).__name__ for item in gc.get_objects())
+
+def soak(cycles, warmup=WARMUP, frame_duration=None, verbose=False):
+    ''' Run the radar's main loop for a number of refresh cycles.
+        Param cycles: Number of refreshes
+        Param warmup: Cycles before the trends are measured (the object types are only kept for that cycle & the last one)
+        Param frame_duration: Milliseconds per frame (None = the radar's setting).
+                              Longer is quicker, as less frames are shown between refreshes.
+        Param verbose: Show what the radar prints
+
+        Returns a list of samples (dictionaries), one per cycle
+    '''
+    context = multiprocessing.get_context("fork")
+    clock.offset = context.Value('d', 0.0)
+    ready = context.Queue()
+    server = context.Process(target=serve, args=(clock.offset, ready), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{ready.get(timeout=30)}"
+
+    secrets.update({
+        'nws_url': f"{base_url}/nws",
+        'opengeo_url': f"{base_url}/opengeo",
+        'basemap': f"{base_url}/tiles/{{z}}/{{x}}/{{y}}.png",
+        'basemap_labels': f"{base_url}/labels/{{z}}/{{x}}/{{y}}.png",
+        'export_dir': None,
+        'level3_dir': None,
+        })
+
+    import net
+    import task_graph
+    import weather_radar
+
+    for module in [weather_radar, net, task_graph]:
+        module.time = clock
+    weather_radar.datetime = VirtualDatetime
+    weather_radar.disp = MockDisplay()
+    if frame_duration is not None:
+        weather_radar.FRAME_DURATION = frame_duration
+
+    samples = []
+    refresh_radar = weather_radar.refresh_radar
+    cpu = [time.process_time()]
+
+    def measured_refresh():
+        if len(samples) >= cycles:
+            raise SoakFinished()
+
+        started = time.monotonic()
+        clock.busy += 1
+        error = None
+        try:
+            return refresh_radar()
+        except Exception as exception:
+            error = type(exception).__name__
+            raise
+        finally:
+            clock.busy -= 1
+            refresh_seconds = time.monotonic() - started
+            objects = object_counts()
+            cpu_now = time.process_time()
+            samples.append({
+                'cycle': len(samples),
+                'virtual_time': clock.time(),
+                'rss_kb': rss(),
+                'open_files': open_files(),
+                'objects': sum(objects.values()),
+                'cpu_seconds': cpu_now - cpu[0], #(Everything since the last refresh, including playing the loop)
+                'refresh_seconds': refresh_seconds,
+                'error': error,
+                'types': objects,
+                })
+            cpu[0] = cpu_now
+            if len(samples) >= 2 and len(samples) - 2 != warmup:
+                samples[-2].pop('types') #(Or they'd be the biggest thing growing)
+            sample = samples[-1]
+            print(f"Cycle {sample['cycle'] + 1}/{cycles}: {time_string(sample['virtual_time'], '%a %H:%M')}, "
+                  f"{sample['rss_kb'] / 1024:.1f} MB, {sample['open_files']} files, {sample['objects']} objects, "
+                  f"{sample['cpu_seconds']:.2f} s CPU{f', {error}' if error else ''}", file=sys.stderr)
+
+    weather_radar.refresh_radar = measured_refresh
+
+    with tempfile.TemporaryDirectory() as folder:
+        weather_radar.STATE_FILE = os.path.join(folder, "radar_state.pickle")
+        with contextlib.ExitStack() as stack:
+            if not verbose:
+                stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+            try:
+                weather_radar.main()
+            except SoakFinished:
+                pass
+
+    server.terminate()
+    return samples
+def report(samples, warmup=WARMUP):
+    ''' Print the trends.
+        Param samples: From soak()
+        Param warmup: Cycles to ignore at the start
+
+        Returns True if nothing's growing
+    '''
+    measured = samples[warmup:]
+    if len(measured) < 2:
+        print(f"Not enough cycles after the warm up ({len(samples)} cycles, {warmup} warm up)")
+        return False
+
+    cycle_seconds = (measured[-1]['virtual_time'] - measured[0]['virtual_time']) / (len(measured) - 1)
+    rss_slope = np.polyfit(np.arange(len(measured)), [sample['rss_kb'] for sample in measured], 1)[0]
+    rss_per_day = rss_slope * 86400 / cycle_seconds if cycle_seconds > 0 else 0
+    file_growth = measured[-1]['open_files'] - measured[0]['open_files']
+    cpu = np.array([sample['cpu_seconds'] for sample in measured])
+    refresh = np.array([sample['refresh_seconds'] for sample in measured])
+    errors = Counter(sample['error'] for sample in samples if sample['error'])
+
+    print("\n****************************************************")
+    print(f"Soaked {len(samples)} cycles ({len(samples) * cycle_seconds / 86400:.1f} virtual days, {cycle_seconds / 60:.1f} minutes per cycle)")
+    print(f"- RSS: {measured[0]['rss_kb'] / 1024:.1f} -> {measured[-1]['rss_kb'] / 1024:.1f} MB, trend {rss_slope:+.1f} KB/cycle ({rss_per_day / 1024:+.2f} MB/day)")
+    print(f"- Open files: {measured[0]['open_files']} -> {measured[-1]['open_files']}")
+    print(f"- CPU per cycle: {cpu.mean():.2f} s average, {np.percentile(cpu, 95):.2f} s 95th percentile, {cpu.max():.2f} s max")
+    print(f"- Refresh: {refresh.mean():.2f} s average, {refresh.max():.2f} s max")
+    print(f"- Errors: {dict(errors) if errors else 'none'}")
+
+    growth = measured[-1]['types'] - measured[0]['types']
+    print(f"- Objects: {measured[0]['objects']} -> {measured[-1]['objects']}")
+    for name, count in growth.most_common(10):
+        print(f"\t+{count} {name}")
+
+    leaking = rss_per_day > MAX_RSS_PER_DAY or file_growth > MAX_FD_GROWTH
+    print("LEAKING!" if leaking else "Flat!")
+    return not leaking and not errors
+def save_csv(samples, path):
+    ''' Save the samples (without the object types) as a CSV file '''
+    columns = ['cycle', 'virtual_time', 'rss_kb', 'open_files', 'objects', 'cpu_seconds', 'refresh_seconds', 'error']
+    with open(path, "w", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(samples)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the weather radar for days of refreshes (against a local stand-in server) and check for leaks.")
+    parser.add_argument("--cycles", type=int, default=300, help="Refresh cycles to run")
+    parser.add_argument("--warmup", type=int, default=WARMUP, help="Cycles to ignore at the start (while caches fill)")
+    parser.add_argument("--frame-duration", type=int, default=5000, help="Milliseconds per frame (longer is quicker)")
+    parser.add_argument("--csv", help="Save each cycle's measurements to a CSV file")
+    parser.add_argument("--verbose", action="store_true", help="Show what the radar prints")
+    args = parser.parse_args()
+
+    samples = soak(args.cycles, args.warmup, args.frame_duration, args.verbose)
+    if args.csv:
+        save_csv(samples, args.csv)
+    sys.exit(0 if report(samples, args.warmup) else 1)
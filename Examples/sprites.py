@@ -0,0 +1,196 @@
+"""
+--------------------------------------------------
+  Weather Radar! --  Label sprites
+--------------------------------------------------
+
+Rendering TrueType text (especially with a stroke) is slow on the Pi, and we
+draw the same labels over and over again. So labels are rendered once into a
+small RGBA "sprite", kept in a cache, and pasted onto the layers after that.
+
+* label_sprite(): A whole label (alert names, "!!!"...). One-offs like status
+                  messages with the time in them aren't kept (cache=False).
+* pill_sprite(): The rounded alert "pill" labels
+* draw_glyphs(): Text that keeps changing (like the frame times). Each character
+                 is cached instead, and the text is put together from those.
+
+Fonts are (file, size) tuples, and are only loaded the first time they're used.
+
+"""
+
+import math
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageDraw, ImageFont
+
+MAX_SPRITES = 512
+
+fonts = {}                 #(file, size) -> FreeTypeFont
+sprite_cache = OrderedDict() #key -> (sprite, extra info)
+sprite_lock = threading.Lock()
+measure_draw = ImageDraw.Draw(Image.new('RGBA', (1, 1))) #For measuring text
+
+################################################
+#  FUNCTIONS!
+################################################
+def get_font(font):
+    ''' Load a font (only the first time it's used).
+        Param font: (file, size) tuple (a loaded font is returned as is)
+
+        Returns a PIL font.
+    '''
+    if not isinstance(font, tuple):
+        return font
+    if font not in fonts:
+        fonts[font] = ImageFont.truetype(font[0], font[1])
+    return fonts[font]
+def text_length(text, font):
+    ''' Returns the length of text in pixels '''
+    return get_font(font).getlength(text)
+def label_sprite(text, font, fill, stroke_width=0, stroke_fill=None, spacing=2, cache=True):
+    ''' Get a rendered label.
+        Param text: Label text (can be multiline)
+        Param font: (file, size) tuple
+        Param fill: RGBA colour tuple
+        Param stroke_width, stroke_fill: Outline width & RGBA colour
+        Param spacing: Line spacing (for multiline text)
+        Param cache: Keep it for next time (False for text that won't be seen again)
+
+        Returns the sprite, and the (x,y) offset to paste it at (relative to where the text would be drawn)
+    '''
+    key = ('label', text, font, fill, stroke_width, stroke_fill, spacing)
+    cached = get_cached(key)
+    if cached is not None:
+        return cached
+
+    pil_font = get_font(font)
+    left, top, right, bottom = measure_draw.multiline_textbbox((0,0), text, font=pil_font, spacing=spacing, stroke_width=stroke_width)
+
+    sprite = Image.new('RGBA', (max(1, right - left), max(1, bottom - top)), (0,0,0,0))
+    ImageDraw.Draw(sprite).multiline_text(
+        (-left, -top),
+        text,
+        font=pil_font,
+        fill=fill,
+        spacing=spacing,
+        stroke_width=stroke_width,
+        stroke_fill=stroke_fill
+        )
+
+    if not cache:
+        return sprite, (left, top)
+    return set_cached(key, (sprite, (left, top)))
+def pill_sprite(text, font, fill_colour, stroke_colour, font_fill, height):
+    ''' Get a rendered alert "pill" label (rounded ends, outline & text).
+        Param text: Label text
+        Param font: (file, size) tuple
+        Param fill_colour, stroke_colour, font_fill: RGBA colour tuples
+        Param height: Height of the pill
+
+        Returns the sprite, and the length of the text.
+        (The sprite starts 5 pixels left of the text)
+    '''
+    key = ('pill', text, font, fill_colour, stroke_colour, font_fill, height)
+    cached = get_cached(key)
+    if cached is not None:
+        return cached
+
+    length = text_length(text, font)
+    sprite = Image.new('RGBA', (math.ceil(length) + 16, height + 1), (0,0,0,0))
+    pill = ImageDraw.Draw(sprite)
+    pos_x, pos_y = 5, 0
+
+    #Rounded start
+    pill.chord(
+        (pos_x-5,pos_y, pos_x+15, pos_y+height),
+        90,
+        270,
+        fill=fill_colour,
+        outline=stroke_colour,
+        width=1
+        )
+    #Rectangle
+    pill.rectangle(
+        (pos_x+5,pos_y,pos_x+length,pos_y+height),
+        fill=fill_colour,
+        outline=stroke_colour,
+        width=1
+        )
+    #Rounded end
+    pill.chord(
+        (pos_x+length-10, pos_y, pos_x+length+10, pos_y+height),
+        270,
+        90,
+        fill=fill_colour,
+        outline=stroke_colour,
+        width=1
+        )
+    #Rectangle (to cover up internal strokes)
+    pill.rectangle(
+        (pos_x+3,pos_y+1,pos_x+length+3,pos_y+height-1),
+        fill=fill_colour
+        )
+    #Text
+    pill.text(
+        (pos_x+2,pos_y),
+        text,
+        font=get_font(font),
+        fill=font_fill
+        )
+
+    return set_cached(key, (sprite, length))
+def draw_label(layer, xy, text, font, fill, stroke_width=0, stroke_fill=None, spacing=2):
+    ''' Draw a label onto a layer (like ImageDraw.text, but cached).
+        Param layer: RGBA image to draw on
+        Param xy: Where the text goes (same as ImageDraw.text)
+        (the rest are the same as label_sprite)
+    '''
+    sprite, (left, top) = label_sprite(text, font, fill, stroke_width, stroke_fill, spacing)
+    blit(layer, sprite, (xy[0] + left, xy[1] + top))
+def draw_glyphs(layer, xy, text, font, fill, stroke_width=0, stroke_fill=None):
+    ''' Draw text one cached character at a time. For text that keeps
+        changing (e.g. times), where whole labels wouldn't be reused.
+        All the strokes go down first, then the characters, like ImageDraw.text does.
+
+        Param layer: RGBA image to draw on
+        Param xy: Where the text goes (same as ImageDraw.text)
+        (the rest are the same as label_sprite)
+    '''
+    pil_font = get_font(font)
+    positions = [xy[0] + pil_font.getlength(text[:i]) for i in range(len(text))]
+
+    passes = [(fill, 0, None)]
+    if stroke_width > 0:
+        passes.insert(0, (stroke_fill, stroke_width, stroke_fill)) #Stroke (filled with the stroke colour)
+
+    for colour, width, outline in passes:
+        for x, character in zip(positions, text):
+            if character.isspace():
+                continue
+            sprite, (left, top) = label_sprite(character, font, colour, width, outline)
+            blit(layer, sprite, (x + left, xy[1] + top))
+def blit(layer, sprite, xy):
+    ''' Alpha composite a sprite onto a layer (clipped to the layer).
+        Param layer: RGBA image (changed in place)
+        Param sprite: RGBA sprite
+        Param xy: (x,y) of the sprite's top left corner
+    '''
+    x, y = round(xy[0]), round(xy[1])
+    left, top = max(0, -x), max(0, -y)
+    right = min(sprite.width, layer.width - x)
+    bottom = min(sprite.height, layer.height - y)
+    if right <= left or bottom <= top:
+        return
+    layer.alpha_composite(sprite, dest=(x + left, y + top), source=(left, top, right, bottom))
+def get_cached(key):
+    with sprite_lock:
+        if key in sprite_cache:
+            sprite_cache.move_to_end(key)
+            return sprite_cache[key]
+    return None
+def set_cached(key, value):
+    with sprite_lock:
+        sprite_cache[key] = value
+        if len(sprite_cache) > MAX_SPRITES: #Forget the oldest sprite
+            sprite_cache.popitem(last=False)
+    return value
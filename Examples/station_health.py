@@ -0,0 +1,135 @@
+"""
+--------------------------------------------------
+  Weather Radar! --  Radar network health
+--------------------------------------------------
+
+The radar stations file has every WSR-88D & TDWR station in it. Instead of
+looking at just ours, this works out the latency & status (Up, Warning, Down)
+of all of them at once, as numpy arrays:
+
+    table = station_table(station_file, now)
+    table.status_name(table.find("KLGX"))
+    neighbour = nearest_healthy(table, lat, lon, station_type="WSR-88D", exclude=["KLGX"])
+
+The times are parsed without a Python loop too (as fixed-width text, straight
+into numpy datetimes), so the whole network takes about a millisecond.
+
+"""
+
+import numpy as np
+
+UP, WARNING, DOWN = 0, 1, 2
+STATUS_NAMES = np.array(["Up", "Warning", "Down"])
+UP_MINUTES = 10      #Latency under this is Up...
+WARNING_MINUTES = 60 #...under this is Warning, and anything more is Down
+EARTH_RADIUS = 6371  #km
+
+################################################
+#  FUNCTIONS!
+################################################
+class StationTable:
+    ''' Every radar station, as arrays. '''
+
+    def __init__(self, ids, names, types, lats, lons, latency, status, records):
+        self.ids = ids         #Upper case IDs
+        self.names = names
+        self.types = types     #"WSR-88D" or "TDWR"
+        self.lats = lats
+        self.lons = lons
+        self.latency = latency #Minutes since the last data was received (NaN if it's not known)
+        self.status = status   #UP, WARNING or DOWN
+        self.records = records #The station file records (for anything else)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def find(self, station):
+        ''' Returns the index of a station (or None) '''
+        index = np.flatnonzero(self.ids == station.upper())
+        return int(index[0]) if len(index) else None
+
+    def status_name(self, index):
+        ''' Returns "Up", "Warning" or "Down" '''
+        return str(STATUS_NAMES[self.status[index]])
+
+    def counts(self):
+        ''' Returns how many stations are up, warning & down '''
+        return dict(zip(STATUS_NAMES.tolist(), np.bincount(self.status, minlength=3).tolist()))
+
+def station_table(station_file, now):
+    ''' Work out the status of every station.
+        Param station_file: Radar stations JSON (from the Weather API)
+        Param now: Current time (timezone aware datetime)
+
+        Returns a StationTable
+    '''
+    records = station_file['features']
+    properties = [record['properties'] for record in records]
+    coordinates = np.array([(record.get('geometry') or {}).get('coordinates', [np.nan, np.nan])[:2] for record in records], dtype=np.float64).reshape(-1, 2) #(lon, lat)
+
+    received = received_times([(station.get('latency') or {}).get('levelTwoLastReceivedTime') for station in properties])
+    latency = (np.datetime64(int(now.timestamp()), 's') - received).astype(np.float64) / 60
+    latency[np.isnat(received)] = np.nan
+
+    return StationTable(
+        np.array([station['id'].upper() for station in properties]),
+        np.array([station.get('name') or "" for station in properties]),
+        np.array([station.get('stationType') or "" for station in properties]),
+        coordinates[:, 1],
+        coordinates[:, 0],
+        latency,
+        classify(latency),
+        records
+        )
+def received_times(times):
+    ''' Parse ISO 8601 times like 2024-05-01T12:34:56+00:00 (all at once).
+        Param times: List of strings (or None)
+
+        Returns a numpy datetime64[s] array in UTC (NaT where there isn't a time)
+    '''
+    text = np.array([time or "" for time in times], dtype="U32").reshape(-1)
+    result = np.full(len(text), np.datetime64("NaT"), dtype="datetime64[s]")
+    valid = np.char.str_len(text) >= 19
+    if not valid.any():
+        return result
+
+    local = text[valid].astype("U19").astype("datetime64[s]")
+
+    #Timezone offset (+HH:MM, +HHMM, or Z)
+    codes = text[valid].view(np.uint32).reshape(-1, 32).astype(np.int64)
+    digits = codes - ord("0")
+    sign = np.select([codes[:, 19] == ord("+"), codes[:, 19] == ord("-")], [1, -1], 0)
+    colon = codes[:, 22] == ord(":")
+    hours = digits[:, 20] * 10 + digits[:, 21]
+    minutes = np.where(colon, digits[:, 23] * 10 + digits[:, 24], digits[:, 22] * 10 + digits[:, 23])
+    offset = np.where(sign != 0, sign * (hours * 60 + minutes), 0)
+
+    result[valid] = local - offset.astype("timedelta64[m]")
+    return result
+def classify(latency):
+    ''' Returns the status (UP, WARNING, DOWN) for latencies in minutes (unknown is DOWN) '''
+    latency = np.maximum(latency, 0) #(A little clock difference can make it look like it's from the future)
+    return np.select([latency < UP_MINUTES, latency < WARNING_MINUTES], [UP, WARNING], DOWN).astype(np.int8)
+def distances(table, lat, lon):
+    ''' Returns the distance (km) from a point to every station '''
+    lat1, lon1 = np.radians(lat), np.radians(lon)
+    lat2, lon2 = np.radians(table.lats), np.radians(table.lons)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+def nearest_healthy(table, lat, lon, station_type=None, exclude=(), max_km=400):
+    ''' Find the closest station that's up.
+        Param table: StationTable
+        Param lat, lon: Where we are
+        Param station_type: Only this type of station (e.g. "WSR-88D", as they have different products)
+        Param exclude: Station IDs not to pick
+        Param max_km: Furthest away it can be
+
+        Returns the station's index (or None)
+    '''
+    distance = distances(table, lat, lon)
+    usable = (table.status == UP) & (distance <= max_km) & ~np.isin(table.ids, [station.upper() for station in exclude])
+    if station_type is not None:
+        usable &= table.types == station_type
+    if not usable.any():
+        return None
+    return int(np.flatnonzero(usable)[distance[usable].argmin()])
@@ -0,0 +1,92 @@
+"""
+--------------------------------------------------
+  Weather Radar! --  Task graph helper
+--------------------------------------------------
+
+A tiny helper for running a refresh as an asyncio task graph.
+
+Each stage is added with its inputs. If an input is another stage (a task),
+the stage waits for it, and gets its result instead. Stages that don't
+depend on each other run at the same time, so a refresh only takes as long
+as its slowest chain of stages.
+
+    graph = TaskGraph(pool)
+    times = graph.add('times', get_times, url)
+    frames = graph.add('frames', get_frames, times)   # waits for 'times'
+
+A stage that only needs some of its inputs later on can be given them as
+tasks (defer=), and wait for them itself:
+
+    frames = graph.add('frames', get_frames, times, alerts=alerts, defer=('alerts',))
+
+"""
+
+import time
+import asyncio
+
+
+class TaskGraph:
+    ''' A set of stages (asyncio tasks) and how long each one took. '''
+
+    def __init__(self, executor=None):
+        ''' Param executor: Thread pool for blocking functions (None = asyncio default) '''
+        self.executor = executor
+        self.tasks = {}
+        self.timings = {} #name -> (start, end) in time.monotonic() seconds
+
+    def add(self, name, function, *inputs, defer=(), **kw_inputs):
+        ''' Add a stage to the graph.
+            Param name: Name of the stage (for timings)
+            Param function: A coroutine function, or a normal (blocking) function
+                            which is run in the executor.
+            Param inputs, kw_inputs: Arguments. Tasks are waited for and replaced by their results.
+            Param defer: Names of keyword inputs to pass on as they are (tasks the stage waits for itself)
+
+            Returns the stage's task (to use as an input for other stages).
+        '''
+        if name in self.tasks:
+            raise ValueError(f"Stage '{name}' is already in the graph")
+
+        task = asyncio.ensure_future(self._run(name, function, inputs, kw_inputs, defer))
+        self.tasks[name] = task
+        return task
+
+    async def _run(self, name, function, inputs, kw_inputs, defer):
+        ''' Wait for a stage's inputs (apart from the deferred ones), then run it. '''
+        inputs = [await value if isinstance(value, asyncio.Future) else value for value in inputs]
+        kw_inputs = {key: await value if isinstance(value, asyncio.Future) and key not in defer else value for key, value in kw_inputs.items()}
+
+        start = time.monotonic()
+        try:
+            if asyncio.iscoroutinefunction(function):
+                return await function(*inputs, **kw_inputs)
+            else:
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(self.executor, lambda: function(*inputs, **kw_inputs))
+        finally:
+            self.timings[name] = (start, time.monotonic())
+
+    async def wait(self):
+        ''' Wait for every stage (including ones added while waiting).
+            If a stage fails, the other stages are cancelled and the error is raised.
+
+            Returns a dictionary of stage name -> result
+        '''
+        try:
+            while not all(task.done() for task in self.tasks.values()):
+                await asyncio.gather(*self.tasks.values())
+        except BaseException:
+            for task in self.tasks.values():
+                task.cancel()
+            raise
+
+        return {name: task.result() for name, task in self.tasks.items()}
+
+    def timeline(self):
+        ''' Returns (total seconds, stage timings sorted by when they started) '''
+        if not self.timings:
+            return 0, []
+        first = min(start for start, end in self.timings.values())
+        last = max(end for start, end in self.timings.values())
+        ordered = sorted(self.timings.items(), key=lambda item: item[1][0])
+        return last - first, [(name, start - first, end - start) for name, (start, end) in ordered]
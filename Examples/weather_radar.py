@@ -20,46 +20,82 @@ from datetime import datetime
 import pytz
 
 import os
+import shutil
 import json
 import math
-import requests
 import logging
-
-from PIL import Image, ImageDraw, ImageFont
+import pickle
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from PIL import Image, ImageDraw
 from io import BytesIO
 import xmltodict
 import geotiler
 import numpy as np
 
-#Adafruit & CircuitPython libraries
-import board
-import digitalio
-import adafruit_rgb_display.ili9341 as ili9341
-
 #Secrets! (openweather API & lat long coordinates)
 from secrets import secrets
+from task_graph import TaskGraph
+from net import fetch, fetch_map_tiles, start_deadline
+from export import export_all
+from sprites import text_length, label_sprite, pill_sprite, draw_label, draw_glyphs, blit
+from display import push_frame
+from nexrad import read_product, find_product, to_raster
+from motion import estimate_motion, arrival_eta
+from reflectivity import dbz_stack, sample, legend_matches
+from geojson_stream import Shapes, read_features
+from frame_history import FrameHistory, to_images, DATA_FILE
+from station_health import station_table, nearest_healthy, UP, DOWN
+import mbtiles
+from quality import QualityController
+from compositing import put_together, make_pool, SharedLayers, composite_async, composite_many
 
 CURR_DIR = f"{os.path.dirname(__file__)}/"
 
-cs_pin = digitalio.DigitalInOut(board.CE0)
-dc_pin = digitalio.DigitalInOut(board.D25)
-reset_pin = digitalio.DigitalInOut(board.D24)
 BAUDRATE = 24000000
-spi = board.SPI()
-disp = ili9341.ILI9341(
-    spi,
-    rotation=270,
-    cs=cs_pin,
-    dc=dc_pin,
-    rst=reset_pin,
-    baudrate=BAUDRATE,
-)
+FRAMEBUFFER = secrets.get('framebuffer') #e.g. /dev/fb0 for an HDMI/DSI panel (None = the ILI9341 on SPI)
+FRAMEBUFFER_SCALE = secrets.get('framebuffer_scale') or 1 #Make the frames this many times bigger on the panel
+disp = None #The display (made the first time something's shown, or set it to e.g. display.MockDisplay first)
+shown = None #What's on the display (so only the parts that change get sent)
+
+def make_display():
+    ''' Set up the display (the ILI9341, or a framebuffer). '''
+    if FRAMEBUFFER:
+        from framebuffer import Framebuffer
+        return Framebuffer(FRAMEBUFFER, scale=FRAMEBUFFER_SCALE)
+
+    #Adafruit & CircuitPython libraries
+    import board
+    import digitalio
+    import adafruit_rgb_display.ili9341 as ili9341
+
+    cs_pin = digitalio.DigitalInOut(board.CE0)
+    dc_pin = digitalio.DigitalInOut(board.D25)
+    reset_pin = digitalio.DigitalInOut(board.D24)
+    spi = board.SPI()
+    return ili9341.ILI9341(
+        spi,
+        rotation=270,
+        cs=cs_pin,
+        dc=dc_pin,
+        rst=reset_pin,
+        baudrate=BAUDRATE,
+    )
+def show(image):
+    ''' Put an image on the display (only sending what changed since the last one). '''
+    global disp, shown
+    if disp is None:
+        disp = make_display()
+    shown = push_frame(disp, image, shown)
 
 print("\n************************************\n*  WEATHER RADAR by Thornhill!     *\n************************************")
 
-# Open and display the loading screen!
+# The loading screen!
 loading = Image.open(f"{CURR_DIR}loading.png")
-disp.image(loading)
 
 ################################################
 # Get nearest station based on Lat Long
@@ -77,6 +113,7 @@ def get_station_data(station_param=None):
     global station_mode
     global station_status
     global latency
+    global network_status
 
     ######################
     # Get the station ID #
@@ -89,13 +126,9 @@ def get_station_data(station_param=None):
     ################################
     # Get radar stations JSON file #
     ################################
-    stations_url = "https://api.weather.gov/radar/stations?stationType=WSR-88D,TDWR"
+    stations_url = f"{NWS_URL}/radar/stations?stationType=WSR-88D,TDWR"
 
-    try:
-        response = requests.get(stations_url, headers=headers, timeout=20)
-    except:
-        print("Connection Problems: Getting radar station data")
-        response = False
+    response = fetch(stations_url, headers=headers, timeout=20, name="radar station data")
 
     if response:
         station_file = response.json()
@@ -104,62 +137,50 @@ def get_station_data(station_param=None):
         station_status = f"{response}"
         return station_status
 
-    ################################
-    # Get the current time (in UTC) #
-    ################################
-    UTC = pytz.utc
-    datetime_utc = datetime.now(UTC)
+    #############################################
+    # Latency & status of every station at once #
+    #############################################
+    #(One numpy pass over the whole network, see station_health.py)
+    network_status = station_table(station_file, datetime.now(pytz.utc))
+    print(f"- Network: {network_status.counts()}")
 
     #########################################
     # Pull the data we need for our station #
     #########################################
-    for record in station_file['features']:
-        if record['properties']['id'] == station.upper(): #If the ID matches
-            station_name = record['properties']['name']
-            station_mode = record['properties']['rda']['properties']['volumeCoveragePattern'] #Mode of the station (e.g. R35, R21)
+    index = network_status.find(station)
+    if index is not None:
+        record = network_status.records[index]
+        station_name = record['properties']['name']
+        station_mode = ((record['properties'].get('rda') or {}).get('properties') or {}).get('volumeCoveragePattern', "---") #Mode of the station (e.g. R35, R21)
 
-            #Check the status of the station by looking at the last received time.
-            latency_time = datetime.strptime(record['properties']['latency']['levelTwoLastReceivedTime'],'%Y-%m-%dT%H:%M:%S%z')
-            diff_time = datetime_utc - latency_time
+        #Check the status of the station by looking at the last received time.
+        station_status = network_status.status_name(index)
+        latency = round(float(network_status.latency[index]),1)
 
-            if diff_time.days > 0: #If greater than 1 day, then it's definitely down
-                station_status = "Down"
-            else:
-                if diff_time.seconds < (60*10): #Less than 10 mins, it's probably up!
-                    station_status = "Up"
-                elif diff_time.seconds > (60*10) and diff_time.seconds < (60*60): #Between 10 mins & 60, warning!
-                    station_status = "Warning"
-                else: #Otherwise, yeah, it's down
-                    station_status = "Down"
-
-            latency = round(diff_time.seconds/60,1)
-
-            print(f"\n----------------------\nStation: {station.upper()} ({station_name})\n----------------------")
-            print(f"- Mode: {station_mode}")
-            print(f"- Status: {station_status} (Last received: {latency} minutes ago)")
+        print(f"\n----------------------\nStation: {station.upper()} ({station_name})\n----------------------")
+        print(f"- Mode: {station_mode}")
+        print(f"- Status: {station_status} (Last received: {latency} minutes ago)")
 
     return station_status
-def location_to_station():
+def location_to_station(fallback=True):
     ''' Get the ID of the nearest radar station from lat long coordinates.
         Also nearest population centre, state, time zone, and forecast URLs
+        Param fallback: Use the station in secrets.py if it doesn't work
 
-        Returns the station code! (must be lowercase)
+        Returns the station code! (must be lowercase) or None if it didn't work (and there's no fallback)
     '''
     global station
     global forecast_url
     global forecast_grid_url
     global timeZone
+    global located
 
     ######################################
     # Try to get the lat long point file #
     ######################################
-    point_url = f"https://api.weather.gov/points/{lat_long[0]},{lat_long[1]}"
+    point_url = f"{NWS_URL}/points/{lat_long[0]},{lat_long[1]}"
 
-    try:
-        response = requests.get(point_url, headers=headers, timeout=5)
-    except:
-        print("Connection Problems getting Lat/Long point data!")
-        response = False
+    response = fetch(point_url, headers=headers, timeout=5, name="Lat/Long point data")
 
     if response:
         point_file = json.load(BytesIO(response.content))
@@ -170,10 +191,13 @@ def location_to_station():
         location_state = point_file['relativeLocation']['properties']['state']
         timeZone = point_file['timeZone']
         forecast_url = point_file['forecast']
+        located = True
 
         print(f"{location_city} ({location_state}) -- {station.upper()} -- {timeZone}")
     else:
         print(f"Unable to get location or radar ({response})")
+        if not fallback or not secrets.get("station"):
+            return None
         get_station_data(secrets["station"]) #Use a fallback if it doesn't work!
 
     return station
@@ -188,11 +212,7 @@ def get_bounding_coordinates(url):
     ################################
     # Get the GetCapabilities file #
     ################################
-    try:
-        response = requests.get(url, headers=headers, timeout=5 )
-    except:
-        print("Connection Problems: Getting Bounding coordinates")
-        response = False
+    response = fetch(url, headers=headers, timeout=5, name="Bounding coordinates")
 
     ################################
     # Get the bounding coordinates #
@@ -213,19 +233,32 @@ def get_bounding_coordinates(url):
 
 lat_long = secrets['coordinates']
 headers = secrets['header']
-layer = 'bohp'
+timeZone = 'UTC' #Our time zone (until location_to_station() finds it)
+located = False #Whether location_to_station() has found us (otherwise we're on the station in secrets.py, with UTC times)
 
-location_to_station()
+################################################
+# Servers (can be changed, e.g. for a local mirror, or soak.py)
+################################################
+NWS_URL = secrets.get('nws_url') or "https://api.weather.gov"
+OPENGEO_URL = secrets.get('opengeo_url') or "https://opengeo.ncep.noaa.gov"
+BASEMAP = secrets.get('basemap') or 'stamen-toner' #GeoTiler provider, a tile url like http://host/{z}/{x}/{y}.png, or an .mbtiles file (see mbtiles.py)
+BASEMAP_LABELS = secrets.get('basemap_labels') or 'stamen-toner-labels'
+RADAR_LAYERS = secrets.get('layers') or ['bohp'] #Radar products to keep ready (switch between them with switch_layer())
+layer = RADAR_LAYERS[0] #Radar product being shown
 
 ################################################
 # XML & JSON urls
 ################################################
-capabilities_url = f'https://opengeo.ncep.noaa.gov:443/geoserver/{station}/{station}_{layer}/wms?SERVICE=WMS&VERSION=1.3.0&REQUEST=GetCapabilities'
-warnings_capabilities_url = "https://opengeo.ncep.noaa.gov/geoserver/wwa/warnings/ows?service=wms&version=1.3.0&request=GetCapabilities"
-alert_capabilities_url = "https://opengeo.ncep.noaa.gov/geoserver/wwa/hazards/ows?service=wms&version=1.3.0&request=GetCapabilities"
+warnings_capabilities_url = f"{OPENGEO_URL}/geoserver/wwa/warnings/ows?service=wms&version=1.3.0&request=GetCapabilities"
+alert_capabilities_url = f"{OPENGEO_URL}/geoserver/wwa/hazards/ows?service=wms&version=1.3.0&request=GetCapabilities"
 
-#Get the SW and NE coordinates from the WMS GetCapabilities file
-minx, miny, maxx, maxy = get_bounding_coordinates(capabilities_url)
+################################################
+# Saved state (for warm starts)
+################################################
+STATE_FILE = f"{CURR_DIR}radar_state.pickle"
+STATE_VERSION = 2 #(2: alert polygons are Shapes)
+basemap_cache = {} #(provider, zoom, size, extent) -> (basemap, basemap labels)
+circle_overlay = None #Loaded by get_circle_overlay()
 
 ################################################
 # WMS settings
@@ -238,156 +271,397 @@ EPSG = 4326
 SRS = f"EPSG%3A{EPSG}"
 EXCEPTION = "application/vnd.ogc.se_inimage"
 
+################################################
+# Radar tiles (same XYZ grid as the basemap)
+################################################
+TILE_SIZE = 256
+MAX_CACHED_TILES = 150 * len(RADAR_LAYERS) #A refresh's worth for each product (about 40MB of RGBA tiles each)
+radar_tile_cache = OrderedDict() #(station, layer, TIME, z, x, y) -> RGBA array
+radar_tile_lock = threading.Lock() #Frames are downloaded at the same time
+LEVEL3_DIR = secrets.get('level3_dir') #Mirrored NEXRAD Level III files (see nexrad.py), used instead of the WMS if they're there
+
+################################################
+# Radar products (layers)
+################################################
+layer_cache = (None, None, {}) #From the last refresh: (map, overlays, {layer: OrderedDict of key -> (time_datetime, radar image)})
+dbz_stacks = {} #layer -> (radar images they're from, times, dBZ stack), see sample_radar()
+SAMPLE_LAYER = 'bref_raw' #Product to sample reflectivity from
+REFLECTIVITY_LAYERS = ['bref_raw'] #Products drawn with the reflectivity legend (the only ones that can be turned back into dBZ)
+legend_checks = {} #(station, layer) -> whether its legend matches our palette (checked once, see sample_radar())
+next_layer = None #Product to switch to at the end of the loop (see switch_layer())
+
+################################################
+# Refresh graph
+################################################
+AREA_HAZARDS = ["Storm","Extreme Wind","High Wind","Gale Warning","Blizzard","Hurricane","Tropical","Winter Storm"]
+network_pool = ThreadPoolExecutor(max_workers=8) #Requests that can run at the same time
+REFRESH_BUDGET = 90 #Seconds. Whatever isn't downloaded by then is skipped (see net.py)
+QUALITY_BUDGET = secrets.get('quality_budget') or 60 #Seconds. Slower refreshes turn the quality down (see quality.py)
+quality = QualityController(QUALITY_BUDGET)
+COMPOSITE_WORKERS = 0 if (os.cpu_count() or 1) < 2 else min(4, os.cpu_count()) #Processes to put frames together in (0 = in the refresh threads, e.g. on one core, see compositing.py)
+compositing_pool = None #Started by start_compositing()
+
+################################################
+# Animated exports (GIF/APNG/WebP, see export.py)
+################################################
+EXPORT_DIR = secrets.get('export_dir') #Folder to save the loop to after every refresh (None = don't)
+EXPORT_FORMATS = ("gif", "png", "webp")
+
+################################################
+# Radar network (see station_health.py)
+################################################
+network_status = None #StationTable of every station, from the last refresh
+home_station = None #Our station (a neighbouring one is used while it's down)
+NEIGHBOUR_KM = 400 #Furthest away a neighbouring station can be
+NEIGHBOUR_TRIES = 3 #Neighbours to try (nearest first) before giving up on switching
+NETWORK_ZOOM = 5 #Zoom of the network status map
+STATUS_COLOURS = [(0,170,0,255), (240,170,0,255), (210,0,0,255)] #Up, Warning, Down
+
+################################################
+# Frame history (see frame_history.py)
+################################################
+HISTORY_DIR = secrets.get('history_dir') #Folder to keep old frames & radar images in, to scrub back through later (None = don't)
+HISTORY_MB = 1024 #Disk space for all of it (split between the stations, the frames & each product). The oldest go first.
+HISTORY_STATIONS = 2 #Stations to keep history for (ours, and the neighbour being used while it's down)
+histories = {} #(station, 'frames' or product) -> FrameHistory (opened the first time they're needed)
+
+################################################
+# Animation
+################################################
+FRAME_DURATION = 750 #Milliseconds per frame (frames are sent as partial updates, see display.py)
+
+################################################
+# Storm motion (see motion.py)
+################################################
+MOTION_BLOCK_SIZE = 80 #Pixels per block (None = one motion for the whole map)
+storm_motion = None #From the last refresh
+storm_eta = None #Minutes until precipitation reaches the marker (None if nothing's heading for it)
+
 ################################################
 # Fonts!
 ################################################
 
-fnt_medium = ImageFont.truetype(f"{CURR_DIR}HelveticaNeue.ttf", 15)
-fnt_goth = ImageFont.truetype(f"{CURR_DIR}CenturyGothic.ttf", 20)
-fnt_goth_bold = ImageFont.truetype(f"{CURR_DIR}CenturyGothic-Bold.ttf", 20)
-fnt_goth_medium = ImageFont.truetype(f"{CURR_DIR}CenturyGothic.ttf", 15)
+# (file, size) -- loaded the first time they're used (see sprites.py)
+fnt = (f"{CURR_DIR}CenturyGothic-Bold.ttf", 20)
+fnt_small = (f"{CURR_DIR}HelveticaNeue.ttf", 12)
+fnt_medium = (f"{CURR_DIR}HelveticaNeue.ttf", 15)
+fnt_goth = (f"{CURR_DIR}CenturyGothic.ttf", 20)
+fnt_goth_bold = (f"{CURR_DIR}CenturyGothic-Bold.ttf", 20)
+fnt_goth_medium = (f"{CURR_DIR}CenturyGothic.ttf", 15)
 
 
 ################################################
 #  FUNCTIONS!
 ################################################
-def get_radar_images(base_map_layer='stamen-toner',layer=None, zoom=None, show_alerts=True, warnings_list=[],hazard_list=[], frames=None):
+async def get_radar_images(base_map_layer=BASEMAP,layer=None, zoom=None, show_alerts=True, warnings_list=[],hazard_list=[], local_alerts=([],[]), local_warnings=[], station_status=None, frames=None, radar_zoom_out=0, graph=None):
     ''' Get and make a list of radar images.
+        Every input can also be a task from the refresh graph. Each frame starts
+        downloading as soon as the radar times are known, and is put together as
+        soon as its own radar image, the basemap and the alerts are ready.
 
         Param base_map_layer (str): basemap layer to use (see geotiler library for map providers)
-        Param layer (str): Radar layer to disp
+        Param layer (str): Radar layer to display (the other RADAR_LAYERS are downloaded too, to switch to later)
         Param zoom (int): Zoom level for the basemap
         Param show_alerts: True/False show hazard polygons
         Param warnings_list: A list of warnings
         Param hazard_list: A list of hazards
+        Param local_alerts: Local (hazards, unique hazards)
+        Param local_warnings: A list of local warnings
+        Param station_status: Station status (used to work out the number of frames)
         Param frames: Number of frames
+        Param radar_zoom_out: Radar image resolution (0 = full, 1 = half, see get_radar_frame())
+        Param graph: TaskGraph to add the stages to
 
         Returns a list of PIL images.
     '''
+    global layer_cache
+
+    if graph is None:
+        graph = TaskGraph(network_pool)
+    layers = [layer] + [name for name in RADAR_LAYERS if name != layer]
+    old_rasters = layer_cache[2]
+    rasters = {name: OrderedDict() for name in layers}
+
     ########################################
     # Make and get a basemap! (and labels) #
     ########################################
-    base_map, base_map_labels, map = get_basemap("coordinate",provider=base_map_layer,zoom=zoom,width=320)
-    size = map.size
-    minx, miny, maxx, maxy = map.extent
-
-    print(f"\n----------------------\nNew radar images @ zoom {zoom}:\n----------------------")
+    map, map_labels = get_maps("coordinate",provider=base_map_layer,zoom=zoom,width=320)
+    basemap = graph.add('basemap', render_basemap, map, map_labels, base_map_layer)
 
     ###################################################
     # Get layer times (from WMS GetCapabilities file) #
     ###################################################
-    times, times_datetime = get_times(capabilities_url)
+    times_tasks = {name: graph.add(f'radar times {name}', get_times, layer_capabilities_url(name)) for name in layers}
 
-    ##################
-    # List of frames #
-    ##################
-    if frames == None:
-        if station_mode in ["R30", "R31", "R32", "R35", "---"]: #Less frames when in clean air mode.
-            num_frames = 5
-        else:
-            num_frames = 10
-    else:
-        num_frames = frames
-    #Sometimes there's less times than the number of frames...
-    if len(times) < num_frames:
-        num_frames = len(times)
-    else:
-        pass
+    ###################################################
+    # Layers that are the same for every frame        #
+    ###################################################
+    overlays = graph.add('overlays', make_overlay_layers, map, basemap, warnings_list, hazard_list, local_alerts, local_warnings, show_alerts)
 
-    #Make a list of frames
-    prev_images =[*range(0, num_frames, 1)] #e.g. [0,1,2,3]
-    prev_times = [*range(int(num_frames/-1),0, 1)] #e.g. [-1,-2,-3,-4]
-    image_list = []
+    print(f"\n----------------------\nNew radar images @ zoom {zoom}:\n----------------------")
 
     #######################################
     # Go through and construct each frame #
     #######################################
-    for i,image in enumerate(prev_images):
-
-        ###########################
-        # Get latest radar images #
-        ###########################
-        TIME = times[prev_times[i]]
-        TIME_for_url = TIME.replace(':','%3A')
-        bbox=f'{miny}%2C{minx}%2C{maxy}%2C{maxx}'
-
-        radar_url = f"https://opengeo.ncep.noaa.gov:443/geoserver/{station}/ows?SERVICE=WMS&service=WMS&version=1.3.0&request=GetMap&layers={station}_{layer}&styles=&width={size[0]}&height={size[1]}&crs={SRS}&bbox={bbox}&format={format}&transparent={transparent}&bgcolor={bg_colour}&exceptions={EXCEPTION}&time={TIME_for_url}"
-
-        try: #Try to get the radar image
-            response_radar = requests.get(radar_url, headers=headers, timeout=10)
-        except requests.exceptions.ConnectionError:
-            print("Connection problems")
-            time.sleep(5)
-            continue
+    async def get_radar(name, TIME, time_datetime):
+        # Radar images never change, so reuse the ones from the last refresh
+        key = (station, tuple(map.extent), tuple(map.size), TIME, radar_zoom_out)
+        if key in old_rasters.get(name, {}):
+            radar = old_rasters[name][key][1]
+        else:
+            radar = await graph.add(f'radar {name} {TIME}', get_radar_frame, map, station, name, TIME, radar_zoom_out)
+        if radar is not None:
+            rasters[name][key] = (time_datetime, radar)
+        return radar
 
-        if response_radar: #If we can get a radar image
-            radar = Image.open(BytesIO(response_radar.content))
-        else: #or if we can't
-            print(f"\tCouldn't get radar image! ({response_radar})")
-            continue
+    async def make_frame(TIME, time_datetime):
+        radar = await get_radar(layer, TIME, time_datetime)
+        if radar is None:
+            print(f"\tCouldn't get radar image! ({TIME})")
+            return None
 
         # Is the radar image blank?
-        extrema = radar.convert("L").getextrema() #Extrema reports the min & max colour values.
-        if extrema == (255,255): #If blank
-            print(f"Radar image{image}: {TIME} UTC  (blank image)")
-            continue #If it's blank, skip it!
+        if is_blank(radar): #If blank
+            print(f"Radar image: {TIME} UTC  (blank image)")
+            return None #If it's blank, skip it!
         else:
-            print(f"Radar image{image}: {TIME} UTC")
-            pass
+            print(f"Radar image: {TIME} UTC")
 
-        combined = base_map
-        combined_width, combined_height = combined.width,combined.height
+        return await graph.add(f'composite {TIME}', composite_shared, radar, overlays, shared, time_datetime)
 
-        ################
-        #   Warnings   #
-        ################
-        if len(warnings_list) > 0:
-            warning_layer = Image.new('RGBA',combined.size,(255,0,0,0))
-            combined_warning_annotation = ImageDraw.Draw(warning_layer)
-
-            #Make warning polygons & labels
-            for warning in warnings_list:
-                polygon = warning[2]
-                polygons_pixels = []
-
-                for points in polygon:
-                    pixel_x, pixel_y = map.rev_geocode((points[0],points[1]))
-                    pixel_x, pixel_y = round(pixel_x),round(pixel_y)
-                    polygons_pixels.append((pixel_x, pixel_y))
-
-                polygon = polygons_pixels
-
-                # Distinguish between watches & warnings (Warnings are more dangerous)
-                if "Warning" in warning[0]:
-                    stroke_colour = (255,0,0,255)
-                    font_colour = (255,0,0,255)
-                    opacity = 255
-                    text = "!!!"
-                else:
-                    stroke_colour = (255,255,0,255)
-                    font_colour = (0,0,0,255)
-                    opacity = 170
-                    text = ""
-
-                #Colours for different types
-                if "Marine" in warning[0]:
-                    fill_colour = (0,228,255,opacity)
-                elif "Thunderstorm" in warning[0]:
-                    fill_colour = (255,255,0,opacity)
-                elif "Tornado" in warning[0]:
-                    fill_colour = (196,0,0,opacity)
-                else:
-                    fill_colour = (255,255,255,opacity)
-
-                #Make the polygon
-                combined_warning_annotation.polygon(
-                    polygon,
-                    fill=fill_colour,
-                    outline=stroke_colour)
-                #Find the center of the polygon
-                poly_center = centroid(polygon)
-                #Add text to the center of the polygon
-                combined_warning_annotation.text(
+    async def other_product(name, newest, oldest):
+        # Another product's radar images (from `newest` to `oldest` frames back), to switch to later
+        product_times, product_datetimes = await times_tasks[name]
+        if product_times[0] is None:
+            return
+        count = len(product_times)
+        await asyncio.gather(*[get_radar(name, product_times[i], product_datetimes[i]) for i in range(max(0, count - oldest), count - newest)])
+
+    times, times_datetime = await times_tasks[layer]
+    if times[0] is None: #Couldn't get the GetCapabilities file
+        return []
+
+    ##################
+    # List of frames #
+    ##################
+    #The newest few frames are always needed, so start them straight away.
+    #The older ones wait until we know the station mode.
+    num_frames = 5
+    if frames != None:
+        num_frames = frames
+    num_frames = min(num_frames, len(times)) #Sometimes there's less times than the number of frames...
+
+    shared = graph.add('shared layers', share_layers, overlays) #(Copied into shared memory once, for the compositing processes)
+    frame_tasks = [asyncio.ensure_future(make_frame(times[i], times_datetime[i])) for i in range(len(times) - num_frames, len(times))]
+    product_tasks = [asyncio.ensure_future(other_product(name, 0, num_frames)) for name in layers[1:]]
+
+    if frames == None:
+        if isinstance(station_status, asyncio.Future):
+            await station_status
+        if station_mode not in ["R30", "R31", "R32", "R35", "---"]: #Less frames when in clean air mode.
+            extra_frames = min(10, len(times)) - num_frames
+            older = range(len(times) - num_frames - extra_frames, len(times) - num_frames)
+            frame_tasks = [asyncio.ensure_future(make_frame(times[i], times_datetime[i])) for i in older] + frame_tasks
+            product_tasks += [asyncio.ensure_future(other_product(name, num_frames, num_frames + extra_frames)) for name in layers[1:]]
+
+    try:
+        image_list = [frame for frame in await asyncio.gather(*frame_tasks) if frame is not None]
+        await asyncio.gather(*product_tasks)
+    finally:
+        if shared.done() and not shared.cancelled() and shared.exception() is None and shared.result() is not None:
+            shared.result().close()
+    print("Done!")
+
+    #Keep this refresh's radar images (oldest first), so switching products doesn't download anything
+    layer_cache = (map, await overlays, {name: OrderedDict(sorted(product.items(), key=lambda item: item[1][0])) for name, product in rasters.items()})
+
+    return image_list
+def is_blank(radar):
+    ''' Returns True if a radar image has nothing on it '''
+    return radar.convert("L").getextrema() == (255,255) #Extrema reports the min & max colour values.
+def layer_capabilities_url(name, station_id=None):
+    ''' Returns the WMS GetCapabilities url for one of the station's radar layers (None = the station being used) '''
+    if station_id is None:
+        station_id = station
+    return f'{OPENGEO_URL}/geoserver/{station_id}/{station_id}_{name}/wms?SERVICE=WMS&VERSION=1.3.0&REQUEST=GetCapabilities'
+def switch_layer(name):
+    ''' Ask for a different radar product (e.g. from a button, in another thread).
+        It's switched to when the loop that's playing finishes.
+        Param name: One of RADAR_LAYERS
+    '''
+    global next_layer
+    next_layer = name
+def use_layer(name):
+    ''' Switch the radar product that's shown. Only the radar images from the
+        last refresh are put back together (nothing is downloaded).
+        Param name: One of RADAR_LAYERS
+
+        Returns the new frames (or None if we don't have that product)
+    '''
+    global layer, next_layer
+
+    next_layer = None
+    map, overlays, rasters = layer_cache
+    if overlays is None or not rasters.get(name):
+        print(f"No {name} radar images to switch to")
+        return None
+
+    frames = composite_frames([(time_datetime, radar) for time_datetime, radar in rasters[name].values() if not is_blank(radar)], overlays)
+    if not frames:
+        print(f"The {name} radar images are blank")
+        return None
+
+    print(f"Showing {name}")
+    layer = name
+    return frames
+def sample_radar(lats, lons, name=None):
+    ''' Get the reflectivity at lots of points, in every frame from the last refresh.
+        Param lats, lons: Coordinates of the points (lists or numpy arrays)
+        Param name: Radar product (None = SAMPLE_LAYER). Must be one of REFLECTIVITY_LAYERS.
+
+        Returns the frame times (UTC datetimes), and a (frames, points) array of dBZ (NaN = no echo, or off the map)
+        (No frames if the product wasn't downloaded, or None if its legend doesn't match our palette)
+    '''
+    map, overlays, rasters = layer_cache
+    if name is None:
+        name = SAMPLE_LAYER
+    if name not in REFLECTIVITY_LAYERS:
+        raise ValueError(f"{name} isn't a reflectivity product (it has no dBZ legend)")
+    if not check_legend(name):
+        return None
+    product = rasters.get(name)
+    if not product:
+        return [], np.full((0, np.size(lats)), np.nan, dtype=np.float32)
+
+    #Decode the frames once (until the next refresh)
+    if name not in dbz_stacks or dbz_stacks[name][0] is not product:
+        times = [time_datetime for time_datetime, radar in product.values()]
+        dbz_stacks[name] = (product, times, dbz_stack([radar for time_datetime, radar in product.values()]))
+    product, times, stack = dbz_stacks[name]
+
+    #Where the points are on the map (same projection as the radar tiles)
+    x, y = global_pixel(np.asarray(lons, dtype=float), np.asarray(lats, dtype=float), map.zoom)
+    origin_x, origin_y = map_origin(map)
+    rows = np.floor(y - origin_y).astype(int)
+    cols = np.floor(x - origin_x).astype(int)
+
+    return times, sample(stack, rows, cols)
+def check_legend(name):
+    ''' Check (once for each station) that a layer's legend is the palette to_dbz() uses.
+        Param name: Radar product
+
+        Returns True if it matches (False if it doesn't, or if the legend can't be downloaded. That's tried again next time)
+    '''
+    key = (station, name)
+    if key not in legend_checks:
+        legend_url = f'{OPENGEO_URL}/geoserver/{station}/{station}_{name}/ows?SERVICE=WMS&VERSION=1.3.0&REQUEST=GetLegendGraphic&FORMAT=image/png&LAYER={station}_{name}'
+        response = fetch(legend_url, headers=headers, timeout=5, name=f"{name} legend")
+        if not response:
+            return False
+        try:
+            legend_checks[key] = legend_matches(Image.open(BytesIO(response.content)))
+        except OSError: #Not an image
+            return False
+        if not legend_checks[key]:
+            print(f"The {name} legend doesn't match the reflectivity palette (so it can't be sampled)")
+    return legend_checks[key]
+def map_pixels(map, coordinates):
+    ''' Convert lon/lat coordinates to map pixels, all at once (same as map.rev_geocode).
+        Param map: GeoTiler map construct
+        Param coordinates: (points, 2) array of lon/lat
+
+        Returns a (points, 2) array of rounded (x,y) pixels
+    '''
+    center_x, center_y = global_pixel(map.center[0], map.center[1], map.zoom)
+    map_x, map_y = map.rev_geocode(map.center)
+    x, y = global_pixel(coordinates[:, 0], coordinates[:, 1], map.zoom)
+    return np.rint(np.stack([x - (center_x - map_x), y - (center_y - map_y)], axis=1)).astype(int)
+def draw_shape(layer, draw, shape, pixels, fill, outline):
+    ''' Draw every polygon of an alert. Holes are left empty.
+        Param layer: Layer being drawn on
+        Param draw: ImageDraw for the layer
+        Param shape: Shapes for the alert (see geojson_stream.py)
+        Param pixels: The shape's coordinates in map pixels (from map_pixels())
+        Param fill, outline: RGBA colours
+    '''
+    pixel_shape = Shapes(pixels, shape.ring_offsets, shape.polygon_offsets, shape.feature_offsets)
+    for polygon in pixel_shape.polygons():
+        rings = [ring.ravel().tolist() for ring in polygon if len(ring) >= 3]
+        if len(rings) == 0:
+            continue
+        if len(rings) == 1:
+            draw.polygon(rings[0], fill=fill, outline=outline)
+            continue
+
+        # Polygon with holes: fill through a mask, then outline every ring
+        mask = Image.new('L', layer.size, 0)
+        mask_draw = ImageDraw.Draw(mask)
+        mask_draw.polygon(rings[0], fill=255)
+        for hole in rings[1:]:
+            mask_draw.polygon(hole, fill=0)
+        layer.paste(fill, mask=mask)
+        for ring in rings:
+            draw.polygon(ring, outline=outline)
+def make_overlay_layers(map, basemap, warnings_list, hazard_list, local_alerts, local_warnings, show_alerts=True):
+    ''' Make the layers that are the same for every frame (basemap, alerts, marker, ring and labels).
+        Param map: GeoTiler map construct
+        Param basemap: (basemap, basemap labels)
+        Param warnings_list: A list of warnings
+        Param hazard_list: A list of hazards
+        Param local_alerts: Local (hazards, unique hazards)
+        Param local_warnings: A list of local warnings
+        Param show_alerts: True/False show hazard polygons
+
+        Returns a dictionary with the 'below' (under the radar) and 'above' (over the radar) layers.
+    '''
+    base_map, base_map_labels = basemap
+    size = base_map.size
+
+    ################
+    #   Warnings   #
+    ################
+    warning_fill_colour = (0,0,0,0)
+    warning_layer = Image.new('RGBA',size,(255,0,0,0))
+    if len(warnings_list) > 0:
+        combined_warning_annotation = ImageDraw.Draw(warning_layer)
+
+        #Make warning polygons & labels
+        for warning in warnings_list:
+            shape = warning[2]
+            pixels = map_pixels(map, shape.coordinates) #All the points at once
+
+            # Distinguish between watches & warnings (Warnings are more dangerous)
+            if "Warning" in warning[0]:
+                stroke_colour = (255,0,0,255)
+                font_colour = (255,0,0,255)
+                opacity = 255
+                text = "!!!"
+            else:
+                stroke_colour = (255,255,0,255)
+                font_colour = (0,0,0,255)
+                opacity = 170
+                text = ""
+
+            #Colours for different types
+            if "Marine" in warning[0]:
+                fill_colour = (0,228,255,opacity)
+            elif "Thunderstorm" in warning[0]:
+                fill_colour = (255,255,0,opacity)
+            elif "Tornado" in warning[0]:
+                fill_colour = (196,0,0,opacity)
+            else:
+                fill_colour = (255,255,255,opacity)
+
+            #Make the polygons
+            draw_shape(warning_layer, combined_warning_annotation, shape, pixels, fill_colour, stroke_colour)
+            if len(shape.ring_offsets) < 2:
+                continue
+            #Find the center of the (first) polygon
+            poly_center = centroid(pixels[shape.ring_offsets[0]:shape.ring_offsets[1]])
+            #Add text to the center of the polygon
+            if text != "":
+                draw_label(
+                    warning_layer,
                     poly_center,
                     text,
                     font=fnt,
@@ -396,276 +670,379 @@ def get_radar_images(base_map_layer='stamen-toner',layer=None, zoom=None, show_a
                     stroke_fill=(255,255,255,200)
                     )
 
-            # Warning fill colour for a decorative ring border (see Times, Decoration)
-            if "Tornado Warning" in [elem for sublist in warnings_list for elem in sublist]:
-                warning_fill_colour = (255,0,0,255)
-            elif "Tornado Watch" in [elem for sublist in warnings_list for elem in sublist]:
-                warning_fill_colour = (255,174,0,255)
-            elif "Severe Thunderstorm Warning" in [elem for sublist in warnings_list for elem in sublist]:
-                warning_fill_colour = (255,255,0,255)
-            elif "Severe Thunderstorm Watch" in [elem for sublist in warnings_list for elem in sublist]:
-                warning_fill_colour = (255,255,0,150)
+        # Warning fill colour for a decorative ring border (see Times, Decoration)
+        if "Tornado Warning" in [elem for sublist in warnings_list for elem in sublist]:
+            warning_fill_colour = (255,0,0,255)
+        elif "Tornado Watch" in [elem for sublist in warnings_list for elem in sublist]:
+            warning_fill_colour = (255,174,0,255)
+        elif "Severe Thunderstorm Warning" in [elem for sublist in warnings_list for elem in sublist]:
+            warning_fill_colour = (255,255,0,255)
+        elif "Severe Thunderstorm Watch" in [elem for sublist in warnings_list for elem in sublist]:
+            warning_fill_colour = (255,255,0,150)
+
+    ######################
+    #   Alerts/Hazards   #
+    ######################
+    hazard_layer = Image.new('RGBA',size,(255,0,0,0))
+    if show_alerts and len(hazard_list) > 0:
+        combined_hazard = ImageDraw.Draw(hazard_layer)
+
+        # Make hazard polygons & labels
+        for hazard in hazard_list[0]:
+            hazard_type = hazard[0]
+            hazard_onset = hazard[1]    #Onset of hazard
+            polygon_hazard = hazard[2]  #Polygons (Shapes)
+            hazard_ends = hazard[3]     #End/expiration of hazard
+
+            # Convert polygon lat,long coordinates into pixel coordinates
+            polygon_hazard_pixels = map_pixels(map, polygon_hazard.coordinates)
+
+            #Styles to distinguish between watches & warnings
+            if "Warning" in hazard_type:
+                stroke_colour = (255,0,0,255) #Red
+                font_colour = (255,0,0,255)
             else:
-                fill_colour = (0,0,0,0)
-
-        ######################
-        #   Alerts/Hazards   #
-        ######################
-        if show_alerts:
-            # If there's hazards, make a hazard layer
-            if len(hazard_list) > 0:
-                hazard_layer = Image.new('RGBA',combined.size,(255,0,0,0))
-                combined_hazard = ImageDraw.Draw(hazard_layer)
-
-                # Make hazard polygons & labels
-                for hazard in hazard_list[0]:
-                    hazard_type = hazard[0]
-                    hazard_onset = hazard[1]    #Onset of hazard
-                    polygon_hazard = hazard[2]  #Coordinates of polygon
-                    hazard_ends = hazard[3]     #End/expiration of hazard
-                    polygon_hazard_pixels = []
-
-                    # Convert polygon lat,long coordinates into pixel coordinates
-                    for hazard_points in polygon_hazard:
-                        pix_x, pix_y = map.rev_geocode((hazard_points[0],hazard_points[1]))
-                        pix_x, pix_y = round(pix_x),round(pix_y)
-                        polygon_hazard_pixels.append((pix_x, pix_y))
-
-                    polygon_hazard = polygon_hazard_pixels
-
-                    #Styles to distinguish between watches & warnings
-                    if "Warning" in hazard_type:
-                        stroke_colour = (255,0,0,255) #Red
-                        font_colour = (255,0,0,255)
-                    else:
-                        stroke_colour = (255,255,0,255) #Yellow
-                        font_colour = (0,0,0,255)
-
-
-                    opacity = 200
-
-                    #Colours for different types
-                    if "High" in hazard_type:
-                        fill_colour = (245,212,142,opacity) #Tan/beige, #F5D48E
-                    elif "Extreme" in hazard_type:
-                        fill_colour = (245,212,142,opacity) #Tan/beige, #F5D48E
-                    elif "Gale" in hazard_type:
-                        fill_colour = (245,212,142,opacity) #Tan/beige, #F5D48E
-                    elif "Hurricane" in hazard_type:
-                        fill_colour = (147,255,0,opacity) #Lime green, #93FF00
-                    elif "Tropical" in hazard_type:
-                        fill_colour = (147,255,0,opacity) #Lime green, #93FF00
-                    elif "Blizzard" in hazard_type:
-                        fill_colour = (167,58,157,opacity) #Dark purple, #A73A9D
-                    elif "Ice" in hazard_type:
-                        fill_colour = (129,231,234,opacity) #Sky blue, #81E7EA
-                    elif "Winter" in hazard_type:
-                        fill_colour = (129,172,234,opacity) #Cornflower blue, #81ACEA
-                    elif "Storm" in hazard_type:
-                        fill_colour = (255,255,0,opacity) #Yellow
-                    else:
-                        fill_colour = (0,0,0,255)
-
-                    #Make the hazard polygon
-                    combined_hazard.polygon(polygon_hazard,fill=fill_colour,outline=stroke_colour)
-                    pass
-
-        ###############
-        #   Marker    #
-        ###############
-        marker_layer = Image.new('RGBA',combined.size,(255,0,0,0))
-        marker_annotation = ImageDraw.Draw(marker_layer)
-
-        #add a marker for the map center.
-        map_center_x, map_center_y = map.rev_geocode(map.center)
-        x0,y0,x1,y1 = map_center_x-10, map_center_y-10, map_center_x+10, map_center_y+10
-        offset = 2 #Shadow offset
-
-        marker_annotation.ellipse(#Shadow
-            [x0 + offset, y0 + offset, x1 + offset, y1 + offset],
-            outline=(0,0,0,100), #Grey
-            width=5
-            )
-        marker_annotation.ellipse(#marker
-            [x0, y0, x1, y1],
-            outline=(255,0,0,255), #Red
-            width=5
-            )
+                stroke_colour = (255,255,0,255) #Yellow
+                font_colour = (0,0,0,255)
+
+
+            opacity = 200
+
+            #Colours for different types
+            if "High" in hazard_type:
+                fill_colour = (245,212,142,opacity) #Tan/beige, #F5D48E
+            elif "Extreme" in hazard_type:
+                fill_colour = (245,212,142,opacity) #Tan/beige, #F5D48E
+            elif "Gale" in hazard_type:
+                fill_colour = (245,212,142,opacity) #Tan/beige, #F5D48E
+            elif "Hurricane" in hazard_type:
+                fill_colour = (147,255,0,opacity) #Lime green, #93FF00
+            elif "Tropical" in hazard_type:
+                fill_colour = (147,255,0,opacity) #Lime green, #93FF00
+            elif "Blizzard" in hazard_type:
+                fill_colour = (167,58,157,opacity) #Dark purple, #A73A9D
+            elif "Ice" in hazard_type:
+                fill_colour = (129,231,234,opacity) #Sky blue, #81E7EA
+            elif "Winter" in hazard_type:
+                fill_colour = (129,172,234,opacity) #Cornflower blue, #81ACEA
+            elif "Storm" in hazard_type:
+                fill_colour = (255,255,0,opacity) #Yellow
+            else:
+                fill_colour = (0,0,0,255)
+
+            #Make the hazard polygons
+            draw_shape(hazard_layer, combined_hazard, polygon_hazard, polygon_hazard_pixels, fill_colour, stroke_colour)
+
+    ###############
+    #   Marker    #
+    ###############
+    marker_layer = Image.new('RGBA',size,(255,0,0,0))
+    marker_annotation = ImageDraw.Draw(marker_layer)
+
+    #add a marker for the map center.
+    map_center_x, map_center_y = map.rev_geocode(map.center)
+    x0,y0,x1,y1 = map_center_x-10, map_center_y-10, map_center_x+10, map_center_y+10
+    offset = 2 #Shadow offset
+
+    marker_annotation.ellipse(#Shadow
+        [x0 + offset, y0 + offset, x1 + offset, y1 + offset],
+        outline=(0,0,0,100), #Grey
+        width=5
+        )
+    marker_annotation.ellipse(#marker
+        [x0, y0, x1, y1],
+        outline=(255,0,0,255), #Red
+        width=5
+        )
 
-        #########################
-        #   Times, decoration   #
-        #########################
-        annotation_layer = Image.new('RGBA',combined.size,(255,0,0,0))
-        combined_annotation = ImageDraw.Draw(annotation_layer)
+    ###########################
+    #   Ring, alert labels    #
+    ###########################
+    annotation_layer = Image.new('RGBA',size,(255,0,0,0))
+    combined_annotation = ImageDraw.Draw(annotation_layer)
 
-        combined_annotation.ellipse( #Decorative ring!
+    combined_annotation.ellipse( #Decorative ring!
+        (10,-30,310,270),
+        outline=(150,150,150,255),
+        width=7
+        )
+    # If there's a LOCAL warning, the make the ring thicker
+    if len(local_warnings) > 0:
+        combined_annotation.ellipse(
             (10,-30,310,270),
-            outline=(150,150,150,255),
-            width=7
-            )
-        # If there's a LOCAL warning, the make the ring thicker
-        if len(local_warnings) > 0:
-            combined_annotation.ellipse(
-                (10,-30,310,270),
-                outline=warning_fill_colour,
-                width=15
-                )
-
-        # Date & Time
-        the_time_local = convert_tz(times_datetime[prev_times[i]],'UTC',timeZone) #Convert to local timezone
-        datetime_string = the_time_local.strftime("%H:%M %Z") #Make it into a string
-        time_since = datetime.now(pytz.timezone(timeZone)) - the_time_local #Calculate time since using current time.
-        time_since = round(time_since.seconds/60)
-        if time_since < 10: #Add a filling zero if less than 10
-            filler = "0"
-        else:
-            filler = ""
-        datetime_string = f"{datetime_string} ({filler}{time_since} mins)"
-
-        #Centre the time based on text length.
-        text_length = combined_annotation.textlength(datetime_string,font=fnt_medium)
-        text_pos_x = (320 - text_length)/2
-        combined_annotation.text(
-            (text_pos_x,0),
-            datetime_string,
-            font=fnt_medium,
-            fill=(0,0,0,255),
-            stroke_width=3,
-            stroke_fill=(255,255,255,255)
+            outline=warning_fill_colour,
+            width=15
             )
 
-        # Local alerts as a label
-        if len(local_alerts[0]) > 0:
-            pos_y = 23
-            pos_x = 0
-            unique_hazards = local_alerts[1]
-            for a_hazard_type in unique_hazards:
-                #Distinguish between watches & warnings
-                if "Warning" in a_hazard_type:
-                    stroke_colour = (255,0,0,255)
-                else:
-                    stroke_colour = (255,255,0,255)
-                    font_colour = (0,0,0,255)
-                #Colours for different types
-                if "High" in a_hazard_type:
-                    fill_colour = (245,212,142,255) #Tan/beige, #F5D48E
-                    font_fill = (0,0,0,255)
-                elif "Extreme" in a_hazard_type:
-                    fill_colour = (245,212,142,255) #Tan/beige, #F5D48E
-                    font_fill = (0,0,0,255)
-                elif "Gale" in a_hazard_type:
-                    fill_colour = (245,212,142,255) #Tan/beige, #F5D48E
-                    font_fill = (0,0,0,255)
-                elif "Hurricane" in a_hazard_type:
-                    fill_colour = (147,255,0,255) #Lime green, #93FF00
-                    font_fill = (0,0,0,255)
-                elif "Tropical" in a_hazard_type:
-                    fill_colour = (147,255,0,255) #Lime green, #93FF00
-                    font_fill = (0,0,0,255)
-                elif "Blizzard" in a_hazard_type:
-                    fill_colour = (167,58,157,255) #Dark purple, #A73A9D
-                    font_fill = (255,255,255,255)
-                elif "Ice" in a_hazard_type:
-                    fill_colour = (129,231,234,255) #Sky blue, #81E7EA
-                    font_fill = (255,255,255,255)
-                elif "Winter" in a_hazard_type:
-                    fill_colour = (129,172,234,255) #Cornflower blue, #81ACEA
-                    font_fill = (255,255,255,255)
-                elif "Storm" in a_hazard_type:
-                    fill_colour = (255,255,0,255) #Yellow
-                else:
-                    fill_colour = (255,255,255,255)
-                    font_fill = (0,0,0,255)
-
-                if len(unique_hazards) >= 3:
-                    alert_font = fnt_small
-                    y_offset = 15
-                else:
-                    alert_font = fnt_medium
-                    y_offset = 20
-
-                text_length = combined_annotation.textlength(a_hazard_type,font=alert_font)
-                pos_x = (320 - text_length)/2
-                #Rounded start
-                combined_annotation.chord(
-                    (pos_x-5,pos_y, pos_x+15, pos_y+y_offset),
-                    90,
-                    270,
-                    fill=fill_colour,
-                    outline=stroke_colour,
-                    width=1
-                    )
-                #Rectangle
-                combined_annotation.rectangle(
-                    (pos_x+5,pos_y,pos_x+text_length,pos_y+y_offset),
-                    fill=fill_colour,
-                    outline=stroke_colour,
-                    width=1
-                    )
-                #Rounded end
-                combined_annotation.chord(
-                    (pos_x+text_length-10, pos_y, pos_x+text_length+10, pos_y+y_offset),
-                    270,
-                    90,
-                    fill=fill_colour,
-                    outline=stroke_colour,
-                    width=1
-                    )
-                #Rectangle (to cover up internal strokes)
-                combined_annotation.rectangle(
-                    (pos_x+3,pos_y+1,pos_x+text_length+3,pos_y+y_offset-1),
-                    fill=fill_colour
-                    )
-                #Text
-                combined_annotation.text(
-                    (pos_x+2,pos_y),
-                    a_hazard_type,
-                    font=alert_font,
-                    fill=font_fill,
-                    stroke_width=0,
-                    stroke_fill=(255,255,255,200)
-                    )
-                pos_y = pos_y + y_offset + 2
-
-
-        ########################################
-        #   Putting all the layers together!   #
-        ########################################
-        if show_alerts: #Hazard layer
-            if len(hazard_list) > 0:
-                combined = Image.alpha_composite(combined, hazard_layer)
-
-        # Basemap + Radar (note function to make radar image transparent)
-        combined = Image.alpha_composite(combined, make_transparent(radar,155))
-        if len(warnings_list) > 0: #Warning layer
-            combined = Image.alpha_composite(combined, warning_layer)
-        combined = Image.alpha_composite(combined, base_map_labels) #Base + map labels
-        combined = Image.alpha_composite(combined, marker_layer) #Maker
-
-        #Put all the layers together!
-        combined = Image.alpha_composite(combined, annotation_layer) #Annotations
-        #Circle overlay!
-        circle_overlay = Image.open(f"{CURR_DIR}circle_overlay.png")
-        combined = Image.alpha_composite(combined, circle_overlay)
-
-        image_list.append(combined)
-    print("Done!")
+    # Local alerts as a label
+    if len(local_alerts[0]) > 0:
+        pos_y = 23
+        pos_x = 0
+        unique_hazards = local_alerts[1]
+        for a_hazard_type in unique_hazards:
+            font_fill = (0,0,0,255)
+            #Distinguish between watches & warnings
+            if "Warning" in a_hazard_type:
+                stroke_colour = (255,0,0,255)
+            else:
+                stroke_colour = (255,255,0,255)
+                font_colour = (0,0,0,255)
+            #Colours for different types
+            if "High" in a_hazard_type:
+                fill_colour = (245,212,142,255) #Tan/beige, #F5D48E
+                font_fill = (0,0,0,255)
+            elif "Extreme" in a_hazard_type:
+                fill_colour = (245,212,142,255) #Tan/beige, #F5D48E
+                font_fill = (0,0,0,255)
+            elif "Gale" in a_hazard_type:
+                fill_colour = (245,212,142,255) #Tan/beige, #F5D48E
+                font_fill = (0,0,0,255)
+            elif "Hurricane" in a_hazard_type:
+                fill_colour = (147,255,0,255) #Lime green, #93FF00
+                font_fill = (0,0,0,255)
+            elif "Tropical" in a_hazard_type:
+                fill_colour = (147,255,0,255) #Lime green, #93FF00
+                font_fill = (0,0,0,255)
+            elif "Blizzard" in a_hazard_type:
+                fill_colour = (167,58,157,255) #Dark purple, #A73A9D
+                font_fill = (255,255,255,255)
+            elif "Ice" in a_hazard_type:
+                fill_colour = (129,231,234,255) #Sky blue, #81E7EA
+                font_fill = (255,255,255,255)
+            elif "Winter" in a_hazard_type:
+                fill_colour = (129,172,234,255) #Cornflower blue, #81ACEA
+                font_fill = (255,255,255,255)
+            elif "Storm" in a_hazard_type:
+                fill_colour = (255,255,0,255) #Yellow
+            else:
+                fill_colour = (255,255,255,255)
+                font_fill = (0,0,0,255)
 
-    return image_list
-def get_all_alerts(*hazard_types, coordinates=None):
+            if len(unique_hazards) >= 3:
+                alert_font = fnt_small
+                y_offset = 15
+            else:
+                alert_font = fnt_medium
+                y_offset = 20
+
+            #The pill label (rounded ends, box & text) is rendered once, then reused
+            pill, pill_length = pill_sprite(a_hazard_type, alert_font, fill_colour, stroke_colour, font_fill, y_offset)
+            pos_x = (320 - pill_length)/2
+            blit(annotation_layer, pill, (pos_x-5, pos_y))
+            pos_y = pos_y + y_offset + 2
+
+    ########################################
+    #   Putting all the layers together!   #
+    ########################################
+    # Everything under the radar is one layer, and everything over it is another,
+    # so each frame only needs a couple of composites.
+    below = Image.alpha_composite(base_map, hazard_layer) #Basemap + hazards
+    above = warning_layer
+    for layer in [base_map_labels, marker_layer, annotation_layer]: #Warnings + map labels + marker + ring & alert labels
+        above = Image.alpha_composite(above, layer)
+
+    return {'below': below, 'above': above}
+def composite_frame(radar, overlays, time_datetime):
+    ''' Put a radar frame together (in this process, see composite_shared() for the compositing pool).
+        Param radar: Radar image
+        Param overlays: Layers from make_overlay_layers()
+        Param time_datetime: Time of the radar image (UTC datetime)
+
+        Returns a PIL image.
+    '''
+    return put_together(overlays['below'], overlays['above'], get_circle_overlay(), radar, frame_time_text(time_datetime), fnt_medium)
+def frame_time_text(time_datetime):
+    ''' Returns the time along the top of a frame, e.g. "14:05 EDT (07 mins)" '''
+    the_time_local = convert_tz(time_datetime,'UTC',timeZone) #Convert to local timezone
+    datetime_string = the_time_local.strftime("%H:%M %Z") #Make it into a string
+    time_since = datetime.now(pytz.timezone(timeZone)) - the_time_local #Calculate time since using current time.
+    time_since = round(time_since.seconds/60)
+    if time_since < 10: #Add a filling zero if less than 10
+        filler = "0"
+    else:
+        filler = ""
+    return f"{datetime_string} ({filler}{time_since} mins)"
+def start_compositing():
+    ''' Start the compositing processes.
+        They're forked, so this has to happen before any threads are started (it's the first thing main() does).
+        Without them, frames are put together in the refresh threads.
+    '''
+    global compositing_pool
+    if COMPOSITE_WORKERS > 0 and compositing_pool is None:
+        compositing_pool = make_pool(COMPOSITE_WORKERS)
+        print(f"Compositing with {COMPOSITE_WORKERS} processes")
+def share_layers(overlays):
+    ''' Returns the layers that are the same for every frame, in shared memory (None without the compositing pool) '''
+    if compositing_pool is None:
+        return None
+    try:
+        return SharedLayers(overlays['below'], overlays['above'], get_circle_overlay())
+    except OSError as exception: #(e.g. /dev/shm is full)
+        print(f"Couldn't share the layers ({exception}), compositing here instead")
+        return None
+def stop_compositing(exception):
+    ''' The compositing pool has broken (e.g. a process was killed), so carry on without it '''
+    global compositing_pool
+    print(f"Compositing processes stopped ({type(exception).__name__}), compositing here instead")
+    if compositing_pool is not None:
+        compositing_pool.shutdown(wait=False, cancel_futures=True)
+    compositing_pool = None
+async def composite_shared(radar, overlays, shared, time_datetime):
+    ''' composite_frame(), in the compositing pool if there is one.
+        Param shared: share_layers() of the overlays
+
+        Returns a PIL image.
+    '''
+    if shared is not None and compositing_pool is not None:
+        try:
+            return await composite_async(compositing_pool, shared, radar, frame_time_text(time_datetime), fnt_medium)
+        except BrokenProcessPool as exception:
+            stop_compositing(exception)
+    return await asyncio.get_running_loop().run_in_executor(network_pool, composite_frame, radar, overlays, time_datetime)
+def composite_frames(radars, overlays):
+    ''' Put lots of frames together at once (in the compositing pool if there is one).
+        Param radars: List of (time_datetime, radar image)
+        Param overlays: Layers from make_overlay_layers()
+
+        Returns a list of PIL images.
+    '''
+    if compositing_pool is not None and radars:
+        shared = share_layers(overlays)
+        try:
+            if shared is not None:
+                return composite_many(compositing_pool, shared, [radar for time_datetime, radar in radars], [frame_time_text(time_datetime) for time_datetime, radar in radars], fnt_medium)
+        except BrokenProcessPool as exception:
+            stop_compositing(exception)
+        finally:
+            if shared is not None:
+                shared.close()
+    return [composite_frame(radar, overlays, time_datetime) for time_datetime, radar in radars]
+def get_radar_frame(map, station, layer, TIME, zoom_out=0):
+    ''' Build a radar image for a GeoTiler map from XYZ radar tiles.
+        Param map: GeoTiler map construct
+        Param station: Radar station ID
+        Param layer: Radar layer
+        Param TIME: Layer time (str)
+        Param zoom_out: Use tiles from this many zoom levels out, and scale them up (1 = half resolution, a quarter of the tiles)
+
+        Returns a PIL image the same size as the map (or None if a tile is missing).
+    '''
+    if LEVEL3_DIR: #Draw it ourselves if we have the Level III file
+        time_datetime = datetime.strptime(TIME,'%Y-%m-%dT%H:%M:%S.000Z').replace(tzinfo=pytz.utc)
+        path = find_product(os.path.join(LEVEL3_DIR, station, layer), time_datetime)
+        if path:
+            try:
+                return to_raster(read_product(path), map.extent, map.size)
+            except ValueError as error:
+                print(f"\tCouldn't decode {path} ({error}), using the WMS")
+
+    width, height = map.size
+    zoom = map.zoom - zoom_out
+    scale = 2 ** zoom_out
+    origin_x, origin_y = map_origin(map)
+
+    #Where the map is on the tiles (in pixels at the tiles' zoom level)
+    left, top = origin_x / scale, origin_y / scale
+    right, bottom = (origin_x + width) / scale, (origin_y + height) / scale
+
+    #Range of tiles that cover the map
+    tile_x0, tile_y0 = int(left // TILE_SIZE), int(top // TILE_SIZE)
+    tile_x1, tile_y1 = (math.ceil(right) - 1) // TILE_SIZE, (math.ceil(bottom) - 1) // TILE_SIZE
+
+    #Stitch the tiles together (white & transparent, like the WMS background)
+    mosaic = np.full(((tile_y1 - tile_y0 + 1) * TILE_SIZE, (tile_x1 - tile_x0 + 1) * TILE_SIZE, 4), (255,255,255,0), dtype=np.uint8)
+    for tile_y in range(tile_y0, tile_y1 + 1):
+        if tile_y < 0 or tile_y >= 2 ** zoom: #Off the top or bottom of the world
+            continue
+        for tile_x in range(tile_x0, tile_x1 + 1):
+            tile = get_radar_tile(station, layer, TIME, zoom, tile_x % 2 ** zoom, tile_y)
+            if tile is None:
+                return None
+
+            row = (tile_y - tile_y0) * TILE_SIZE
+            col = (tile_x - tile_x0) * TILE_SIZE
+            mosaic[row:row + TILE_SIZE, col:col + TILE_SIZE] = tile
+
+    #Cut the map out of the tiles
+    if zoom_out:
+        #(Nearest neighbour, so the colours stay the radar's colours)
+        box = (left - tile_x0 * TILE_SIZE, top - tile_y0 * TILE_SIZE, right - tile_x0 * TILE_SIZE, bottom - tile_y0 * TILE_SIZE)
+        return Image.fromarray(mosaic).resize((width, height), Image.NEAREST, box=box)
+    row = origin_y - tile_y0 * TILE_SIZE
+    col = origin_x - tile_x0 * TILE_SIZE
+    return Image.fromarray(mosaic[row:row + height, col:col + width])
+def get_radar_tile(station, layer, TIME, zoom, tile_x, tile_y):
+    ''' Get a single 256x256 radar tile, from the cache if we've seen it before.
+        Param station: Radar station ID
+        Param layer: Radar layer
+        Param TIME: Layer time (str)
+        Param zoom, tile_x, tile_y: XYZ tile coordinates
+
+        Returns a RGBA numpy array (or None if it couldn't be downloaded)
+    '''
+    key = (station, layer, TIME, zoom, tile_x, tile_y)
+    with radar_tile_lock:
+        if key in radar_tile_cache:
+            radar_tile_cache.move_to_end(key)
+            return radar_tile_cache[key]
+
+    # Tile bounds in web mercator metres (EPSG:3857)
+    world = 2 * math.pi * 6378137
+    tile_metres = world / 2 ** zoom
+    minx = tile_x * tile_metres - world / 2
+    maxx = minx + tile_metres
+    maxy = world / 2 - tile_y * tile_metres
+    miny = maxy - tile_metres
+    bbox = f'{minx}%2C{miny}%2C{maxx}%2C{maxy}'
+    TIME_for_url = TIME.replace(':','%3A')
+
+    tile_url = f"{OPENGEO_URL}/geoserver/{station}/ows?SERVICE=WMS&service=WMS&version=1.3.0&request=GetMap&layers={station}_{layer}&styles=&width={TILE_SIZE}&height={TILE_SIZE}&crs=EPSG%3A3857&bbox={bbox}&format={format}&transparent={transparent}&bgcolor={bg_colour}&exceptions={EXCEPTION}&time={TIME_for_url}"
+
+    response_tile = fetch(tile_url, headers=headers, timeout=10, name=f"radar tile {zoom}/{tile_x}/{tile_y}")
+    if not response_tile:
+        print(f"\tCouldn't get radar tile {zoom}/{tile_x}/{tile_y} ({response_tile})")
+        return None
+
+    tile = np.array(Image.open(BytesIO(response_tile.content)).convert("RGBA"))
+
+    with radar_tile_lock:
+        radar_tile_cache[key] = tile
+        if len(radar_tile_cache) > MAX_CACHED_TILES: #Forget the oldest tile
+            radar_tile_cache.popitem(last=False)
+
+    return tile
+def map_origin(map):
+    ''' Work out where the top left of a GeoTiler map is on the XYZ tile grid.
+        Param map: GeoTiler map construct
+
+        Returns (x,y) in pixels at the map's zoom level
+    '''
+    center_x, center_y = global_pixel(map.center[0], map.center[1], map.zoom)
+    map_x, map_y = map.rev_geocode(map.center)
+    return int(round(center_x - map_x)), int(round(center_y - map_y))
+def global_pixel(lon, lat, zoom):
+    ''' Web mercator pixel position of a lon/lat (works with numpy arrays too).
+        Param lon, lat: Coordinates
+        Param zoom: Zoom level
+
+        Returns (x,y) in pixels from the top left of the world
+    '''
+    world = TILE_SIZE * 2 ** zoom
+    x = (np.asarray(lon) + 180) / 360 * world
+    y = (1 - np.arcsinh(np.tan(np.radians(lat))) / math.pi) / 2 * world
+    return x, y
+def get_all_alerts(*hazard_types, coordinates=None, hazard_times=None, warning_times=None):
     ''' Get the list of active hazards & warnings in an area.
         param hazard_types: An array of hazards for the WFS cql_filter.
         param coordinates: Bounding coordinates. Can be:
                             - (x,y) tuple for a point location
                             - Geotiler map construct
+        param hazard_times: Hazard layer times from get_times() (fetched if not given)
+        param warning_times: Warning layer times from get_times() (fetched if not given)
 
         Returns a list of warnings, (hazards, unique hazards)
 
     '''
-    global minx
-    global miny
-    global maxy
-    global maxx
     global hazard_polygons_pixel
     global warning_polygons_pixel
 
@@ -678,7 +1055,7 @@ def get_all_alerts(*hazard_types, coordinates=None):
     elif type(coordinates) is geotiler.map.Map: #If coordinates are a GeoTiler map
         minx, miny, maxx, maxy = coordinates.extent
     else: #Else use WMS layer extent.
-        minx, miny, maxx, maxy = minx, miny, maxx, maxy
+        minx, miny, maxx, maxy = radar_extent
 
     ##############
     # cql filter #
@@ -701,57 +1078,54 @@ def get_all_alerts(*hazard_types, coordinates=None):
     #####################
     # Get current times #
     #####################
-    hazard_time, hazard_datetime = get_times(alert_capabilities_url)
+    #(The local & greater area alerts can share the same times)
+    if hazard_times is None:
+        hazard_times = get_times(alert_capabilities_url)
+    hazard_time, hazard_datetime = hazard_times
     hazard_time = hazard_time[-1] #Get just the latest time
 
-    warning_time, warning_datetime = get_times(warnings_capabilities_url)
+    if warning_times is None:
+        warning_times = get_times(warnings_capabilities_url)
+    warning_time, warning_datetime = warning_times
     warning_time = warning_time[-1] #Get just the latest time
 
     ##################################################
     # Construct full URL for warning & hazard layers #
     ##################################################
-    hazard_json_url = f"https://opengeo.ncep.noaa.gov/geoserver/wwa/ows?service=wfs&version=2.0.0&request=GetFeature&outputFormat=application%2Fjson&typeNames=hazards&srsName=EPSG:4326&cql_filter=IDP_FileDate+%3D+{hazard_time}+AND+BBOX(geom,{minx},{miny},{maxx},{maxy},%27EPSG:4326%27){types}"
+    hazard_json_url = f"{OPENGEO_URL}/geoserver/wwa/ows?service=wfs&version=2.0.0&request=GetFeature&outputFormat=application%2Fjson&typeNames=hazards&srsName=EPSG:4326&cql_filter=IDP_FileDate+%3D+{hazard_time}+AND+BBOX(geom,{minx},{miny},{maxx},{maxy},%27EPSG:4326%27){types}"
 
-    warning_json_url = f"https://opengeo.ncep.noaa.gov/geoserver/wwa/ows?service=wfs&version=2.0.0&request=GetFeature&outputFormat=application%2Fjson&typeNames=warnings&srsName=EPSG:4326&cql_filter=IDP_FileDate+%3D+{warning_time}+AND+BBOX(geom,{minx},{miny},{maxx},{maxy},%27EPSG:4326%27)"
+    warning_json_url = f"{OPENGEO_URL}/geoserver/wwa/ows?service=wfs&version=2.0.0&request=GetFeature&outputFormat=application%2Fjson&typeNames=warnings&srsName=EPSG:4326&cql_filter=IDP_FileDate+%3D+{warning_time}+AND+BBOX(geom,{minx},{miny},{maxx},{maxy},%27EPSG:4326%27)"
 
     #############################
     # Get warnings and hazards  #
     #############################
-    try: #Warnings
-        response_warning = requests.get(warning_json_url, headers=headers,timeout=5)
-    except:
-        print("Connection problem getting warning file.")
-        response_warning = False
-    try: #Hazards
-        response_hazard = requests.get(hazard_json_url, headers=headers,timeout=5)
-    except:
-        print("Connection problem getting hazard file.")
-        response_hazard = False
+    #(Streamed, and read a feature at a time, see geojson_stream.py)
+    response_warning = fetch(warning_json_url, headers=headers, timeout=5, name="warning file", stream=True) #Warnings
+    response_hazard = fetch(hazard_json_url, headers=headers, timeout=5, name="hazard file", stream=True) #Hazards
 
     warnings_list = []
-    warning_polygons = []
 
     hazard_list = []
-    hazard_polygons = []
     hazard_types_list = []
     unique_hazards = []
 
     if response_hazard:
-        hazard_json_file = response_hazard.json()
-        total_hazards = hazard_json_file['totalFeatures']
+        with response_hazard:
+            hazard_shapes, hazard_properties = read_features(response_hazard)
+        total_hazards = len(hazard_properties)
 
-        print(f"\n--------------\nHazards: ({hazard_json_file['totalFeatures']})\n--------------")
+        print(f"\n--------------\nHazards: ({total_hazards})\n--------------")
 
         if total_hazards > 0:
-            for index, record in enumerate(hazard_json_file['features']):
-                hazard_type = record['properties']['prod_type']
-                cap_id = record['properties']['cap_id']
-                onset = record['properties']['onset']
-                ends = record['properties']['ends']
+            for index, properties in enumerate(hazard_properties):
+                hazard_type = properties['prod_type']
+                cap_id = properties['cap_id']
+                onset = properties['onset']
+                ends = properties['ends']
 
                 #Sometimes the 'ends' field is blank, so we'll use the expiration instead.
                 if ends in ["",None]:
-                    ends = record['properties']['expiration']
+                    ends = properties['expiration']
 
                 #Convert & remake onset & end times to local radar timezone
                 onset_local_datetime = convert_tz(onset,'UTC',timeZone) #Converted to local datetime
@@ -762,27 +1136,20 @@ def get_all_alerts(*hazard_types, coordinates=None):
                 #Collect the hazard type
                 hazard_types_list.append(hazard_type)
 
-                #Get polygon coordinates
-                if record['geometry']['type'] == "MultiPolygon":
-                    hazard_polygons.append(record['geometry']['coordinates'][0][0])
-
-                    for polygon in hazard_polygons:
-                        polygons_coordinates = []
-                        for points in polygon:
-                            polygons_coordinates.append((points[0], points[1]))
-
+                #Polygons (all of them, as flat arrays. See geojson_stream.py)
+                shape = hazard_shapes.feature(index)
+                if len(shape.polygon_offsets) > 1:
                     #Make the hazard list:
                     hazard_list.append([
                         hazard_type,
                         onset_local_datetime,
-                        polygons_coordinates,
+                        shape,
                         ends_local_datetime
                         ])
 
-                    unique_hazards = list(set(hazard_types_list))
                     print(f"- {hazard_type},\t\t{onset_local} until {ends_local}")
-                else:
-                    pass
+
+            unique_hazards = list(dict.fromkeys(hazard_types_list)) #(In the order they came in, so every run draws them the same)
 
         else:
             print("- No hazards!")
@@ -791,33 +1158,25 @@ def get_all_alerts(*hazard_types, coordinates=None):
         print(f"Unable to get Hazards json file ({response_hazard})")
 
     if response_warning:
-        warning_json_file = response_warning.json()
+        with response_warning:
+            warning_shapes, warning_properties = read_features(response_warning)
 
-        print(f"\n--------------\nWarnings: ({warning_json_file['totalFeatures']})\n--------------")
+        print(f"\n--------------\nWarnings: ({len(warning_properties)})\n--------------")
 
-        if warning_json_file['totalFeatures'] > 0:
-            for record in warning_json_file['features']:
-                warning_type = record['properties']['prod_type']
-                cap_id = record['properties']['cap_id']
+        if len(warning_properties) > 0:
+            for index, properties in enumerate(warning_properties):
+                warning_type = properties['prod_type']
+                cap_id = properties['cap_id']
 
                 #Strip and remake the expiration time
-                expiration_datetime = datetime.strptime(record['properties']['expiration'],'%Y-%m-%dT%H:%M:%S%z')
+                expiration_datetime = datetime.strptime(properties['expiration'],'%Y-%m-%dT%H:%M:%S%z')
                 expiration = datetime.strftime(expiration_datetime, '%Y-%m-%d, %H:%M %Z')
 
-                # Get polygon coordinates
-                if record['geometry']['type'] == "MultiPolygon":
-                    warning_polygons.append(record['geometry']['coordinates'][0][0])
-
-                    for polygon in warning_polygons:
-                        polygons_coordinates = []
-                        for points in polygon:
-                            polygons_coordinates.append((points[0], points[1]))
-
-                #[type, [bbox], expiration, (pixel_x,pixel_y)]
+                #[type, expiration, polygons (see geojson_stream.py)]
                 warnings_list.append([
                     warning_type,
                     expiration,
-                    polygons_coordinates
+                    warning_shapes.feature(index)
                     ])
                 print(f"- {warning_type}, ends {expiration}")
         else:
@@ -827,22 +1186,14 @@ def get_all_alerts(*hazard_types, coordinates=None):
         print(f"Unable to get Warnings json file ({response_warning})")
 
     return warnings_list, (hazard_list, unique_hazards)
-def make_transparent(image,transparency):
-    ''' Make opague parts of a transparent image, transparent!
-
-        Param image: The image to use.
-        Param transparent: value between 0 & 255. 0 = full transparent, 255 = opaque.
-
-        Returns a reconstructed image.
-    '''
-    #Make sure the image has an alpha channel
-    image = image.convert("RGBA")
-
-    #Do some array magic.
-    img_array = np.array(image)
-    img_array[:, :, 3] = (transparency * (img_array[:, :, :3] != 255).any(axis=2))
-
-    return Image.fromarray(img_array)
+def get_circle_overlay():
+    ''' Load the circle overlay (only once). '''
+    global circle_overlay
+
+    if circle_overlay is None:
+        with Image.open(f"{CURR_DIR}circle_overlay.png") as overlay_file:
+            circle_overlay = overlay_file.convert("RGBA")
+    return circle_overlay
 def get_times(url):
     ''' For a layer, get a list of times by requesting the GetCapabilities XML file.
         Param url: The url for the GetCapabilities file.
@@ -851,11 +1202,7 @@ def get_times(url):
     '''
     global times_split
 
-    try:
-        response = requests.get(url, headers=headers, timeout=10)
-    except:
-        print("Connection Problems: Getting times")
-        response = False
+    response = fetch(url, headers=headers, timeout=10, name="times")
 
     if response:
         xml_file = BytesIO(response.content)
@@ -878,14 +1225,14 @@ def get_times(url):
 
     #Return a list of times (str), and a list of times (datetime)
     return times, times_datetime
-def get_basemap(mode,zoom,width,provider='stamen-toner'):
-    ''' Make a basemap using GeoTiler
+def get_maps(mode,zoom,width,provider=BASEMAP):
+    ''' Make the GeoTiler map constructs for the basemap (and labels)
         Param mode: Method of getting the map extents.
         Param zoom: Zoom level
         Param width: Width of the map.
-        Param provider: The map provider (see the Geotiler library for a list)
+        Param provider: The map provider (see the Geotiler library for a list, or a tile url)
 
-        Returns rendered basemap, rendered basemap labels, and map construct.
+        Returns map construct, and labels map construct.
     '''
     global minx
     global miny
@@ -900,27 +1247,68 @@ def get_basemap(mode,zoom,width,provider='stamen-toner'):
         map = geotiler.Map( center=(lat_long[1],lat_long[0]),
                             zoom=zoom,
                             size=size,
-                            provider=provider)
+                            provider=map_provider(provider))
         map_labels = geotiler.Map(center=(lat_long[1],lat_long[0]),
                             size=size,
                             zoom=map.zoom,
-                            provider='stamen-toner-labels')
+                            provider=map_provider(BASEMAP_LABELS))
         minx, miny, maxx, maxy = map.extent
 
     else:
         # Use the minx, miny, maxx, maxy extents from the radar layer.
         map = geotiler.Map( extent=(minx, miny, maxx, maxy),
                             zoom=zoom,
-                            provider=provider)
+                            provider=map_provider(provider))
         map_labels = geotiler.Map( extent=(minx, miny, maxx, maxy),
                             zoom=map.zoom,
-                            provider='stamen-toner-labels')
+                            provider=map_provider(BASEMAP_LABELS))
 
     (map_center_x,map_center_y) = map.rev_geocode(map.center)
-    base_map = geotiler.render_map(map)
-    base_map_labels = geotiler.render_map(map_labels)
 
-    return base_map, base_map_labels, map
+    return map, map_labels
+def map_provider(provider):
+    ''' Returns a GeoTiler provider name as is, or a provider for a tile url (with {z}, {x} & {y} in it) or MBTiles file '''
+    if provider.endswith('.mbtiles'):
+        return mbtiles.provider(provider)
+    if '{z}' not in provider:
+        return provider
+    return geotiler.provider.MapProvider({'name': provider, 'url': provider})
+async def render_basemap(map, map_labels, provider=BASEMAP):
+    ''' Render a basemap (and labels) using GeoTiler. Both are downloaded (or read from MBTiles) at the same time.
+        Param map: Map construct
+        Param map_labels: Labels map construct
+        Param provider: The map provider
+
+        Returns rendered basemap, rendered basemap labels.
+    '''
+    #The basemap only changes if the location or zoom does, so reuse it.
+    basemap_key = (provider, map.zoom, tuple(map.size), tuple(map.extent))
+    if basemap_key in basemap_cache:
+        return basemap_cache[basemap_key]
+
+    errors = []
+    async def downloader(tiles, num_workers):
+        async for tile in fetch_map_tiles(tiles, num_workers):
+            if tile.error:
+                errors.append(tile.error)
+            yield tile
+
+    async def render(map):
+        if mbtiles.is_mbtiles(map.provider):
+            image, missing = await mbtiles.render_map(map, network_pool)
+            errors.extend(missing)
+            return image
+        return await geotiler.render_map_async(map, downloader=downloader)
+
+    basemap = tuple(await asyncio.gather(render(map), render(map_labels)))
+
+    #Only keep it if every tile was downloaded
+    if len(errors) == 0:
+        basemap_cache[basemap_key] = basemap
+    else:
+        print(f"Couldn't get {len(errors)} basemap tiles")
+
+    return basemap
 def convert_tz(time,original_tz,new_tz):
     ''' Convert datetime from one timezone to another!
         Param time: (str or datetime) to convert.
@@ -957,15 +1345,15 @@ def play_animation(frames):
     '''
     global latest_image
 
-    duration = 750
+    duration = FRAME_DURATION
     latest_image = frames[-1]
 
     for frame in frames:
         start_time = time.monotonic()
-        disp.image(frame)
+        show(frame) #Only the radar & time change between frames, so this is quick
 
-        while time.monotonic() < (start_time + duration / 1000):
-            pass
+        #Sleep (rather than spin) so the background refresh gets the CPU
+        time.sleep(max(0, start_time + duration / 1000 - time.monotonic()))
 def status_images(message,background=None, background_colour=(100,100,100,200), font=fnt_goth_bold, font_colour=(255,255,255,255), xy=None, border=True):
     ''' Make an image that displays a status message.
         param message: message to display
@@ -983,14 +1371,9 @@ def status_images(message,background=None, background_colour=(100,100,100,200),
     annotation_layer = Image.new('RGBA',(320,240),(120,120,120,0))
     status_annotation = ImageDraw.Draw(annotation_layer)
 
-    # Get bounding box of the status message
-    text_bbox = status_annotation.multiline_textbbox(
-                                        (0,0),
-                                        message,
-                                        font=font,
-                                        spacing=2)
-    text_length = text_bbox[2]-text_bbox[0]
-    text_height = text_bbox[3]-text_bbox[1]
+    # Get the status message, and its size (not cached, most of them have the time in them)
+    text_sprite, text_offset = label_sprite(message, font, font_colour, spacing=2, cache=False)
+    text_length, text_height = text_sprite.size
 
     # If xy is given, use that... otherwise place it slightly middle left
     if xy == None:
@@ -1016,14 +1399,7 @@ def status_images(message,background=None, background_colour=(100,100,100,200),
         90,
         fill=background_colour
         )
-    status_annotation.multiline_text(#Text
-        (x_pos+15,y_pos),
-        message,
-        font=font,
-        fill=font_colour,
-        spacing=2,
-        stroke_width=0
-    )
+    blit(annotation_layer, text_sprite, (x_pos+15+text_offset[0], y_pos+text_offset[1])) #Text
 
     status_image = Image.new('RGBA',(320,240))
     #If a background image is given, use that
@@ -1034,67 +1410,486 @@ def status_images(message,background=None, background_colour=(100,100,100,200),
     status_image = Image.alpha_composite(status_image, annotation_layer)
     #Add the circle overaly (if True)
     if border:
-        circle_overlay = Image.open(f"{CURR_DIR}circle_overlay.png")
-        status_image = Image.alpha_composite(status_image, circle_overlay)
+        status_image = Image.alpha_composite(status_image, get_circle_overlay())
     else:
         pass
 
 
     return status_image
 
-disp.image(status_images("Standby!",loading))
+def start_session():
+    ''' Work out the station, timezone and radar layer extent.
+        If there's a saved state for our location, use that instead (much faster!)
 
-while True:
+        If our location can't be looked up, the station in secrets.py is used (see find_location())
+        Raises ConnectionError if there's no station to use, or its layer extent can't be looked up (so it's tried again)
+
+        Returns the last loop of frames from the saved state (or None)
+    '''
+    global station
+    global home_station
+    global timeZone
+    global station_mode
+    global capabilities_url
+    global radar_extent
+    global minx, miny, maxx, maxy
+    global warnings_list, hazard_list, local_warnings, local_alerts
+    global located
+
+    state = load_state()
+    if state is not None:
+        station = state['station']
+        home_station = state.get('home_station', station)
+        timeZone = state['timeZone']
+        located = state.get('located', True)
+        station_mode = state['station_mode']
+        radar_extent = state['radar_extent']
+        basemap_cache.update(state['basemaps'])
+        warnings_list, hazard_list = state['warnings_list'], state['hazard_list']
+        local_warnings, local_alerts = state['local_warnings'], state['local_alerts']
+        print(f"Warm start: {station.upper()} -- {timeZone} (saved {state['saved']})")
+    else:
+        home_station = location_to_station()
+        station_mode = "---"
+        if home_station is None: #(No station in secrets.py to fall back on, so try again later)
+            raise ConnectionError("Couldn't look up our location")
+        if not located:
+            print(f"Using {home_station.upper()} from secrets.py, with {timeZone} times (until our location can be looked up)")
+
+    capabilities_url = layer_capabilities_url(layer)
+
+    #Get the SW and NE coordinates from the WMS GetCapabilities file
+    if state is None:
+        radar_extent = get_bounding_coordinates(capabilities_url)
+        if radar_extent == (0, 0, 0, 0):
+            raise ConnectionError("Couldn't get the radar layer's extent")
+    minx, miny, maxx, maxy = radar_extent
+
+    return state['frames'] if state is not None else None
+def find_location():
+    ''' Try looking up our location again (after starting on the station in secrets.py).
+        Sets our time zone, and our home station (pick_station() switches to it, if it's up)
+    '''
+    global station
+    global home_station
+
+    current = station
+    found = location_to_station(fallback=False)
+    station = current #(Keep using the same station until pick_station() says otherwise)
+    if found is not None:
+        home_station = found
+        print(f"Found our location: {home_station.upper()} -- {timeZone}")
+def save_state(frames):
+    ''' Save everything we need for a warm start to disk.
+        The file is written to a temporary file first, then swapped in, so
+        a crash or power cut never leaves a half-written state behind.
+
+        Param frames: The latest loop of composited frames.
+    '''
+    state = {
+        'version': STATE_VERSION,
+        'coordinates': tuple(lat_long),
+        'saved': datetime.now(pytz.utc),
+        'station': station,
+        'home_station': home_station,
+        'timeZone': timeZone,
+        'located': located,
+        'station_mode': station_mode,
+        'radar_extent': radar_extent,
+        'basemaps': basemap_cache,
+        'warnings_list': warnings_list,
+        'hazard_list': hazard_list,
+        'local_warnings': local_warnings,
+        'local_alerts': local_alerts,
+        'frames': frames,
+    }
+
+    temp_file = f"{STATE_FILE}.tmp"
     try:
-        print("\n****************************************************")
+        with open(temp_file, 'wb') as state_file:
+            pickle.dump(state, state_file, protocol=pickle.HIGHEST_PROTOCOL)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(temp_file, STATE_FILE)
+    except (OSError, pickle.PicklingError) as error:
+        print(f"Couldn't save state ({error})")
+def load_state():
+    ''' Load the saved state (if there is one, and it's for our location).
+
+        Returns the state dictionary, or None
+    '''
+    try:
+        with open(STATE_FILE, 'rb') as state_file:
+            state = pickle.load(state_file)
+    except FileNotFoundError:
+        return None
+    except Exception as error: #Corrupt or from an old version of the code
+        print(f"Couldn't load saved state ({type(error).__name__})")
+        return None
+
+    if state.get('version') != STATE_VERSION or state.get('coordinates') != tuple(lat_long):
+        return None
+
+    return state
+def refresh_radar():
+    ''' Run a refresh cycle (in this thread's event loop).
+
+        Returns a list of frames, and how long to wait until the next refresh (seconds)
+    '''
+    frames, interval = asyncio.get_event_loop().run_until_complete(refresh_cycle())
 
-        time_now = datetime.now(pytz.timezone(timeZone))
+    if EXPORT_DIR:
+        export_loop(frames)
+
+    return frames, interval
+def export_loop(frames):
+    ''' Save the loop as animations (for web pages, chat alerts, etc.)
+        Param frames: A list of images/frames.
+    '''
+    try:
+        exports = export_all(frames, EXPORT_DIR, name=f"{station}_{layer}", formats=EXPORT_FORMATS, duration=FRAME_DURATION)
+    except (OSError, ValueError) as error:
+        print(f"Couldn't export the loop ({error})")
+        return
+
+    for path, (size, seconds) in exports.items():
+        print(f"- Saved {path} ({round(size/1024)} KB in {seconds:.2f} seconds)")
+async def refresh_cycle():
+    ''' Get alerts, station status and radar images.
+        Everything that doesn't depend on something else runs at the same time:
+
+            hazard times --+--> local alerts ------------------------+
+            warning times -+--> greater area alerts --> overlays ---+--> frames
+            basemap --------------------------------------^          |
+            radar times ---> radar frame downloads ------------------+
+            station status --> (older frames, if not in clean air mode)
+
+        Returns a list of frames, and how long to wait until the next refresh (seconds)
+    '''
+    global warnings_list, hazard_list, local_warnings, local_alerts, storm_motion, storm_eta
+
+    print("\n****************************************************")
+    graph = TaskGraph(network_pool)
+    start_deadline(REFRESH_BUDGET)
+    settings = quality.settings()
+
+    ##############################
+    #       Alerts & status      #
+    ##############################
+    hazard_times = graph.add('hazard times', get_times, alert_capabilities_url)
+    warning_times = graph.add('warning times', get_times, warnings_capabilities_url)
+    local = graph.add('local alerts', get_all_alerts, coordinates=(lat_long[1],lat_long[0]), hazard_times=hazard_times, warning_times=warning_times)
+    status = graph.add('station status', get_station_data, station)
+
+    local_warnings_task = graph.add('local warnings', lambda alerts: alerts[0], local)
+    local_alerts_task = graph.add('local hazards', lambda alerts: alerts[1], local)
+    if settings['alerts']:
+        area = graph.add('area alerts', get_all_alerts, *AREA_HAZARDS, hazard_times=hazard_times, warning_times=warning_times)
+        warnings_task = graph.add('area warnings', lambda alerts: alerts[0], area)
+        hazards_task = graph.add('area hazards', lambda alerts: alerts[1], area)
+    else: #Turned down (see quality.py), so the greater area's alerts aren't downloaded or drawn
+        warnings_task, hazards_task = [], ([], [])
+
+    ##############################
+    #           Radar!           #
+    ##############################
+    radar_zoom_7 = graph.add('frames', get_radar_images,
+        base_map_layer=BASEMAP,
+        layer=layer,
+        zoom=7,
+        show_alerts=settings['alerts'],
+        warnings_list=warnings_task,
+        hazard_list=hazards_task,
+        local_alerts=local_alerts_task,
+        local_warnings=local_warnings_task,
+        station_status=status,
+        frames=settings['frames'],
+        radar_zoom_out=settings['radar_zoom_out'],
+        graph=graph,
+        defer=('warnings_list', 'hazard_list', 'local_alerts', 'local_warnings', 'station_status') #(Only the overlays & older frames wait for these)
+        )
 
-        print(f"\n----------------------\n     Local info:\n----------------------")
-        local_warnings, local_alerts = get_all_alerts(coordinates=(lat_long[1],lat_long[0]))
+    try:
+        results = await graph.wait()
+    finally:
+        start_deadline(None)
+    local_warnings, local_alerts = results['local alerts']
+    if 'area alerts' in results: #(Otherwise the last ones are kept, for how often to check)
+        warnings_list, hazard_list = results['area alerts']
+
+    total, timeline = graph.timeline()
+    print(f"\nRefresh took {total:.1f} seconds")
+    quality.update((total, timeline))
+
+    if settings['motion']:
+        storm_forecast()
+    else:
+        storm_motion, storm_eta = None, None
 
-        print(f"\n\n----------------------\n     Greater area:\n----------------------")
-        warnings_list, hazard_list = get_all_alerts("Storm","Extreme Wind","High Wind","Gale Warning","Blizzard","Hurricane","Tropical","Winter Storm")
+    checked_station = station
+    switched = pick_station()
 
-        ##############################
-        #           Radar!           #
-        ##############################
-        if get_station_data(station) in ["Up","Online"]:
-            radar_zoom_7 = get_radar_images(
-                base_map_layer='stamen-toner',
-                layer="bohp",
-                zoom=7,
-                show_alerts=True,
-                warnings_list=warnings_list,
-                hazard_list=hazard_list
-                )
-            if radar_zoom_7 == None:
-                tech_problems = status_images("Zoom 7 problems!",loading)
-                radar_zoom_7 = [tech_problems]
-
-            #If there's warnings, check every 5 mins! (otherwise every 10)
-            if len(warnings_list) > 0:
-                interval = (5 * 60)
-            else:
-                interval = (10*60)
+    if results['station status'] in ["Up","Online"]:
+        radar_zoom_7 = results['frames']
+        if radar_zoom_7 in [None, []]:
+            tech_problems = status_images("Zoom 7 problems!",loading)
+            radar_zoom_7 = [tech_problems]
+        elif HISTORY_DIR:
+            save_history(radar_zoom_7)
+
+        #If there's warnings, check every 5 mins! (otherwise every 10)
+        if len(warnings_list) > 0:
+            interval = (5 * 60)
         else:
-            # If the radar station is down, make an error image
-            error_background = Image.new('RGBA',(320,240),(150,100,100,255))
-            time_now = datetime.now(pytz.timezone(timeZone))
+            interval = (10*60)
+    else:
+        # If the radar station is down, make an error image (on a map of the other stations, if we can)
+        error_background = await network_status_map() or Image.new('RGBA',(320,240),(150,100,100,255))
+        time_now = datetime.now(pytz.timezone(timeZone))
 
-            ## Status message using current time, station, station status, and latency
-            message = f'({time_now.strftime("%H:%M")}) {station} {station_status.lower()}\n Last received: {latency} mins ago'
-            background_image = status_images(
-                                                message,
-                                                background=error_background,
-                                                background_colour=(0,0,0,0),
-                                                font=fnt_goth_medium,
-                                                xy=(10,100),
-                                                border=True
-                                                )
-            radar_zoom_7 = [[background_image]]
+        ## Status message using current time, station, station status, and latency
+        message = f'({time_now.strftime("%H:%M")}) {checked_station} {station_status.lower()}\n Last received: {latency} mins ago'
+        if switched:
+            message = f'{message}\n Switching to {station.upper()}'
+        background_image = status_images(
+                                            message,
+                                            background=error_background,
+                                            background_colour=(0,0,0,150), #(Dark, so it can be read over the map)
+                                            font=fnt_goth_medium,
+                                            xy=(10,100),
+                                            border=True
+                                            )
+        radar_zoom_7 = [background_image]
+
+        interval = (15*60) #Check every 15 minutes
+
+    if switched: #Get the new station's frames straight away
+        interval = 60
+
+    return radar_zoom_7, interval
+def get_history(name, size):
+    ''' Open one of the station being used's histories (the first time it's needed).
+        Each station has its own, so images from a neighbour (while ours is down) don't go in ours.
+        Param name: 'frames' or a radar product
+        Param size: (width, height) of its images
+
+        Returns a FrameHistory
+    '''
+    key = (station, name)
+    if key not in histories:
+        prune_histories()
+        max_bytes = HISTORY_MB * 1024 * 1024 // (HISTORY_STATIONS * (len(RADAR_LAYERS) + 1))
+        histories[key] = FrameHistory(os.path.join(HISTORY_DIR, station, name), (size[1], size[0], 4), max_bytes)
+    return histories[key]
+def prune_histories():
+    ''' Delete the history of stations we're not using (other than ours), so there's
+        never more than HISTORY_STATIONS stations' worth on disk.
+    '''
+    keep = {home_station, station}
+    for name in os.listdir(HISTORY_DIR) if os.path.isdir(HISTORY_DIR) else []:
+        folder = os.path.join(HISTORY_DIR, name)
+        if name in keep or not any(os.path.isfile(os.path.join(folder, product, DATA_FILE)) for product in ['frames'] + RADAR_LAYERS):
+            continue #(Only station histories are deleted)
+        for key in [key for key in histories if key[0] == name]:
+            histories.pop(key).close()
+        print(f"Deleting the {name.upper()} history")
+        shutil.rmtree(folder, ignore_errors=True)
+def save_history(frames):
+    ''' Add the new loop, and every product's radar images, to the history.
+        Param frames: The composited frames (one for each radar image of the product being shown that isn't blank)
+    '''
+    map, overlays, rasters = layer_cache
+    images = {name: list(product.values()) for name, product in rasters.items()}
+    frame_times = [time_datetime for time_datetime, radar in images.get(layer, []) if not is_blank(radar)]
+    if len(frame_times) == len(frames):
+        images['frames'] = list(zip(frame_times, frames))
+
+    for name, timed_images in images.items():
+        if not timed_images:
+            continue
+        try:
+            history = get_history(name, timed_images[0][1].size)
+            history.add_many([time_datetime for time_datetime, image in timed_images], [image.convert("RGBA") for time_datetime, image in timed_images])
+        except (OSError, ValueError) as error:
+            print(f"Couldn't save the {name} history ({error})")
+def history_images(start=None, end=None, name='frames'):
+    ''' Get images from the history (e.g. to play back or export the afternoon's storm).
+        Param start, end: UTC datetimes (None = from the first / to the last)
+        Param name: 'frames' or a radar product
+
+        Returns a list of times (UTC datetimes), and a list of PIL images
+    '''
+    if not HISTORY_DIR:
+        return [], []
+    size = layer_cache[0].size if layer_cache[0] is not None else (320, 240)
+    times, frames = get_history(name, tuple(size)).window(start, end)
+    return [datetime.fromtimestamp(int(seconds), pytz.utc) for seconds in times], to_images(frames)
+def pick_station():
+    ''' Use the nearest healthy station while ours is down, and go back to ours once it's up again.
+
+        Returns True if the station changed
+    '''
+    global station, capabilities_url, radar_extent
+    global minx, miny, maxx, maxy
+
+    if network_status is None or home_station is None:
+        return False
+
+    home = network_status.find(home_station)
+    current = network_status.find(station)
+    if home is not None and network_status.status[home] == UP:
+        choice = home_station
+        if choice == station:
+            return False
+        extent = station_extent(choice)
+        if extent is None:
+            return False
+    elif current is not None and network_status.status[current] != DOWN:
+        return False
+    else:
+        #Nearest neighbour whose radar layer we can use
+        station_type = network_status.types[home] if home is not None else None #(TDWRs have different products)
+        exclude = [home_station, station]
+        for attempt in range(NEIGHBOUR_TRIES):
+            neighbour = nearest_healthy(network_status, lat_long[0], lat_long[1], station_type, exclude=exclude, max_km=NEIGHBOUR_KM)
+            if neighbour is None:
+                return False
+            choice = network_status.ids[neighbour].lower()
+            extent = station_extent(choice)
+            if extent is not None:
+                break
+            print(f"Skipping {choice.upper()} (no radar layer extent)")
+            exclude.append(choice)
+        else:
+            return False
+
+    print(f"Switching from {station.upper()} to {choice.upper()}")
+    station = choice
+    capabilities_url = layer_capabilities_url(layer)
+    radar_extent = extent
+    minx, miny, maxx, maxy = radar_extent
+    return True
+def station_extent(station_id):
+    ''' Returns a station's radar layer extent (minx, miny, maxx, maxy), or None if we can't get it '''
+    extent = get_bounding_coordinates(layer_capabilities_url(layer, station_id))
+    return None if extent == (0, 0, 0, 0) else extent
+async def network_status_map(zoom=NETWORK_ZOOM):
+    ''' Draw every radar station around us on a basemap, coloured by status.
+        Param zoom: Zoom level for the basemap
+
+        Returns a PIL image (or None if we don't have the network status)
+    '''
+    if network_status is None:
+        return None
+
+    size = (320,240)
+    map = geotiler.Map(center=(lat_long[1],lat_long[0]), zoom=zoom, size=size, provider=map_provider(BASEMAP))
+    map_labels = geotiler.Map(center=(lat_long[1],lat_long[0]), zoom=zoom, size=size, provider=map_provider(BASEMAP_LABELS))
+    basemap, basemap_labels = await render_basemap(map, map_labels, BASEMAP)
+    status_map = Image.alpha_composite(basemap.convert('RGBA'), basemap_labels.convert('RGBA'))
+
+    #Stations on the map (all at once)
+    coordinates = np.column_stack([network_status.lons, network_status.lats])
+    known = np.isfinite(coordinates).all(axis=1)
+    pixels = np.zeros((len(coordinates), 2), dtype=int)
+    pixels[known] = map_pixels(map, coordinates[known])
+    visible = known & (pixels[:, 0] >= 0) & (pixels[:, 0] < size[0]) & (pixels[:, 1] >= 0) & (pixels[:, 1] < size[1])
+
+    draw = ImageDraw.Draw(status_map)
+    for index in np.flatnonzero(visible):
+        x, y = pixels[index]
+        radius = 6 if network_status.ids[index].lower() in [station, home_station] else 4
+        draw.ellipse((x-radius, y-radius, x+radius, y+radius), fill=STATUS_COLOURS[network_status.status[index]], outline=(0,0,0,255))
+        draw_label(status_map, (x+radius+2, y-8), str(network_status.ids[index]), fnt_small, (0,0,0,255), stroke_width=2, stroke_fill=(255,255,255,255))
+
+    return status_map
+def storm_forecast():
+    ''' Work out storm motion from the radar images we just got, and when
+        precipitation will reach the marker (the centre of the map).
+    '''
+    global storm_motion, storm_eta
+
+    storm_motion, storm_eta = None, None
+    images = [(time_datetime, radar) for time_datetime, radar in layer_cache[2].get(layer, {}).values() if not is_blank(radar)]
+    if len(images) < 2:
+        return
+
+    times = [time_datetime for time_datetime, radar in images]
+    radars = [radar for time_datetime, radar in images]
+    storm_motion = estimate_motion(radars, times, block_size=MOTION_BLOCK_SIZE)
+    if storm_motion is None:
+        print("Storm motion: not enough echoes")
+        return
+
+    width, height = radars[-1].size
+    eta = arrival_eta(radars[-1], storm_motion, (width / 2, height / 2))
+    speed_x, speed_y = storm_motion.velocity
+    print(f"Storm motion: {math.hypot(speed_x, speed_y):.2f} pixels/min")
+
+    if eta is not None:
+        #(The ETA is from the time of the last radar image, not now)
+        since = (datetime.now(pytz.utc).replace(tzinfo=None) - times[-1]).total_seconds() / 60
+        storm_eta = max(0, eta - since)
+        print(f"Precipitation at the marker in about {round(storm_eta)} mins" if storm_eta > 0 else "Precipitation at the marker now")
+def play_while(future, frames):
+    ''' Keep playing a loop of frames until a background job is finished.
+        Param future: The background job (concurrent.futures Future)
+        Param frames: A list of images/frames.
+
+        Returns the result of the job (or raises its exception)
+    '''
+    while not future.done():
+        frames = check_layer(frames)
+        play_animation(frames)
+    return future.result()
+def check_layer(frames):
+    ''' Switch products if switch_layer() was called.
+        Param frames: The frames that are playing
+
+        Returns the frames to play next
+    '''
+    if next_layer is None or next_layer == layer:
+        return frames
+    return use_layer(next_layer) or frames
+def new_event_loop():
+    ''' GeoTiler needs an asyncio event loop in the refresh thread. '''
+    asyncio.set_event_loop(asyncio.new_event_loop())
+def main():
+    ''' Refresh the radar in the background, and play the latest loop forever! '''
+    retry_delays = [30, 60, 120, 300, 600, 900] #Seconds to wait after 1, 2, 3... errors in a row
+    errors = 0
+
+    start_compositing() #(Before any threads)
+    show(loading)
+    show(status_images("Standby!",loading))
+    frames = [status_images("Standby!",loading)]
+    session_started = False
+
+    refresher = ThreadPoolExecutor(max_workers=1, initializer=new_event_loop)
+
+    while True:
+        try:
+            #Find our station & time zone (again next time round if it doesn't work)
+            if not session_started:
+                frames = start_session() or frames
+                session_started = True
+            elif not located:
+                find_location()
+
+            #Keep the last loop playing while we get new frames
+            frames, interval = play_while(refresher.submit(refresh_radar), frames)
+            save_state(frames)
+            errors = 0
+
+        except Exception as exception:
+            ### If there's an error, get the time, display it, and try again a bit later.
+            time_now = datetime.now(pytz.timezone(timeZone))
+            message = f'{time_now.strftime("%H:%M")}\nException: {type(exception).__name__}'
+            show(status_images(message,loading,font=fnt_goth_medium))
+            logging.exception('Caught an error')
 
-            interval = (15*60) #Check every 15 minutes
+            interval = retry_delays[min(errors, len(retry_delays) - 1)]
+            errors += 1
 
         print(f"\nChecking again in {interval/60} minutes.")
         start_time = time.monotonic()
@@ -1103,17 +1898,13 @@ while True:
         #      Displaying stuff!     #
         ##############################
         while time.monotonic() < start_time + interval:
-            play_animation(radar_zoom_7)
+            frames = check_layer(frames)
+            play_animation(frames)
 
         ### Once the waiting time has elapsed, show that were refreshing!
         time_now = datetime.now(pytz.timezone(timeZone))
         image_with_status = status_images(f'⟳ {time_now.strftime("%H:%M")}',latest_image)
-        disp.image(image_with_status)
-
-    except Exception as exception:
-        ### If there's an error, get the time, and display it.
-        time_now = datetime.now(pytz.timezone('America/New_York'))
-        message = f'{time_now.strftime("%H:%M")}\nException: {type(exception).__name__}'
-        disp.image(status_images(message,loading,font=fnt_goth_medium))
-        logging.exception('Caught an error')
-        break
+        show(image_with_status)
+
+if __name__ == "__main__":
+    main()